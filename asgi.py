@@ -0,0 +1,380 @@
+import os
+import json
+import uuid
+import time
+import asyncio
+import logging
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qsl
+from concurrent.futures import ThreadPoolExecutor
+from jsonschema import validate, ValidationError
+import main
+import src.shared_variables as shared_variables
+from src.validation_schemas import (
+    store_schema, update_schema, update_batch_schema, interaction_payload_schema, interaction_chunk_schema, challenge_stream_schema
+)
+from src.handlers.challenge import (
+    validate_interaction_payload, take_streamed_session, score_interaction, build_interaction_record, save_interaction_record,
+    sign_token
+)
+from src.handlers.store import store_interaction
+from src.handlers.update import apply_label, apply_labels
+from src.handlers.serve import public_key_pem
+from src.handlers.profile import parse_profile_args, profile_headers
+from src.profiler import ProfilerError, collapsed
+from src.session_store import IncompleteStream, OutOfOrderChunk
+from src.tenants import site_for_token, bearer_token
+from src.access_log import StageTimer
+
+##################
+# asyncio serving mode
+#
+# Exposes the same routes as main.py as an ASGI application. The event loop only parses
+# requests and writes responses; CPU heavy steps (validation, user agent parsing, feature
+# extraction, inference, signing) run in a bounded thread pool and file I/O runs in the
+# default executor, so a slow disk or a long extraction never blocks other requests.
+# Keys, tokens, the model and admission control are shared with main.py.
+#
+# to run this, run `uvicorn asgi:app --host 0.0.0.0 --port 5000` from the root of the repo
+##################
+
+CPU_WORKERS = int(os.getenv('ASGI_CPU_WORKERS', str(os.cpu_count() or 1)))
+cpu_executor = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix='challenge')
+
+# Routes that do not need the AUTH_TOKEN, same as check_authentication in main.py
+PUBLIC_ROUTES = {'/api/public_key', '/api/assets', '/api/challenge', '/api/challenge/events'}
+
+
+class Request:
+    def __init__(self, scope, body, started_at=None):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.query = dict(parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+        self.scheme = scope.get('scheme', 'http')
+        self.http_version = scope.get('http_version', '1.1')
+        self.remote_addr = scope['client'][0] if scope.get('client') else None
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+        self.body = body
+        self.started_at = started_at if started_at is not None else time.perf_counter()
+        # Stage timings for the access log
+        self.stages = StageTimer()
+
+    @property
+    def cookies(self):
+        cookie = SimpleCookie()
+        cookie.load(self.headers.get('cookie', ''))
+        return {name: morsel.value for name, morsel in cookie.items()}
+
+    def json(self):
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            return None
+
+
+class Response:
+    def __init__(self, body=b'', status=200, content_type='application/json', headers=None):
+        self.body = body
+        self.status = status
+        self.headers = ([('content-type', content_type)] if content_type else []) + (headers or [])
+
+    def set_cookie(self, name, value):
+        self.headers.append(('set-cookie', f'{name}={value}; Path=/'))
+
+
+def json_response(data, status=200, headers=None):
+    return Response(json.dumps(data).encode('utf-8'), status, headers=headers)
+
+
+def _validated_json(request, schema):
+    # Equivalent of flask_expects_json: returns (data, None) or (None, error response)
+    data = request.json()
+    if not isinstance(data, dict):
+        return None, json_response({'error': 'Failed to decode JSON object'}, 400)
+    try:
+        validate(instance=data, schema=schema)
+    except ValidationError as e:
+        return None, json_response({'error': e.message}, 400)
+    return data, None
+
+
+def _run_challenge(interaction_payload, body, user_agent_string, site_id, interaction_id, stages):
+    # Everything CPU heavy for one challenge, executed in cpu_executor; body holds the streaming fields
+    stages.mark('queue')
+    error = (validate_interaction_payload(interaction_payload, interaction_payload_schema)
+             or validate_interaction_payload(body, challenge_stream_schema))
+    stages.mark('validate')
+    if error:
+        return error, None, None, None, None
+    # May load the site's model from disk on first use
+    model, encoder, linear = shared_variables.current_model(site_id)
+    session = take_streamed_session(main.session_store, body)
+    score, user_agent = score_interaction(interaction_payload, user_agent_string, model, encoder, session, linear, main.cascade)
+    stages.mark('score')
+    token = sign_token(score, interaction_id, main.PRIVATE_KEY)
+    stages.mark('sign')
+    return None, score, user_agent, token, session.feature_vector() if session is not None else None
+
+
+def _run_challenge_events(chunk):
+    error = validate_interaction_payload(chunk, interaction_chunk_schema)
+    if error:
+        return error, None
+    return None, main.session_store.feed(chunk['streamId'], chunk['interactions'], chunk['seq'])
+
+
+async def captcha_challenge(request):
+    rejection = main.admission.admit(request.remote_addr, request.cookies.get('session_id'))
+    request.stages.mark('admission')
+    if rejection is not None:
+        return json_response({'error': 'Too many requests', 'reason': rejection}, 429, [('retry-after', '1')])
+    try:
+        api_key = bearer_token(request.headers.get('authorization'))
+        site_id = site_for_token(api_key)
+        if not api_key or (api_key != main.PUBLIC_AUTH_TOKEN and site_id is None):
+            return json_response({'error': 'Unauthorized'}, 401)
+
+        body = request.json()
+        if not isinstance(body, dict):
+            return json_response({'error': 'Failed to decode JSON object'}, 400)
+        interaction_payload = body.get('data')
+        save_interaction = body.get('save', False)
+        if not interaction_payload:
+            return json_response({'error': 'No data provided'}, 400)
+
+        session_id = request.cookies.get('session_id') or str(uuid.uuid4())
+        interaction_id = str(uuid.uuid4())
+
+        loop = asyncio.get_running_loop()
+        try:
+            error, score, user_agent, token, features = await loop.run_in_executor(
+                cpu_executor, _run_challenge,
+                interaction_payload, body, request.headers.get('user-agent'), site_id, interaction_id, request.stages
+            )
+        except IncompleteStream as e:
+            return json_response({'error': 'Streamed events are incomplete on this worker', 'reason': str(e)}, 409)
+        if error:
+            return json_response({'error': error}, 400)
+
+        if save_interaction == True:
+            record = build_interaction_record(
+                session_id, interaction_id, interaction_payload, score, user_agent, request.headers.get('referer', ''),
+                features, site_id
+            )
+            await asyncio.to_thread(save_interaction_record, record)
+            request.stages.mark('save')
+
+        response = json_response({'token': token})
+        response.set_cookie('session_id', session_id)
+        return response
+    finally:
+        main.admission.release()
+
+
+async def captcha_challenge_events(request):
+    rejection = main.admission.admit(request.remote_addr, request.cookies.get('session_id'))
+    request.stages.mark('admission')
+    if rejection is not None:
+        return json_response({'error': 'Too many requests', 'reason': rejection}, 429, [('retry-after', '1')])
+    try:
+        api_key = bearer_token(request.headers.get('authorization'))
+        site_id = site_for_token(api_key)
+        if not api_key or (api_key != main.PUBLIC_AUTH_TOKEN and site_id is None):
+            return json_response({'error': 'Unauthorized'}, 401)
+
+        chunk = request.json()
+        if not isinstance(chunk, dict):
+            return json_response({'error': 'Failed to decode JSON object'}, 400)
+        session_id = request.cookies.get('session_id') or str(uuid.uuid4())
+
+        loop = asyncio.get_running_loop()
+        try:
+            error, interaction_count = await loop.run_in_executor(cpu_executor, _run_challenge_events, chunk)
+        except OutOfOrderChunk as e:
+            return json_response({'error': 'Chunk out of order', 'reason': str(e), 'expectedSeq': e.expected_seq}, 409)
+        if error:
+            return json_response({'error': error}, 400)
+
+        response = json_response({'interaction_count': interaction_count})
+        response.set_cookie('session_id', session_id)
+        return response
+    finally:
+        main.admission.release()
+
+
+async def captcha_challenge_preflight(request):
+    # CORS preflight, same as flask_cors.cross_origin on the Flask route
+    return Response(status=200, content_type='text/html; charset=utf-8', headers=[
+        ('access-control-allow-origin', '*'),
+        ('access-control-allow-methods', 'POST, OPTIONS'),
+        ('access-control-allow-headers', request.headers.get('access-control-request-headers', '*'))
+    ])
+
+
+async def store_data(request):
+    data, error = _validated_json(request, store_schema)
+    if error:
+        return error
+    if not data.get('data'):
+        return json_response({'error': 'Data is required'}, 400)
+    session_id = data.get('session_id') or request.cookies.get('session_id')
+    interaction_id, session_id = await asyncio.to_thread(
+        store_interaction, data['data'], session_id, request.headers.get('user-agent'), data.get('site_id')
+    )
+    response = json_response({'message': 'Data stored successfully', 'interaction_id': interaction_id})
+    response.set_cookie('session_id', session_id)
+    return response
+
+
+async def update_label(request):
+    data, error = _validated_json(request, update_schema)
+    if error:
+        return error
+    if not data.get('interaction_id') or data.get('label') is None:
+        return json_response({'error': 'Interaction ID and label are required'}, 400)
+    if not await asyncio.to_thread(apply_label, data['interaction_id'], data['label']):
+        return json_response({'error': 'Interaction ID not found'}, 404)
+    return json_response({'message': 'Label updated successfully'})
+
+
+async def update_labels_batch(request):
+    data, error = _validated_json(request, update_batch_schema)
+    if error:
+        return error
+    updated, not_found, failed = await asyncio.to_thread(apply_labels, data['updates'])
+    return json_response({'message': 'Labels updated successfully', 'updated': updated, 'not_found': not_found, 'failed': failed})
+
+
+async def get_public_key(request):
+    return json_response({'public_key': public_key_pem(main.PUBLIC_KEY)})
+
+
+async def admission_stats(request):
+    return json_response(dict(main.admission.stats(), streaming_sessions=main.session_store.stats(), access_log=main.access_log.stats(),
+                              traffic_capture=main.traffic_capture.stats()))
+
+
+async def model_cache_stats(request):
+    return json_response(shared_variables.tenant_models.stats())
+
+
+async def cascade_stats(request):
+    return json_response(main.cascade.stats())
+
+
+async def profile_worker(request):
+    # Sampled from a thread of the default executor, so the event loop keeps serving (and is sampled)
+    try:
+        seconds, interval, include_idle, lines, output_format = parse_profile_args(request.query)
+        result = await asyncio.to_thread(main.profiler.profile, seconds, interval, include_idle, lines)
+    except ProfilerError as e:
+        return json_response({'error': str(e)}, 400)
+    if result is None:
+        return json_response({'error': 'A profile is already running on this worker'}, 409)
+    if output_format == 'json':
+        return json_response(result)
+    headers = [(name.lower(), value) for name, value in profile_headers(result)]
+    return Response(collapsed(result).encode('utf-8'), content_type='text/plain; charset=utf-8', headers=headers)
+
+
+async def get_asset_manifest(request):
+    return json_response(main.static_assets.manifest())
+
+
+async def serve_file(request):
+    # Served from memory; html/ is re-scanned and recompressed by the watcher thread of src/static_assets.py
+    path = request.path.lstrip('/') or 'index.html'
+    result = main.static_assets.respond(path, request.headers.get('accept-encoding'), request.headers.get('if-none-match'))
+    if result is None:
+        return json_response({'error': 'Not found'}, 404)
+    status, headers, body = result
+    return Response(body, status, content_type=None, headers=[(name.lower(), value) for name, value in headers])
+
+
+ROUTES = {
+    ('POST', '/api/challenge'): captcha_challenge,
+    ('OPTIONS', '/api/challenge'): captcha_challenge_preflight,
+    ('POST', '/api/challenge/events'): captcha_challenge_events,
+    ('OPTIONS', '/api/challenge/events'): captcha_challenge_preflight,
+    ('POST', '/api/store'): store_data,
+    ('POST', '/api/update'): update_label,
+    ('POST', '/api/update/batch'): update_labels_batch,
+    ('GET', '/api/public_key'): get_public_key,
+    ('GET', '/api/assets'): get_asset_manifest,
+    ('GET', '/api/admin/admission'): admission_stats,
+    ('GET', '/api/admin/models'): model_cache_stats,
+    ('GET', '/api/admin/cascade'): cascade_stats,
+    ('GET', '/api/admin/profile'): profile_worker
+}
+
+
+async def dispatch(request):
+    handler = ROUTES.get((request.method, request.path))
+    if handler is None:
+        if request.method == 'GET':
+            return await serve_file(request)
+        if any(path == request.path for _, path in ROUTES):
+            return json_response({'error': 'Method not allowed'}, 405)
+        return json_response({'error': 'Not found'}, 404)
+
+    if request.path not in PUBLIC_ROUTES:
+        auth_header = request.headers.get('authorization')
+        if not auth_header or len(auth_header.split()) < 2 or auth_header.split()[1] != main.AUTH_TOKEN:
+            return json_response({'error': 'Unauthorized'}, 401)
+    response = await handler(request)
+    if request.path in ('/api/challenge', '/api/challenge/events') and request.method == 'POST':
+        response.headers.append(('access-control-allow-origin', '*'))
+    return response
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            break
+    return b''.join(chunks)
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                cpu_executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        return
+
+    started_at = time.perf_counter()
+    request = Request(scope, await _read_body(receive), started_at)
+    try:
+        response = await dispatch(request)
+    except Exception:
+        logging.exception(f'Error handling {request.method} {request.path}')
+        response = json_response({'error': 'Internal server error'}, 500)
+
+    await send({
+        'type': 'http.response.start',
+        'status': response.status,
+        'headers': [(name.encode('latin-1'), value.encode('latin-1')) for name, value in response.headers]
+                   + [(b'content-length', str(len(response.body)).encode('latin-1'))]
+    })
+    await send({'type': 'http.response.body', 'body': response.body})
+
+    main.access_log.record(
+        request.method, request.path, response.status, request.started_at, len(request.body), len(response.body),
+        request.remote_addr, request.headers.get('user-agent'), request.headers.get('referer'), request.stages.stages
+    )
+    if main.traffic_capture.enabled:
+        main.traffic_capture.record(
+            request.method, request.path, request.started_at, request.body, request.headers.get('user-agent'),
+            request.cookies.get('session_id'), site_for_token(bearer_token(request.headers.get('authorization'))),
+            response.status, response.body
+        )
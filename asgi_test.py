@@ -0,0 +1,189 @@
+import sys
+import os
+import pytest
+import asyncio
+import base64
+import json
+import jwt
+
+sys.path.append(os.path.abspath("."))  # Add current directory
+
+from main import app as flask_app
+from asgi import app as asgi_app
+
+AUTH_TOKEN = os.getenv('AUTH_TOKEN')
+PUBLIC_AUTH_TOKEN = os.getenv('PUBLIC_AUTH_TOKEN')
+USER_AGENT = 'Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) AppleWebKit/605.1.15 Mobile/15E148'
+
+CHALLENGE_PAYLOAD = {
+    'interactions': {
+        'mouseMovements': [{'x': 10, 'y': 10, 'time': 0}, {'x': 40, 'y': 50, 'time': 100}, {'x': 90, 'y': 60, 'time': 250}],
+        'keyPresses': [{'key': 'a', 'time': 300}, {'key': 'b', 'time': 420}]
+    },
+    'duration': 1000,
+    'viewport': {'width': 1280, 'height': 720},
+    'loadTimestamp': 1234567890
+}
+
+
+def call_asgi(method, path, headers=None, body=None):
+    """Send one request through the ASGI app and return (status, headers, body)."""
+    raw_body = json.dumps(body).encode('utf-8') if body is not None else b''
+    path, _, query_string = path.partition('?')
+    scope = {
+        'type': 'http',
+        'method': method,
+        'path': path,
+        'query_string': query_string.encode('latin-1'),
+        'scheme': 'http',
+        'http_version': '1.1',
+        'client': ('127.0.0.1', 50000),
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in (headers or {}).items()]
+    }
+    messages = [{'type': 'http.request', 'body': raw_body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi_app(scope, receive, send))
+    response_headers = {name.decode('latin-1'): value.decode('latin-1') for name, value in sent[0]['headers']}
+    return sent[0]['status'], response_headers, sent[1]['body']
+
+
+@pytest.fixture
+def client():
+    flask_app.config['TESTING'] = True
+    with flask_app.test_client() as client:
+        yield client
+
+
+@pytest.mark.parametrize('path, headers', [
+    ('/api/public_key', {}),
+    ('/captcha.js', {}),
+    ('/captcha.js', {'Accept-Encoding': 'gzip, br'}),
+    ('/captcha.js', {'If-None-Match': '*'}),
+    ('/missing.js', {}),
+    ('/api/assets', {}),
+    ('/api/admin/admission', {}),
+    ('/api/admin/admission', {'Authorization': f'Bearer {AUTH_TOKEN}'}),
+    ('/api/admin/models', {}),
+    ('/api/admin/models', {'Authorization': f'Bearer {AUTH_TOKEN}'}),
+    ('/api/admin/cascade', {}),
+    ('/api/admin/cascade', {'Authorization': f'Bearer {AUTH_TOKEN}'}),
+    ('/api/admin/profile', {}),
+    ('/api/admin/profile?seconds=0.1&format=json', {'Authorization': f'Bearer {AUTH_TOKEN}'}),
+    ('/api/admin/profile?seconds=600', {'Authorization': f'Bearer {AUTH_TOKEN}'})
+])
+def test_get_parity(client, path, headers):
+    """Test GET routes answer with the same status in both servers."""
+    rv = client.get(path, headers=headers)
+    status, response_headers, body = call_asgi('GET', path, headers)
+    assert status == rv.status_code
+    if status == 200 and path.startswith('/api/'):
+        assert json.loads(body).keys() == rv.get_json().keys()
+    if path == '/captcha.js':
+        assert body == rv.data
+        assert response_headers.get('etag') == rv.headers.get('ETag')
+        assert response_headers.get('content-encoding') == rv.headers.get('Content-Encoding')
+
+
+@pytest.mark.parametrize('body, headers', [
+    ({'data': CHALLENGE_PAYLOAD}, {'Authorization': f'Bearer {PUBLIC_AUTH_TOKEN}', 'User-Agent': USER_AGENT}),
+    ({'data': CHALLENGE_PAYLOAD}, {'Authorization': 'Bearer wrong-token', 'User-Agent': USER_AGENT}),
+    ({'data': {'interactions': {}}}, {'Authorization': f'Bearer {PUBLIC_AUTH_TOKEN}', 'User-Agent': USER_AGENT}),
+    ({'save': False}, {'Authorization': f'Bearer {PUBLIC_AUTH_TOKEN}', 'User-Agent': USER_AGENT})
+])
+def test_challenge_parity(client, body, headers):
+    """Test challenges get the same status and score from both servers."""
+    rv = client.post('/api/challenge', json=body, headers=headers)
+    status, response_headers, response_body = call_asgi('POST', '/api/challenge', {**headers, 'Content-Type': 'application/json'}, body)
+    assert status == rv.status_code
+    assert response_headers.get('access-control-allow-origin') == rv.headers.get('Access-Control-Allow-Origin')
+    if status == 200:
+        flask_token = jwt.decode(rv.get_json()['token'], options={'verify_signature': False})
+        asgi_token = jwt.decode(json.loads(response_body)['token'], options={'verify_signature': False})
+        assert asgi_token['score'] == flask_token['score']
+        assert 'session_id=' in response_headers['set-cookie']
+
+
+def test_challenge_token_verifies_with_public_key():
+    """Test the token signed by the ASGI server verifies with the served public key."""
+    headers = {'Authorization': f'Bearer {PUBLIC_AUTH_TOKEN}', 'User-Agent': USER_AGENT}
+    status, _, body = call_asgi('POST', '/api/challenge', headers, {'data': CHALLENGE_PAYLOAD})
+    assert status == 200
+    _, _, public_key = call_asgi('GET', '/api/public_key')
+    token = jwt.decode(json.loads(body)['token'], json.loads(public_key)['public_key'], algorithms=['RS256'])
+    assert 'interaction_id' in token
+
+
+def test_store_and_update_parity(client):
+    """Test store, update and batch update behave the same in both servers."""
+    headers = {'Authorization': f'Bearer {AUTH_TOKEN}', 'User-Agent': USER_AGENT}
+    data = {'data': base64.b64encode(json.dumps(CHALLENGE_PAYLOAD).encode('utf-8')).decode('utf-8')}
+    rv = client.post('/api/store', json=data, headers=headers)
+    status, _, body = call_asgi('POST', '/api/store', headers, data)
+    assert status == rv.status_code == 200
+    interaction_ids = [rv.get_json()['interaction_id'], json.loads(body)['interaction_id']]
+    with open(os.path.join('data', f'{interaction_ids[0]}.json')) as f:
+        flask_record = json.load(f)
+    with open(os.path.join('data', f'{interaction_ids[1]}.json')) as f:
+        asgi_record = json.load(f)
+    assert flask_record.keys() == asgi_record.keys()
+    assert flask_record['user_agent'] == asgi_record['user_agent']
+
+    for update in [{'interaction_id': interaction_ids[0], 'label': 1}, {'interaction_id': 'missing', 'label': 1}, {'label': 1}]:
+        rv = client.post('/api/update', json=update, headers=headers)
+        status, _, body = call_asgi('POST', '/api/update', headers, update)
+        assert status == rv.status_code
+
+    batch = {'updates': [{'interaction_id': interaction_id, 'label': 0} for interaction_id in interaction_ids + ['missing']]}
+    rv = client.post('/api/update/batch', json=batch, headers=headers)
+    status, _, body = call_asgi('POST', '/api/update/batch', headers, batch)
+    assert status == rv.status_code == 200
+    assert json.loads(body) == rv.get_json()
+
+    status, _, _ = call_asgi('POST', '/api/update', {}, {'interaction_id': interaction_ids[0], 'label': 1})
+    assert status == 401
+
+    for interaction_id in interaction_ids:
+        os.remove(os.path.join('data', f'{interaction_id}.json'))
+    os.remove('request_counter.txt')
+
+
+def test_challenge_events_parity(client):
+    """Test streamed event chunks are accepted the same way by both servers."""
+    headers = {'Authorization': f'Bearer {PUBLIC_AUTH_TOKEN}', 'User-Agent': USER_AGENT}
+    for body in [{'streamId': 'parity-page', 'seq': 0, 'interactions': CHALLENGE_PAYLOAD['interactions']},
+                 {'interactions': CHALLENGE_PAYLOAD['interactions']}, {'streamId': 'parity-page', 'interactions': CHALLENGE_PAYLOAD['interactions']},
+                 {'streamId': 'parity-page', 'seq': 0, 'interactions': []}, {}]:
+        rv = client.post('/api/challenge/events', json=dict(body, streamId='flask-stream') if 'streamId' in body else body,
+                         headers=headers)
+        status, response_headers, response_body = call_asgi(
+            'POST', '/api/challenge/events', headers, dict(body, streamId='asgi-stream') if 'streamId' in body else body
+        )
+        assert status == rv.status_code
+        if status == 200:
+            assert json.loads(response_body) == rv.get_json() == {'interaction_count': 5}
+            assert response_headers.get('access-control-allow-origin') == rv.headers.get('Access-Control-Allow-Origin')
+
+    # A chunk that skips one is refused with the number to resend from
+    body = {'seq': 2, 'interactions': CHALLENGE_PAYLOAD['interactions']}
+    rv = client.post('/api/challenge/events', json=dict(body, streamId='flask-stream'), headers=headers)
+    status, _, response_body = call_asgi('POST', '/api/challenge/events', headers, dict(body, streamId='asgi-stream'))
+    assert status == rv.status_code == 409
+    assert json.loads(response_body)['expectedSeq'] == rv.get_json()['expectedSeq'] == 1
+
+    # Each server folded one chunk of its stream; a challenge claiming two is refused
+    rv = client.post('/api/challenge', json={'data': CHALLENGE_PAYLOAD, 'streamId': 'flask-stream', 'streamedChunks': 2}, headers=headers)
+    status, response_headers, _ = call_asgi(
+        'POST', '/api/challenge', headers, {'data': CHALLENGE_PAYLOAD, 'streamId': 'asgi-stream', 'streamedChunks': 2}
+    )
+    assert status == rv.status_code == 409
+    assert response_headers.get('access-control-allow-origin') == rv.headers.get('Access-Control-Allow-Origin')
+
+    status, _, _ = call_asgi('POST', '/api/challenge/events', {'Authorization': 'Bearer wrong-token'}, {'interactions': {}})
+    assert status == 401
@@ -0,0 +1,66 @@
+import sys
+import os
+import time
+import logging
+import tempfile
+from datetime import datetime
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.access_log import AccessLog, StageTimer
+
+##################
+# BENCHMARK
+# time spent on the request thread per access log record: formatting and writing the
+# access-log line synchronously through logging (what after_request used to do) against
+# enqueueing a record for the background writer of src/access_log.py, with and without
+# sampling of successful challenges
+# to run this, run `python benchmarks/access_log_bench.py [requests]` from the root of the repo
+##################
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+
+
+def synchronous_us(log_path, requests):
+    logger = logging.getLogger('access-log-bench')
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    handler = logging.FileHandler(log_path)
+    logger.addHandler(handler)
+    start = time.perf_counter()
+    for _ in range(requests):
+        logger.info('%s - - [%s] "%s %s %s" %s "%s" "%s" %s %s',
+            '203.0.113.7', datetime.now().strftime('%d/%b/%Y:%H:%M:%S %z'), 'POST', '/api/challenge', 'HTTP',
+            'HTTP/1.1', '-', USER_AGENT, 200, 1834)
+    elapsed = time.perf_counter() - start
+    logger.removeHandler(handler)
+    handler.close()
+    return elapsed / requests * 1e6
+
+
+def queued_us(log_path, requests, sample_rate):
+    access_log = AccessLog(log_path, sample_rate=sample_rate, queue_size=requests + 1)
+    stages = StageTimer()
+    for stage in ['admission', 'validate', 'score', 'sign']:
+        stages.mark(stage)
+    start = time.perf_counter()
+    for _ in range(requests):
+        access_log.record('POST', '/api/challenge', 200, start, 1834, 512, '203.0.113.7', USER_AGENT, None, stages.stages)
+    elapsed = time.perf_counter() - start
+    access_log.flush(timeout=60)
+    drained = time.perf_counter() - start
+    access_log.close()
+    return elapsed / requests * 1e6, drained
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    with tempfile.TemporaryDirectory() as scratch:
+        sync_us = synchronous_us(os.path.join(scratch, 'sync.log'), requests)
+        print(f'synchronous logging:          {sync_us:7.2f} us/request on the request thread')
+        for sample_rate in [1.0, 0.1]:
+            queue_us, drained = queued_us(os.path.join(scratch, f'queued-{sample_rate}.log'), requests, sample_rate)
+            print(f'queued, sample rate {sample_rate:<4}:     {queue_us:7.2f} us/request on the request thread '
+                  f'({sync_us / queue_us:.1f}x), all written after {drained:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
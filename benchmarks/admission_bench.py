@@ -0,0 +1,47 @@
+import sys
+import os
+import time
+import threading
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.admission import AdmissionController
+
+##################
+# BENCHMARK
+# measures the per-request cost of admission control (admit + release)
+# to run this, run `python benchmarks/admission_bench.py [requests] [threads] [clients]` from the root of the repo
+##################
+
+
+def run(admission, keys, requests):
+    for i in range(requests):
+        key = keys[i % len(keys)]
+        if admission.admit(key, key) is None:
+            admission.release()
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    clients = int(sys.argv[3]) if len(sys.argv) > 3 else 10000
+    admission = AdmissionController(ip_rate=1000, ip_burst=1000, session_rate=1000, session_burst=1000, max_concurrent=64)
+    keys = [f'10.0.{i // 256}.{i % 256}' for i in range(clients)]
+
+    start = time.perf_counter()
+    run(admission, keys, requests)
+    single = time.perf_counter() - start
+    print(f'1 thread:   {single / requests * 1e6:.2f} us/request')
+
+    per_thread = requests // threads
+    workers = [threading.Thread(target=run, args=(admission, keys[i::threads], per_thread)) for i in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    print(f'{threads} threads:  {elapsed / (per_thread * threads) * 1e6:.2f} us/request')
+    print(admission.stats())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+import sys
+import os
+import time
+import random
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from memory_harness import make_payload
+from model.model_definitions import NeuralNet
+from src.cascade import Cascade, LinearScreen
+from src.handlers.challenge import score_interaction
+from src.extract_features import FEATURE_COUNT, FEATURE_NAMES
+from src.device_encoder import DeviceEncoder
+
+##################
+# BENCHMARK
+# per-request cost of score_interaction with and without the scoring cascade, for an empty
+# payload (decided by the rules), a payload the linear screen is confident about and one that
+# goes all the way to the network
+# to run this, run `python benchmarks/cascade_bench.py [requests]` from the root of the repo
+##################
+
+USER_AGENT = 'Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) AppleWebKit/605.1.15 Mobile/15E148'
+
+
+def per_request_us(score, payload, requests):
+    start = time.perf_counter()
+    for _ in range(requests):
+        score(payload)
+    return (time.perf_counter() - start) / requests * 1e6
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    encoder = DeviceEncoder(['Other', 'iPhone'])
+    model = NeuralNet(FEATURE_COUNT + encoder.width).eval()
+    width = FEATURE_COUNT + encoder.width
+    # Weights that only look at the interaction count: confident for long sessions, undecided otherwise
+    count_weight = [0.0] * width
+    count_weight[FEATURE_NAMES.index('interaction_count')] = 0.05
+    linear = LinearScreen(count_weight, -5.0, 0.01, 0.99)
+    rng = random.Random(0)
+    payloads = {
+        'empty (rules)': {'interactions': {}, 'duration': 1000},
+        '200 events/stream (linear)': make_payload(rng, 200),
+        '20 events/stream (network)': make_payload(rng, 20)
+    }
+
+    cascade = Cascade()
+    for name, payload in payloads.items():
+        without = per_request_us(lambda p: score_interaction(p, USER_AGENT, model, encoder), payload, requests)
+        with_cascade = per_request_us(lambda p: score_interaction(p, USER_AGENT, model, encoder, None, linear, cascade), payload, requests)
+        print(f'{name:<28} network only {without:8.1f} us/request  cascade {with_cascade:8.1f} us/request ({without / with_cascade:.1f}x)')
+    for stage, stage_stats in cascade.stats()['stages'].items():
+        print(f'{stage:<8} decided {stage_stats["decided"]:>6}  mean {stage_stats["mean_latency_us"]:8.1f} us')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+import sys
+import os
+import time
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.device_encoder import DeviceEncoder
+
+##################
+# BENCHMARK
+# per-request cost of one-hot encoding the device family: OneHotEncoder.transform (what the
+# challenge handler used to call) against the DeviceEncoder lookup table
+# to run this, run `python benchmarks/device_encoding_bench.py [requests]` from the root of the repo
+##################
+
+FAMILIES = ['Other', 'iPhone', 'iPad', 'Mac', 'Samsung SM-S918B', 'Pixel 7', 'Pixel 8', 'K', 'Spider', 'Generic Smartphone']
+
+
+def per_request_us(encode, requests):
+    start = time.perf_counter()
+    for i in range(requests):
+        encode(FAMILIES[i % len(FAMILIES)])
+    return (time.perf_counter() - start) / requests * 1e6
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    start = time.perf_counter()
+    from sklearn.preprocessing import OneHotEncoder
+    sklearn_import = time.perf_counter() - start
+    sklearn_encoder = OneHotEncoder(sparse_output=False).fit([[family] for family in FAMILIES])
+    encoder = DeviceEncoder(FAMILIES)
+
+    sklearn_us = per_request_us(lambda family: list(sklearn_encoder.transform([[family]]).flatten()), requests)
+    lookup_us = per_request_us(encoder.encode, requests)
+    print(f'OneHotEncoder.transform: {sklearn_us:8.2f} us/request (plus {sklearn_import * 1000:.0f} ms to import sklearn)')
+    print(f'DeviceEncoder.encode:    {lookup_us:8.2f} us/request ({sklearn_us / lookup_us:.0f}x)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+import sys
+import os
+import time
+import random
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src import extract_features as ef
+from main_test import reference_feature_vector
+
+##################
+# BENCHMARK
+# compares the per-feature reference functions in main_test.py (one pass over the events per feature)
+# with the fused engine behind extract_features (one pass per event stream)
+# to run this, run `python benchmarks/feature_extraction_bench.py [events per stream] [sessions]` from the root of the repo
+##################
+
+
+def make_session(rng, length):
+    return ef.UserInteractionData(
+        mouse_movements=[{'x': rng.uniform(0, 1000), 'y': rng.uniform(0, 800), 'time': i * 16} for i in range(length)],
+        key_presses=[{'key': 'a', 'time': i * 120} for i in range(length)],
+        scroll_events=[{'scrollTop': rng.uniform(0, 5000), 'time': i * 30} for i in range(length)],
+        form_interactions=[{'time': i * 900} for i in range(10)],
+        touch_events=[
+            {'x': rng.uniform(0, 400), 'y': rng.uniform(0, 800), 'force': rng.random(),
+             'type': ['start', 'move', 'end'][i % 3], 'time': i * 20}
+            for i in range(length)
+        ],
+        mouse_clicks=[{'type': ['down', 'up'][i % 2], 'time': i * 80} for i in range(length)],
+        duration=length * 16
+    )
+
+
+def timed(function, sessions):
+    start = time.perf_counter()
+    results = [function(session) for session in sessions]
+    return (time.perf_counter() - start) / len(sessions), results
+
+
+def main():
+    length = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    rng = random.Random(0)
+    sessions = [make_session(rng, length) for _ in range(count)]
+
+    reference_time, reference_results = timed(reference_feature_vector, sessions)
+    fused_time, fused_results = timed(ef.extract_feature_vector, sessions)
+    assert fused_results == reference_results, 'fused engine differs from the reference implementation'
+
+    print(f'{length} events per stream, {count} sessions')
+    print(f'reference: {reference_time * 1000:.2f} ms/session')
+    print(f'fused:     {fused_time * 1000:.2f} ms/session ({reference_time / fused_time:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
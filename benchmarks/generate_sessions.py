@@ -0,0 +1,330 @@
+import sys
+import os
+import json
+import gzip
+import math
+import uuid
+import random
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone, timedelta
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from user_agents import parse
+from src.extract_features import FEATURE_EXTRACTOR_VERSION
+
+##################
+# SYNTHETIC SESSIONS
+# generates labelled human-like (label 1) and bot-like (label 0) interaction sessions in the
+# schema store_data writes to data/, for benchmarking training, the catalog and storage at
+# production volumes:
+#   - humans: curved, throttled mouse paths with minimum-jerk speed profiles, clicks with
+#     press durations, typing with variable key intervals, scroll bursts, touch taps and
+#     swipes on mobile user agents, form submissions
+#   - bots: empty submissions, scripted sessions (straight lines, constant intervals,
+#     zero-length clicks) and sped-up replays of human sessions
+# Session i only depends on (seed, i), so the output is the same for any number of workers.
+# Formats:
+#   files     <out>/<interaction_id>.json; written to data/ they are indexed in the dataset catalog
+#             in bulk (unless --no-catalog), elsewhere only into the catalog given with --catalog
+#   jsonl     <out>/sessions-<chunk>.jsonl, one record per line
+#   jsonl.gz  the same, gzip compressed
+# to run this, run `python benchmarks/generate_sessions.py --count 1000000 [--format files] [--jobs N]`
+# from the root of the repo
+##################
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+SESSION_SPACING_MS = 1000
+CHUNK_SIZE = 10000
+FORMATS = ('files', 'jsonl', 'jsonl.gz')
+
+HUMAN_DESKTOP_USER_AGENTS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.1 Safari/605.1.15',
+    'Mozilla/5.0 (X11; Linux x86_64; rv:121.0) Gecko/20100101 Firefox/121.0',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36 Edg/120.0.0.0'
+]
+HUMAN_MOBILE_USER_AGENTS = [
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 17_1 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.1 Mobile/15E148 Safari/604.1',
+    'Mozilla/5.0 (Linux; Android 14; Pixel 7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Mobile Safari/537.36',
+    'Mozilla/5.0 (Linux; Android 13; SM-S918B) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Mobile Safari/537.36',
+    'Mozilla/5.0 (iPad; CPU OS 17_1 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.1 Mobile/15E148 Safari/604.1'
+]
+BOT_USER_AGENTS = [
+    'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) HeadlessChrome/120.0.0.0 Safari/537.36',
+    'python-requests/2.31.0',
+    'curl/8.4.0',
+    'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)'
+]
+DESKTOP_VIEWPORTS = [(1920, 969), (1536, 730), (1366, 657), (1440, 789), (2560, 1289)]
+MOBILE_VIEWPORTS = [(390, 664), (412, 783), (360, 640), (820, 1106)]
+FIELDS = ['email', 'name', 'password', 'message', 'phone', 'company']
+WORDS = ['hello', 'captcha', 'interaction', 'summer', 'orange', 'network', 'quarterly', 'report', 'thanks', 'meeting']
+
+# Parsed once per worker, parsing dominates otherwise
+_user_agent_fields = {}
+
+
+def user_agent_fields(user_agent_string):
+    fields = _user_agent_fields.get(user_agent_string)
+    if fields is None:
+        user_agent = parse(user_agent_string)
+        fields = _user_agent_fields[user_agent_string] = {
+            'browser': user_agent.browser.family,
+            'browser_version': user_agent.browser.version_string,
+            'os': user_agent.os.family,
+            'os_version': user_agent.os.version_string,
+            'device': user_agent.device.family
+        }
+    return fields
+
+
+class SessionBuilder:
+    # Appends the events of one session, keeping a running clock (ms since the epoch)
+    def __init__(self, rng, start, viewport):
+        self.rng = rng
+        self.time = start
+        self.width, self.height = viewport
+        self.x, self.y = rng.uniform(0, self.width), rng.uniform(0, self.height)
+        self.scroll_top = 0
+        self.interactions = {
+            'mouseMovements': [], 'keyPresses': [], 'scrollEvents': [],
+            'formInteractions': [], 'touchEvents': [], 'mouseClicks': []
+        }
+
+    def wait(self, ms):
+        self.time += max(0, int(ms))
+
+    def mouse_path(self, x, y, step_ms=100, jitter=1.5, curvature=0.15, interval_noise=40):
+        # Minimum-jerk progress along an arc, sampled at the throttle interval of captcha.js
+        rng = self.rng
+        distance = math.hypot(x - self.x, y - self.y)
+        duration = 250 + 120 * math.log2(1 + distance / 20) + rng.uniform(-50, 150)
+        bend = rng.gauss(0, curvature) * distance
+        normal_x, normal_y = (-(y - self.y) / distance, (x - self.x) / distance) if distance else (0, 0)
+        start_x, start_y, start_time = self.x, self.y, self.time
+        elapsed = 0
+        while elapsed < duration:
+            elapsed += step_ms + rng.uniform(0, interval_noise)
+            tau = min(1.0, elapsed / duration)
+            progress = 10 * tau ** 3 - 15 * tau ** 4 + 6 * tau ** 5
+            arc = math.sin(math.pi * progress) * bend
+            self.x = start_x + (x - start_x) * progress + normal_x * arc + rng.gauss(0, jitter)
+            self.y = start_y + (y - start_y) * progress + normal_y * arc + rng.gauss(0, jitter)
+            self.time = start_time + int(elapsed)
+            self.interactions['mouseMovements'].append({'x': round(self.x), 'y': round(self.y), 'time': self.time})
+        self.x, self.y = x, y
+
+    def click(self, press_ms):
+        clicks = self.interactions['mouseClicks']
+        clicks.append({'type': 'down', 'x': round(self.x), 'y': round(self.y), 'time': self.time})
+        self.wait(press_ms)
+        clicks.append({'type': 'up', 'x': round(self.x), 'y': round(self.y), 'time': self.time})
+
+    def type_text(self, text, interval):
+        for key in text:
+            self.wait(interval())
+            self.interactions['keyPresses'].append({'key': key, 'time': self.time})
+
+    def scroll_burst(self, events, step, interval_ms):
+        max_scroll = self.height * 3
+        for _ in range(events):
+            self.wait(interval_ms + self.rng.uniform(0, interval_ms / 2))
+            self.scroll_top = min(max_scroll, max(0, self.scroll_top + step * self.rng.uniform(0.5, 1.5)))
+            self.interactions['scrollEvents'].append({'scrollTop': round(self.scroll_top), 'time': self.time})
+
+    def touch(self, x, y, moves, force, interval_ms=100):
+        touches = self.interactions['touchEvents']
+        rng = self.rng
+        touches.append({'type': 'start', 'x': round(self.x), 'y': round(self.y), 'time': self.time, 'force': force})
+        start_x, start_y = self.x, self.y
+        for i in range(1, moves + 1):
+            self.wait(interval_ms + rng.uniform(0, 30))
+            self.x = start_x + (x - start_x) * i / moves + rng.gauss(0, 2)
+            self.y = start_y + (y - start_y) * i / moves + rng.gauss(0, 2)
+            touches.append({'type': 'move', 'x': round(self.x), 'y': round(self.y), 'time': self.time,
+                            'force': round(min(1.0, max(0.0, force + rng.gauss(0, 0.05))), 3)})
+        self.wait(rng.uniform(60, 140) if moves == 0 else rng.uniform(10, 40))
+        touches.append({'type': 'end', 'x': round(self.x), 'y': round(self.y), 'time': self.time, 'force': 0})
+
+    def submit(self, fields):
+        # captcha.js records every field of the form at submit time
+        for field in fields:
+            self.interactions['formInteractions'].append({'field': field, 'time': self.time})
+
+
+def human_session(rng, start, mobile):
+    viewport = rng.choice(MOBILE_VIEWPORTS if mobile else DESKTOP_VIEWPORTS)
+    session = SessionBuilder(rng, start, viewport)
+    fields = rng.sample(FIELDS, rng.randint(1, 4))
+    session.wait(rng.uniform(400, 2500))  # Reading before the first interaction
+    for field in fields:
+        x, y = rng.uniform(0.1, 0.9) * session.width, rng.uniform(0.1, 0.9) * session.height
+        if mobile:
+            if rng.random() < 0.5:  # Swipe to scroll
+                session.touch(session.x + rng.gauss(0, 20), session.y - rng.uniform(100, 400), rng.randint(3, 8),
+                              round(rng.uniform(0.2, 0.8), 3))
+                session.scroll_top += rng.uniform(100, 600)
+                session.interactions['scrollEvents'].append({'scrollTop': round(session.scroll_top), 'time': session.time})
+                session.wait(rng.uniform(300, 1200))
+            session.x, session.y = x, y
+            session.touch(x, y, rng.choice([0, 0, 1]), round(rng.uniform(0.2, 0.8), 3))
+        else:
+            if rng.random() < 0.4:
+                session.scroll_burst(rng.randint(3, 12), rng.uniform(40, 120), 16)
+                session.wait(rng.uniform(200, 900))
+            session.mouse_path(x, y)
+            session.wait(rng.uniform(50, 300))
+            session.click(rng.lognormvariate(math.log(95), 0.3))
+        session.wait(rng.uniform(150, 600))
+        words = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 4)))
+        session.type_text(words, lambda: max(35, rng.gauss(170, 65)))
+        session.wait(rng.uniform(300, 1500))
+    # Submit
+    if mobile:
+        session.touch(session.x, session.y + rng.uniform(50, 200), 0, round(rng.uniform(0.2, 0.8), 3))
+    else:
+        session.mouse_path(rng.uniform(0.3, 0.7) * session.width, rng.uniform(0.7, 0.95) * session.height)
+        session.click(rng.lognormvariate(math.log(95), 0.3))
+    session.submit(fields)
+    return session, viewport
+
+
+def bot_session(rng, start):
+    kind = rng.choices(['empty', 'scripted', 'replay'], weights=[0.4, 0.4, 0.2])[0]
+    if kind == 'replay':
+        # A recorded human session played back several times faster
+        session, viewport = human_session(rng, start, mobile=False)
+        speed = rng.uniform(3, 8)
+        for events in session.interactions.values():
+            for event in events:
+                event['time'] = start + int((event['time'] - start) / speed)
+        session.time = start + int((session.time - start) / speed)
+        return session, viewport
+
+    viewport = rng.choice(DESKTOP_VIEWPORTS)
+    session = SessionBuilder(rng, start, viewport)
+    if kind == 'empty':
+        session.wait(rng.uniform(0, 300))
+        return session, viewport
+
+    fields = rng.sample(FIELDS, rng.randint(1, 4))
+    interval = rng.choice([0, 10, 50, 100])
+    session.wait(rng.uniform(0, 200))
+    for field in fields:
+        if rng.random() < 0.7:
+            x, y = rng.uniform(0.1, 0.9) * session.width, rng.uniform(0.1, 0.9) * session.height
+            session.mouse_path(x, y, step_ms=100, jitter=0, curvature=0, interval_noise=0)
+            session.click(rng.choice([0, 1]))
+        session.type_text(' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))), lambda: interval)
+    session.submit(fields)
+    return session, viewport
+
+
+def generate_session(seed, index, bot_share=0.5, sites=0):
+    # Returns the record store_data would have written for session `index`
+    rng = random.Random(seed * 1_000_000_007 + index)
+    timestamp = START + timedelta(milliseconds=index * SESSION_SPACING_MS + rng.randint(0, SESSION_SPACING_MS - 1))
+    start = int(timestamp.timestamp() * 1000) - rng.randint(5000, 120000)
+    if rng.random() < bot_share:
+        label = 0
+        session, viewport = bot_session(rng, start)
+        user_agent_string = rng.choice(BOT_USER_AGENTS if rng.random() < 0.5 else HUMAN_DESKTOP_USER_AGENTS)
+    else:
+        label = 1
+        mobile = rng.random() < 0.35
+        session, viewport = human_session(rng, start, mobile)
+        user_agent_string = rng.choice(HUMAN_MOBILE_USER_AGENTS if mobile else HUMAN_DESKTOP_USER_AGENTS)
+    duration = session.time - start + rng.randint(0, 500)
+
+    record = {
+        'session_id': str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+        'interaction_id': str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+        'timestamp': timestamp.isoformat(),
+        'interaction_data': session.interactions,
+        'duration': duration,
+        'label': label,
+        'user_agent': user_agent_fields(user_agent_string),
+        'viewport': {'width': viewport[0], 'height': viewport[1]},
+        'load_timestamp': start,
+        'feature_version': FEATURE_EXTRACTOR_VERSION
+    }
+    if sites:
+        record['site_id'] = f'site-{rng.randrange(sites)}'
+    return record
+
+
+def write_chunk(chunk, first, count, seed, bot_share, sites, out_dir, output_format):
+    # Runs in a worker: writes sessions [first, first + count) and returns their catalog rows (files format)
+    rows = []
+    if output_format == 'files':
+        for index in range(first, first + count):
+            record = generate_session(seed, index, bot_share, sites)
+            with open(os.path.join(out_dir, f'{record["interaction_id"]}.json'), 'w') as f:
+                json.dump(record, f)
+            rows.append((record['interaction_id'], record['timestamp'], record['label'],
+                         record['user_agent']['device'], record.get('site_id')))
+        return count, rows
+
+    file_path = os.path.join(out_dir, f'sessions-{chunk:05d}.{output_format}')
+    opener = gzip.open if output_format == 'jsonl.gz' else open
+    with opener(f'{file_path}.tmp', 'wt') as f:
+        for index in range(first, first + count):
+            f.write(json.dumps(generate_session(seed, index, bot_share, sites)))
+            f.write('\n')
+    os.replace(f'{file_path}.tmp', file_path)
+    return count, rows
+
+
+def generate(count, out_dir, output_format='files', seed=0, bot_share=0.5, sites=0, jobs=None,
+             chunk_size=CHUNK_SIZE, index_catalog=None):
+    # Returns the number of sessions written
+    # index_catalog: None indexes the files only when they are written to the data directory the catalog describes
+    from src import catalog
+    os.makedirs(out_dir, exist_ok=True)
+    if index_catalog is None:
+        index_catalog = os.path.realpath(out_dir) == os.path.realpath(catalog.DATA_DIR)
+    chunks = [(chunk, first, min(chunk_size, count - first)) for chunk, first in enumerate(range(0, count, chunk_size))]
+    written = 0
+    with ProcessPoolExecutor(max_workers=jobs or os.cpu_count() or 1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = [
+            executor.submit(write_chunk, chunk, first, chunk_count, seed, bot_share, sites, out_dir, output_format)
+            for chunk, first, chunk_count in chunks
+        ]
+        for future in futures:
+            chunk_written, rows = future.result()
+            if rows and index_catalog:
+                catalog.record_interactions(rows)
+            written += chunk_written
+            print(f'\r{written}/{count} sessions written', end='', flush=True)
+    print()
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate labelled synthetic interaction sessions')
+    parser.add_argument('--count', type=int, default=10000, help='sessions to generate')
+    parser.add_argument('--out', default='data', help='output directory')
+    parser.add_argument('--format', choices=FORMATS, default='files', dest='output_format')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--bot-share', type=float, default=0.5, help='share of bot sessions')
+    parser.add_argument('--sites', type=int, default=0, help='spread the sessions over this many site ids')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='worker processes')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='sessions per task (and per jsonl file)')
+    parser.add_argument('--no-catalog', action='store_true', help='do not index generated files in the dataset catalog')
+    parser.add_argument('--catalog', help='index generated files into this catalog instead (for an --out other than data/)')
+    args = parser.parse_args()
+    index_catalog = None
+    if args.no_catalog:
+        index_catalog = False
+    elif args.catalog:
+        from src import catalog
+        catalog.CATALOG_PATH = args.catalog
+        index_catalog = True
+    written = generate(args.count, args.out, args.output_format, args.seed, args.bot_share, args.sites, args.jobs,
+                       args.chunk_size, index_catalog)
+    print(f'Wrote {written} sessions to {args.out} ({args.output_format})')
+
+
+if __name__ == '__main__':
+    main()
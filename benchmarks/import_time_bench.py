@@ -0,0 +1,123 @@
+import sys
+import os
+import json
+import time
+import tempfile
+import subprocess
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(ROOT)
+
+##################
+# BENCHMARK
+# cold start of the web workers and the CLI tools: wall time from launching the interpreter
+# until the entry point is imported (median of --runs fresh processes), the heavy
+# dependencies each one ends up loading and, from `python -X importtime`, the imports that
+# cost the most. Runs in a scratch directory, so the workers start without a model unless
+# the scenario publishes one.
+# exits with status 1 when a cold start exceeds benchmarks/cold_start_targets.json or a
+# scenario loads a module it must not
+# to run this, run `python benchmarks/import_time_bench.py [--runs 5] [--top 10]` from the root of the repo
+##################
+
+TARGETS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cold_start_targets.json')
+HEAVY_MODULES = ['torch', 'sklearn', 'joblib', 'user_agents', 'jwt', 'cryptography', 'jsonschema', 'flask_cors']
+
+SCENARIOS = {
+    'web worker': 'import main',
+    'web worker (model bundle)': 'import main',
+    'asgi worker': 'import asgi',
+    'list_labels.py': f'import runpy; runpy.run_path({os.path.join(ROOT, "list_labels.py")!r})'
+}
+
+
+def publish_model(work_dir):
+    # A freshly initialized network in the bundle layout model/train.py writes, for the scenario serving a model
+    from model.model_definitions import NeuralNet
+    from src.device_encoder import DeviceEncoder
+    from src.extract_features import FEATURE_COUNT
+    from src.model_bundle import save_bundle
+    encoder = DeviceEncoder(['Other', 'iPhone'])
+    save_bundle(NeuralNet(FEATURE_COUNT + encoder.width), encoder, artifacts_dir=os.path.join(work_dir, 'model', 'artifacts'))
+
+
+def _environment(work_dir):
+    return dict(
+        os.environ, PYTHONPATH=ROOT, AUTH_TOKEN='bench-token', PUBLIC_AUTH_TOKEN='bench-token', ACCESS_LOG='',
+        TRAFFIC_CAPTURE='', SHARED_MODEL_DIR='', CATALOG_PATH=os.path.join(work_dir, 'data', 'catalog.sqlite3')
+    )
+
+
+def loaded_modules(code, work_dir):
+    # The HEAVY_MODULES imported by running `code` in a fresh interpreter
+    report = f'{code}\nimport sys, json\nprint(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))'
+    result = subprocess.run([sys.executable, '-c', report], cwd=work_dir, env=_environment(work_dir),
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def cold_start_ms(code, work_dir, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], cwd=work_dir, env=_environment(work_dir),
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append((time.perf_counter() - start) * 1000)
+    return sorted(times)[len(times) // 2]
+
+
+def import_breakdown(code, work_dir, top):
+    # (cumulative ms, self ms, module) of the imports done directly by the entry point and by those, slowest first
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=work_dir, env=_environment(work_dir),
+                            capture_output=True, text=True, check=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip(' '))) // 2
+        if depth <= 1:
+            rows.append((int(cumulative_us) / 1000, int(self_us) / 1000, name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def check(scenario, elapsed_ms, modules, targets):
+    limits = targets.get(scenario, {})
+    failures = []
+    target = limits.get('cold_start_ms')
+    if target is not None and elapsed_ms > target:
+        failures.append(f'{scenario}: cold start {elapsed_ms:.0f} ms exceeds {target} ms')
+    forbidden = sorted(set(modules) & set(limits.get('forbidden_modules', [])))
+    if forbidden:
+        failures.append(f'{scenario}: imports {", ".join(forbidden)}')
+    return failures
+
+
+def main():
+    runs = int(sys.argv[sys.argv.index('--runs') + 1]) if '--runs' in sys.argv else 5
+    top = int(sys.argv[sys.argv.index('--top') + 1]) if '--top' in sys.argv else 10
+    with open(TARGETS_FILE, 'r') as f:
+        targets = json.load(f)
+
+    failures = []
+    for scenario, code in SCENARIOS.items():
+        with tempfile.TemporaryDirectory() as work_dir:
+            os.makedirs(os.path.join(work_dir, 'data'))
+            if scenario == 'web worker (model bundle)':
+                publish_model(work_dir)
+            elapsed_ms = cold_start_ms(code, work_dir, runs)
+            modules = loaded_modules(code, work_dir)
+            target = targets.get(scenario, {}).get('cold_start_ms')
+            print(f'{scenario:<26} {elapsed_ms:7.0f} ms (target {target} ms)  heavy modules: {", ".join(modules) or "none"}')
+            for cumulative, own, name in import_breakdown(code, work_dir, top):
+                print(f'    {cumulative:8.1f} ms cumulative {own:7.1f} ms self  {name}')
+            failures += check(scenario, elapsed_ms, modules, targets)
+
+    for failure in failures:
+        print(f'FAIL {failure}')
+    if failures:
+        sys.exit(1)
+    print('Cold starts within targets.')
+
+
+if __name__ == '__main__':
+    main()
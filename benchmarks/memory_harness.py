@@ -0,0 +1,159 @@
+import sys
+import os
+import gc
+import json
+import random
+import tempfile
+import tracemalloc
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(ROOT)
+
+##################
+# MEMORY HARNESS
+# replays synthetic challenge payloads of increasing size through the request path under
+# tracemalloc and reports, per scenario and size:
+#   - peak bytes allocated while handling a request (above what was live before it)
+#   - bytes still allocated per request after the run (retained growth, i.e. leaks and unbounded caches)
+#   - the source lines holding the retained memory
+# and exits with status 1 when a number exceeds benchmarks/memory_thresholds.json
+# to run this, run `python benchmarks/memory_harness.py [--quick]` from the root of the repo
+##################
+
+THRESHOLDS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'memory_thresholds.json')
+SIZES = [10, 100, 1000]
+QUICK_SIZES = [10, 100]
+WARM_UP_REQUESTS = 20
+REQUESTS = 50
+QUICK_REQUESTS = 20
+TOP_SITES = 5
+
+# Keep admission control out of the way, make sure the public token is set and discard the access log before main is imported
+os.environ['RATE_LIMIT_IP_PER_SECOND'] = os.environ['RATE_LIMIT_IP_BURST'] = '1000000'
+os.environ['RATE_LIMIT_SESSION_PER_SECOND'] = os.environ['RATE_LIMIT_SESSION_BURST'] = '1000000'
+os.environ.setdefault('PUBLIC_AUTH_TOKEN', 'memory-harness')
+os.environ.setdefault('ACCESS_LOG', os.devnull)
+
+
+def make_payload(rng, size):
+    # size events in each stream
+    return {
+        'interactions': {
+            'mouseMovements': [{'x': rng.uniform(0, 1000), 'y': rng.uniform(0, 800), 'time': i * 16} for i in range(size)],
+            'keyPresses': [{'key': 'a', 'time': i * 120} for i in range(size)],
+            'scrollEvents': [{'scrollTop': rng.uniform(0, 5000), 'time': i * 30} for i in range(size)],
+            'formInteractions': [{'field': 'email', 'time': i * 900} for i in range(size)],
+            'touchEvents': [
+                {'x': rng.uniform(0, 400), 'y': rng.uniform(0, 800), 'force': rng.random(),
+                 'type': ['start', 'move', 'end'][i % 3], 'time': i * 20}
+                for i in range(size)
+            ],
+            'mouseClicks': [{'type': ['down', 'up'][i % 2], 'time': i * 80} for i in range(size)]
+        },
+        'duration': size * 16,
+        'viewport': {'width': 1280, 'height': 720},
+        'loadTimestamp': 1234567890
+    }
+
+
+def scenarios():
+    from main import app, PUBLIC_AUTH_TOKEN
+    from src.extract_features import extract_feature_vector, UserInteractionData
+    client = app.test_client()
+    headers = {
+        'Authorization': f'Bearer {PUBLIC_AUTH_TOKEN}',
+        'User-Agent': 'Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) AppleWebKit/605.1.15 Mobile/15E148'
+    }
+
+    def extract(payload):
+        interactions = payload['interactions']
+        extract_feature_vector(UserInteractionData(
+            interactions['mouseMovements'], interactions['keyPresses'], interactions['scrollEvents'],
+            interactions['formInteractions'], interactions['touchEvents'], interactions['mouseClicks'],
+            payload['duration']
+        ))
+
+    def challenge(payload):
+        rv = client.post('/api/challenge', json={'data': payload}, headers=headers)
+        assert rv.status_code == 200, rv.get_json()
+
+    def challenge_save(payload):
+        rv = client.post('/api/challenge', json={'data': payload, 'save': True}, headers=headers)
+        assert rv.status_code == 200, rv.get_json()
+
+    return {'extract_features': extract, 'challenge': challenge, 'challenge_save': challenge_save}
+
+
+def measure(handle, payload, requests=REQUESTS):
+    for _ in range(WARM_UP_REQUESTS):
+        handle(payload)
+    gc.collect()
+    before = tracemalloc.take_snapshot()
+    baseline = tracemalloc.get_traced_memory()[0]
+    peak = 0
+    for _ in range(requests):
+        tracemalloc.reset_peak()
+        start = tracemalloc.get_traced_memory()[0]
+        handle(payload)
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - start)
+    gc.collect()
+    retained = (tracemalloc.get_traced_memory()[0] - baseline) / requests
+    after = tracemalloc.take_snapshot()
+    # Leave out the tracing and the harness itself
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+    top_sites = after.filter_traces(filters).compare_to(before.filter_traces(filters), 'lineno')[:TOP_SITES]
+    return peak, retained, top_sites
+
+
+def check(scenario, size, peak, retained, thresholds):
+    limits = thresholds.get(scenario, {})
+    failures = []
+    peak_limit = limits.get('peak_bytes', {}).get(str(size))
+    if peak_limit is not None and peak > peak_limit:
+        failures.append(f'{scenario} ({size} events/stream): peak {peak} bytes/request exceeds {peak_limit}')
+    retained_limit = limits.get('retained_bytes_per_request')
+    if retained_limit is not None and retained > retained_limit:
+        failures.append(f'{scenario} ({size} events/stream): retained {retained:.0f} bytes/request exceeds {retained_limit}')
+    return failures
+
+
+def main():
+    quick = '--quick' in sys.argv
+    sizes = QUICK_SIZES if quick else SIZES
+    requests = QUICK_REQUESTS if quick else REQUESTS
+    with open(THRESHOLDS_FILE, 'r') as f:
+        thresholds = json.load(f)
+
+    # main.py loads keys and the model relative to the repo; saved interactions go to a scratch directory
+    os.chdir(ROOT)
+    handlers = scenarios()
+    scratch = tempfile.TemporaryDirectory()
+    os.chdir(scratch.name)
+    os.makedirs('data')
+
+    rng = random.Random(0)
+    failures = []
+    tracemalloc.start()
+    try:
+        for size in sizes:
+            payload = make_payload(rng, size)
+            for scenario, handle in handlers.items():
+                peak, retained, top_sites = measure(handle, payload, requests)
+                print(f'{scenario:<17} {size:>5} events/stream  peak {peak / 1024:9.1f} KiB/request  retained {retained:8.1f} B/request')
+                for stat in top_sites:
+                    if stat.size_diff > 0:
+                        print(f'    {stat.size_diff:>+9} B  {stat.traceback[0].filename}:{stat.traceback[0].lineno}')
+                failures += check(scenario, size, peak, retained, thresholds)
+    finally:
+        tracemalloc.stop()
+        os.chdir(ROOT)
+        scratch.cleanup()
+
+    for failure in failures:
+        print(f'FAIL {failure}')
+    if failures:
+        sys.exit(1)
+    print('Memory use within thresholds.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+import sys
+import os
+import time
+import random
+import threading
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from memory_harness import make_payload
+from model.model_definitions import NeuralNet
+from src.device_encoder import DeviceEncoder
+from src.extract_features import FEATURE_COUNT
+from src.handlers.challenge import score_interaction
+from src.profiler import SamplingProfiler
+
+##################
+# BENCHMARK
+# cost of /api/admin/profile for live traffic: challenges scored per second by a few request
+# threads without the profiler and while it samples them at several intervals, with the
+# overhead the profiler measured itself. Configurations alternate over a few rounds and the
+# medians are reported, since throughput drifts over a run
+# to run this, run `python benchmarks/profiler_bench.py [seconds] [threads] [rounds]` from the root of the repo
+##################
+
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+INTERVALS_MS = [5, 10, 50]
+
+
+def throughput(seconds, threads, model, encoder, payload, profile=None):
+    # Challenges per second over `seconds`, while profile() (if given) runs on this thread
+    stop = threading.Event()
+    counts = [0] * threads
+
+    def work(index):
+        while not stop.is_set():
+            score_interaction(payload, USER_AGENT, model, encoder)
+            counts[index] += 1
+
+    workers = [threading.Thread(target=work, args=(index,)) for index in range(threads)]
+    for worker in workers:
+        worker.start()
+    start = time.perf_counter()
+    result = profile(seconds) if profile is not None else time.sleep(seconds)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    for worker in workers:
+        worker.join()
+    return sum(counts) / elapsed, result
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 3
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    rounds = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+    encoder = DeviceEncoder(['Other'])
+    model = NeuralNet(FEATURE_COUNT + encoder.width).eval()
+    payload = make_payload(random.Random(0), 100)
+    profiler = SamplingProfiler(max_seconds=seconds)
+
+    rates = {None: []}
+    results = {}
+    for _ in range(rounds):
+        rates[None].append(throughput(seconds, threads, model, encoder, payload)[0])
+        for interval_ms in INTERVALS_MS:
+            rate, results[interval_ms] = throughput(seconds, threads, model, encoder, payload,
+                                                    lambda s: profiler.profile(s, interval_ms / 1000))
+            rates.setdefault(interval_ms, []).append(rate)
+    median = {key: sorted(values)[len(values) // 2] for key, values in rates.items()}
+
+    print(f'no profiler            {median[None]:8.0f} challenges/s')
+    for interval_ms in INTERVALS_MS:
+        result = results[interval_ms]
+        print(f'profiling every {interval_ms:>3} ms {median[interval_ms]:8.0f} challenges/s '
+              f'({(1 - median[interval_ms] / median[None]) * 100:+5.1f}% slower)  {result["samples"]} samples, '
+              f'{len(result["stacks"])} stacks, measured overhead {result["overhead"] * 100:.2f}%, '
+              f'final interval {result["interval_ms"]:g} ms')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+import sys
+import os
+import json
+import time
+import asyncio
+import argparse
+from urllib.parse import urlsplit
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.tenants import parse_site_keys
+from src.traffic_capture import token_score
+
+##################
+# BENCHMARK
+# replays traffic recorded with TRAFFIC_CAPTURE (src/traffic_capture.py) against one or two
+# running builds and compares their latency distributions and scores, with each other and
+# with the scores recorded in production.
+#
+# Requests are sent in the recorded order: at the recorded pace (--speed 1), accelerated
+# (--speed 10) or as fast as --concurrency allows (--speed 0). The requests of one session
+# are always sent one after the other, with the recorded session pseudonym as session_id
+# cookie, so streamed events reach the session before its challenge. Targets are replayed one
+# after the other so they do not compete for the CPU. Captured requests asking to save the
+# interaction are replayed without `save` unless --save is given.
+#
+# The targets see every request coming from this machine: start them with raised rate limits
+# (RATE_LIMIT_IP_PER_SECOND, RATE_LIMIT_IP_BURST, MAX_CONCURRENT_CHALLENGES).
+#
+# to run this, run `python benchmarks/replay_traffic.py captures/traffic.jsonl.1 captures/traffic.jsonl
+#   --target http://127.0.0.1:5000 [--target http://127.0.0.1:5001] [--speed 0]` from the root of the repo
+##################
+
+DECISION_THRESHOLD = 0.5
+
+
+def load_capture(paths):
+    # Records of all files in arrival order (rotated files can be given in any order)
+    records = []
+    for path in paths:
+        with open(path, 'r') as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    records = [record for record in records if record.get('body') is not None]
+    records.sort(key=lambda record: record['time'])
+    return records
+
+
+def build_request(host, record, token, keep_save=False):
+    body = dict(record['body'])
+    if not keep_save and record['path'] == '/api/challenge':
+        body.pop('save', None)
+    body = json.dumps(body).encode('utf-8')
+    headers = [
+        f'POST {record["path"]} HTTP/1.1', f'Host: {host}', f'Authorization: Bearer {token}',
+        'Content-Type: application/json', f'Content-Length: {len(body)}', 'Connection: close'
+    ]
+    if record.get('user_agent'):
+        headers.append(f'User-Agent: {record["user_agent"]}')
+    if record.get('session'):
+        headers.append(f'Cookie: session_id={record["session"]}')
+    return ('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1') + body
+
+
+async def send_one(host, port, payload):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(payload)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, body = response.partition(b'\r\n\r\n')
+    return int(head.split(b' ', 2)[1]), body
+
+
+async def replay(records, target, tokens, speed, concurrency, keep_save):
+    # One result per record: (status, latency in seconds, score, seconds sent behind schedule)
+    url = urlsplit(target)
+    host, port = url.hostname, url.port or 80
+    results = [None] * len(records)
+    semaphore = asyncio.Semaphore(concurrency)
+    sessions = {}
+    for index, record in enumerate(records):
+        sessions.setdefault(record.get('session') or f'request-{index}', []).append(index)
+    first_arrival = records[0]['time'] if records else 0
+
+    async def replay_session(indexes):
+        for index in indexes:
+            record = records[index]
+            token = tokens.get(record.get('site_id'), tokens[None])
+            payload = build_request(f'{host}:{port}', record, token, keep_save)
+            lag = 0.0
+            if speed:
+                due = start + (record['time'] - first_arrival) / speed
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                lag = max(0.0, time.perf_counter() - due)
+            async with semaphore:
+                sent_at = time.perf_counter()
+                try:
+                    status, body = await send_one(host, port, payload)
+                except OSError:
+                    status, body = None, b''
+                latency = time.perf_counter() - sent_at
+            score = token_score(body) if record['path'] == '/api/challenge' and status == 200 else None
+            results[index] = (status, latency, score, lag)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(replay_session(indexes) for indexes in sessions.values()))
+    return time.perf_counter() - start, results
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))] if values else float('nan')
+
+
+def summarize(name, elapsed, results):
+    statuses = {}
+    for status, _, _, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    latencies = [latency * 1000 for status, latency, _, _ in results if status == 200]
+    lags = [lag * 1000 for _, _, _, lag in results]
+    print(f'{name}: {len(results)} requests in {elapsed:.1f}s ({len(results) / elapsed:.0f} req/s), '
+          f'statuses {dict(sorted(statuses.items(), key=lambda item: str(item[0])))}')
+    print(f'  latency p50 {percentile(latencies, 0.5):7.1f} ms  p90 {percentile(latencies, 0.9):7.1f} ms  '
+          f'p99 {percentile(latencies, 0.99):7.1f} ms  max {max(latencies, default=float("nan")):7.1f} ms  '
+          f'behind schedule p99 {percentile(lags, 0.99):.1f} ms')
+    return {
+        'elapsed': elapsed, 'statuses': {str(status): count for status, count in statuses.items()},
+        'latency_ms': {'p50': percentile(latencies, 0.5), 'p90': percentile(latencies, 0.9),
+                       'p99': percentile(latencies, 0.99), 'max': max(latencies, default=None)}
+    }
+
+
+def compare_scores(name, baseline, scores):
+    # Scores of the challenges both sides answered
+    pairs = [(a, b) for a, b in zip(baseline, scores) if a is not None and b is not None]
+    if not pairs:
+        print(f'  {name}: no challenge scored by both')
+        return None
+    differences = [abs(a - b) for a, b in pairs]
+    flipped = sum(1 for a, b in pairs if (a > DECISION_THRESHOLD) != (b > DECISION_THRESHOLD))
+    print(f'  {name}: {len(pairs)} challenges, mean |diff| {sum(differences) / len(pairs):.4f}, '
+          f'max |diff| {max(differences):.4f}, decisions flipped {flipped} ({flipped / len(pairs) * 100:.2f}%)')
+    return {'challenges': len(pairs), 'mean_abs_diff': sum(differences) / len(pairs),
+            'max_abs_diff': max(differences), 'flipped': flipped}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay captured challenge traffic against one or two builds')
+    parser.add_argument('captures', nargs='+', help='capture files (TRAFFIC_CAPTURE and its rotated files)')
+    parser.add_argument('--target', action='append', required=True, help='base URL of a running build, at most two')
+    parser.add_argument('--speed', type=float, default=1.0, help='1 for the recorded pace, 10 for ten times faster, 0 for max speed')
+    parser.add_argument('--concurrency', type=int, default=64, help='requests in flight at most')
+    parser.add_argument('--token', default=os.getenv('PUBLIC_AUTH_TOKEN'), help='public key for requests without a site')
+    parser.add_argument('--site-keys', default=os.getenv('SITE_KEYS'), help='site_id=public_key,... of the targets')
+    parser.add_argument('--save', action='store_true', help='keep `save` in replayed challenges')
+    parser.add_argument('--output', help='write the summary to this JSON file')
+    args = parser.parse_args()
+    if len(args.target) > 2:
+        sys.exit('At most two targets can be compared')
+    if not args.token:
+        sys.exit('Set --token or PUBLIC_AUTH_TOKEN')
+
+    records = load_capture(args.captures)
+    tokens = {site_id: key for key, site_id in parse_site_keys(args.site_keys).items()}
+    tokens[None] = args.token
+    print(f'Replaying {len(records)} requests at {"max speed" if not args.speed else f"{args.speed}x"}')
+
+    summary = {'requests': len(records), 'speed': args.speed, 'targets': {}, 'scores': {}}
+    recorded = [record.get('score') for record in records]
+    all_scores = []
+    for target in args.target:
+        elapsed, results = asyncio.run(replay(records, target, tokens, args.speed, args.concurrency, args.save))
+        summary['targets'][target] = summarize(target, elapsed, results)
+        all_scores.append([score for _, _, score, _ in results])
+
+    print('Scores:')
+    for target, scores in zip(args.target, all_scores):
+        summary['scores'][f'recorded vs {target}'] = compare_scores(f'recorded vs {target}', recorded, scores)
+    if len(all_scores) == 2:
+        name = f'{args.target[0]} vs {args.target[1]}'
+        summary['scores'][name] = compare_scores(name, *all_scores)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
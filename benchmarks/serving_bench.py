@@ -0,0 +1,113 @@
+import sys
+import os
+import json
+import time
+import shutil
+import asyncio
+import tempfile
+import subprocess
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+##################
+# BENCHMARK
+# compares requests/s and tail latency of /api/challenge on the Flask server (main.py)
+# and the asyncio server (asgi.py) at high concurrency
+# to run this, run `python benchmarks/serving_bench.py [requests] [concurrency]` from the root of the repo
+##################
+
+AUTH_TOKEN = 'bench-token'
+FLASK_PORT = 5101
+ASGI_PORT = 5102
+
+SERVERS = {
+    'flask (threaded)': [sys.executable, '-c', f'from main import app; app.run(port={FLASK_PORT}, threaded=True)'],
+    'asgi (uvicorn)': [sys.executable, '-m', 'uvicorn', 'asgi:app', '--port', str(ASGI_PORT), '--log-level', 'warning']
+}
+PORTS = {'flask (threaded)': FLASK_PORT, 'asgi (uvicorn)': ASGI_PORT}
+
+
+def challenge_request(port):
+    body = json.dumps({
+        'data': {
+            'interactions': {
+                'mouseMovements': [{'x': i, 'y': i * 2, 'time': i * 16} for i in range(200)],
+                'keyPresses': [{'key': 'a', 'time': i * 120} for i in range(30)]
+            },
+            'duration': 5000,
+            'viewport': {'width': 1280, 'height': 720},
+            'loadTimestamp': 1234567890
+        },
+        'save': True
+    }).encode('utf-8')
+    return (
+        f'POST /api/challenge HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\nAuthorization: Bearer {AUTH_TOKEN}\r\n'
+        f'User-Agent: Mozilla/5.0 (X11; Linux x86_64)\r\nContent-Type: application/json\r\n'
+        f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'
+    ).encode('latin-1') + body
+
+
+async def send_one(port, payload, latencies, statuses):
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(payload)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    latencies.append(time.perf_counter() - start)
+    statuses.append(response.split(b' ', 2)[1])
+
+
+async def run_load(port, requests, concurrency):
+    payload = challenge_request(port)
+    latencies, statuses = [], []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded():
+        async with semaphore:
+            await send_one(port, payload, latencies, statuses)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(bounded() for _ in range(requests)))
+    return time.perf_counter() - start, sorted(latencies), statuses
+
+
+async def wait_for_port(port, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f'Server on port {port} did not start')
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    # The servers run in a scratch directory so saved interactions do not end up in data/
+    repo_root = os.getcwd()
+    work_dir = tempfile.mkdtemp()
+    os.makedirs(os.path.join(work_dir, 'data'))
+    env = dict(os.environ, PYTHONPATH=repo_root, PUBLIC_AUTH_TOKEN=AUTH_TOKEN, AUTH_TOKEN=AUTH_TOKEN, FLASK_ENV='production',
+               RATE_LIMIT_IP_BURST='1e12', RATE_LIMIT_IP_PER_SECOND='1e12',
+               MAX_CONCURRENT_CHALLENGES=str(concurrency * 2))
+    for name, command in SERVERS.items():
+        server = subprocess.Popen(command, env=env, cwd=work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            asyncio.run(wait_for_port(PORTS[name]))
+            asyncio.run(run_load(PORTS[name], 50, 10))  # warm up
+            elapsed, latencies, statuses = asyncio.run(run_load(PORTS[name], requests, concurrency))
+        finally:
+            server.terminate()
+            server.wait()
+        errors = sum(1 for status in statuses if status != b'200')
+        p50 = latencies[len(latencies) // 2] * 1000
+        p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+        print(f'{name:18} {requests / elapsed:8.0f} req/s  p50 {p50:7.1f} ms  p99 {p99:7.1f} ms  errors {errors}')
+    shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
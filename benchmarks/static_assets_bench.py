@@ -0,0 +1,66 @@
+import sys
+import os
+import time
+from flask import Flask, send_from_directory
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.static_assets import StaticAssetCache
+from src.handlers.serve import serve_file
+
+##################
+# BENCHMARK
+# compares requests/s for captcha.js served with send_from_directory (read from disk on every
+# request) and from the in-memory asset cache: a full download, a gzip download and a
+# conditional request answered with 304
+# to run this, run `python benchmarks/static_assets_bench.py [requests]` from the root of the repo
+##################
+
+
+def bench_app():
+    # Both ways of serving on one bare app, so only the handlers differ
+    app = Flask(__name__)
+    static_assets = StaticAssetCache('html')
+
+    @app.route('/disk/<path:path>', methods=['GET'])
+    def disk_route(path):
+        return send_from_directory(os.path.abspath('html'), path)
+
+    @app.route('/cache/<path:path>', methods=['GET'])
+    def cache_route(path):
+        return serve_file(static_assets, path)
+
+    return app
+
+
+def requests_per_second(client, url, requests, headers=None, expected_status=200):
+    start = time.perf_counter()
+    for _ in range(requests):
+        rv = client.get(url, headers=headers)
+        assert rv.status_code == expected_status, rv.status_code
+        rv.close()
+    return requests / (time.perf_counter() - start)
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    client = bench_app().test_client()
+    disk, cache = '/disk/captcha.js', '/cache/captcha.js'
+
+    disk_etag = client.get(disk).headers['ETag']
+    cache_etag = client.get(cache, headers={'Accept-Encoding': 'gzip'}).headers['ETag']
+    results = [
+        ('send_from_directory', requests_per_second(client, disk, requests)),
+        ('send_from_directory 304', requests_per_second(client, disk, requests, {'If-None-Match': disk_etag}, 304)),
+        ('cache', requests_per_second(client, cache, requests)),
+        ('cache gzip', requests_per_second(client, cache, requests, {'Accept-Encoding': 'gzip'})),
+        ('cache 304', requests_per_second(client, cache, requests, {'Accept-Encoding': 'gzip', 'If-None-Match': cache_etag}, 304))
+    ]
+    for name, rate in results:
+        print(f'{name:<25} {rate:10.0f} requests/s')
+
+    size = len(client.get(cache).data)
+    gzip_size = len(client.get(cache, headers={'Accept-Encoding': 'gzip'}).data)
+    print(f'captcha.js: {size} bytes, {gzip_size} bytes gzipped')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import sys
+import os
+import json
+import time
+import uuid
+import shutil
+import tempfile
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+##################
+# BENCHMARK
+# compares labels/s of /api/update (one interaction per call) and /api/update/batch
+# to run this, run `python benchmarks/update_labels_bench.py [interactions] [batch_size]` from the root of the repo
+##################
+
+AUTH_TOKEN = 'bench-token'
+
+
+def create_interactions(count):
+    interaction_ids = []
+    for _ in range(count):
+        interaction_id = str(uuid.uuid4())
+        with open(f'data/{interaction_id}.json', 'w') as f:
+            json.dump({
+                'interaction_id': interaction_id,
+                'interaction_data': {'mouseMovements': [{'x': i, 'y': i, 'time': i * 100} for i in range(50)]},
+                'duration': 5000,
+                'user_agent': {'device': 'Other'}
+            }, f)
+        interaction_ids.append(interaction_id)
+    return interaction_ids
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    repo_root = os.getcwd()
+    work_dir = tempfile.mkdtemp()
+    os.chdir(work_dir)
+    os.makedirs('data')
+    try:
+        os.environ['AUTH_TOKEN'] = AUTH_TOKEN
+        sys.path.insert(0, repo_root)
+        from main import app
+        client = app.test_client()
+        headers = {'Authorization': f'Bearer {AUTH_TOKEN}'}
+
+        interaction_ids = create_interactions(count)
+        start = time.perf_counter()
+        for interaction_id in interaction_ids:
+            client.post('/api/update', json={'interaction_id': interaction_id, 'label': 1}, headers=headers)
+        single_elapsed = time.perf_counter() - start
+
+        interaction_ids = create_interactions(count)
+        start = time.perf_counter()
+        for i in range(0, count, batch_size):
+            updates = [{'interaction_id': interaction_id, 'label': 1} for interaction_id in interaction_ids[i:i + batch_size]]
+            client.post('/api/update/batch', json={'updates': updates}, headers=headers)
+        batch_elapsed = time.perf_counter() - start
+
+        print(f'/api/update:       {count / single_elapsed:10.0f} labels/s')
+        print(f'/api/update/batch: {count / batch_elapsed:10.0f} labels/s (batch size {batch_size})')
+        print(f'speedup:           {single_elapsed / batch_elapsed:10.1f}x')
+    finally:
+        os.chdir(repo_root)
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -13,10 +13,84 @@ export class AICaptcha {
       mouseClicks: []
     };
     this.loadTimestamp = Date.now();
+    // Streamed chunks are kept per page on the server, under an id that is new for every challenge
+    this.streamId = this.newStreamId();
+    // Chunks not delivered yet, each with its sequence number within the stream
+    this.pendingChunks = [];
+    this.nextSeq = 0;
+    // Delivered chunks, resent as one event log if the challenge reaches a worker that missed some
+    this.deliveredChunks = [];
     this.captureInteractions();
     if (config.autoIntercept) {
       this.interceptFormSubmissions();
     }
+    // Optionally upload events every streamInterval ms so the final challenge only carries the rest
+    this.streaming = Promise.resolve();
+    if (config.streamInterval) {
+      setInterval(() => this.streamEvents(), config.streamInterval);
+    }
+  }
+
+  newStreamId() {
+    if (window.crypto && crypto.randomUUID) {
+      return crypto.randomUUID();
+    }
+    return Date.now().toString(36) + Math.random().toString(36).slice(2);
+  }
+
+  takeInteractionData() {
+    const interactions = this.interactionData;
+    this.interactionData = {
+      mouseMovements: [],
+      keyPresses: [],
+      scrollEvents: [],
+      formInteractions: [],
+      touchEvents: [],
+      mouseClicks: []
+    };
+    return interactions;
+  }
+
+  streamEvents() {
+    // Chunks are sent one at a time so the server folds them in order
+    this.streaming = this.streaming.then(async () => {
+      const interactions = this.takeInteractionData();
+      if (Object.values(interactions).some((events) => events.length > 0)) {
+        this.pendingChunks.push({ seq: this.nextSeq++, interactions });
+      }
+      let resent = false;
+      while (this.pendingChunks.length > 0) {
+        const chunk = this.pendingChunks[0];
+        try {
+          const response = await fetch('/api/challenge/events', {
+            method: 'POST',
+            headers: {
+              'Content-Type': 'application/json',
+              'Authorization': `Bearer ${this.config.publicKey}`
+            },
+            body: JSON.stringify({ streamId: this.streamId, seq: chunk.seq, interactions: chunk.interactions }),
+          });
+          if (response.status === 409 && !resent) {
+            // The server is missing earlier chunks (it expired the session or another worker got them): resend from there,
+            // once per interval so workers that each miss other chunks do not keep the loop going
+            const { expectedSeq } = await response.json();
+            const resend = this.deliveredChunks.filter((delivered) => delivered.seq >= expectedSeq);
+            this.deliveredChunks = this.deliveredChunks.filter((delivered) => delivered.seq < expectedSeq);
+            this.pendingChunks = resend.concat(this.pendingChunks);
+            resent = true;
+            continue;
+          }
+          if (!response.ok) {
+            throw new Error(`events upload failed with ${response.status}`);
+          }
+        } catch (error) {
+          // Retried unchanged with the next interval: if the server folded it before failing, it drops the copy
+          return;
+        }
+        this.deliveredChunks.push(this.pendingChunks.shift());
+      }
+    });
+    return this.streaming;
   }
 
   throttle(func, limit) {
@@ -134,8 +208,10 @@ export class AICaptcha {
   }
 
   async sendDataToServer() {
+    // Wait for any chunk still being uploaded, the challenge completes the streamed session
+    await this.streaming;
     const data = {
-      interactions: this.interactionData,
+      interactions: this.config.streamInterval ? this.takeInteractionData() : this.interactionData,
       duration: Date.now() - this.loadTimestamp,
       userAgent: navigator.userAgent,
       viewport: {
@@ -144,18 +220,39 @@ export class AICaptcha {
       },
       loadTimestamp: this.loadTimestamp,
     };
-    const response = await fetch('/api/challenge', {
+    // Chunks that could not be delivered go with the challenge (at most 64, the server's limit)
+    const streamed = this.config.streamInterval && this.pendingChunks.length <= 64;
+    const chunks = this.deliveredChunks.concat(this.pendingChunks);
+    const body = streamed ? { data, streamId: this.streamId, streamedChunks: this.nextSeq, chunks: this.pendingChunks } : null;
+    // The challenge consumes the stream; events recorded afterwards start a new one
+    this.streamId = this.newStreamId();
+    this.pendingChunks = [];
+    this.deliveredChunks = [];
+    this.nextSeq = 0;
+    let response = body ? await this.postChallenge(body) : null;
+    if (!body || response.status === 409) {
+      // Without streaming, or when part of the stream went to another server worker or expired, send the full event log
+      const interactions = {};
+      for (const key of Object.keys(data.interactions)) {
+        interactions[key] = chunks.flatMap((chunk) => chunk.interactions[key]).concat(data.interactions[key]);
+      }
+      response = await this.postChallenge({ data: { ...data, interactions } });
+    }
+
+    const result = await response.json();
+    console.log('captcha response:', result);
+    return result.token;
+  }
+
+  postChallenge(body) {
+    return fetch('/api/challenge', {
       method: 'POST',
       headers: {
         'Content-Type': 'application/json',
         'Authorization': `Bearer ${this.config.publicKey}`
       },
-      body: JSON.stringify({ data }),
+      body: JSON.stringify(body),
     });
-
-    const result = await response.json();
-    console.log('captcha response:', result);
-    return result.token;
   }
 
   interceptFormSubmissions() {
@@ -188,6 +285,10 @@ export class AICaptcha {
       mouseClicks: []
     };
     this.loadTimestamp = Date.now();
+    this.streamId = this.newStreamId();
+    this.pendingChunks = [];
+    this.deliveredChunks = [];
+    this.nextSeq = 0;
   }
 }
 
@@ -1,25 +1,21 @@
-import os
-import json
+import sys
+from src import catalog
 
-# Directory containing the data files
-DATA_DIR = './data'
-
-# Dictionary to store label counts
-label_counts = {}
-
-# Iterate through the files in the data directory
-for filename in os.listdir(DATA_DIR):
-    if filename.endswith('.json'):
-        file_path = os.path.join(DATA_DIR, filename)
-        with open(file_path, 'r') as f:
-            data = json.load(f)
-            label = data.get('label')
-            if label is not None:
-                if label in label_counts:
-                    label_counts[label] += 1
-                else:
-                    label_counts[label] = 1
+# The label counts come from the dataset catalog instead of parsing every file in data/.
+# Files stored before the catalog existed are indexed on the first run; --rebuild reindexes all of them.
+if '--rebuild' in sys.argv:
+    print(f'Indexed {catalog.rebuild()} interactions.')
+else:
+    indexed = catalog.index_legacy()
+    if indexed:
+        print(f'Indexed {indexed} interactions.')
 
 # Print the label counts
+label_counts = catalog.label_counts()
 for label, count in label_counts.items():
     print(f'Label: {label}, Count: {count}')
+
+# Print the class balance and how much new data the next training run will see
+for label, share in catalog.class_balance().items():
+    print(f'Label: {label}, Share: {share * 100:.1f}%')
+print(f'Labelled since last training run: {catalog.labelled_since_last_train()}')
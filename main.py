@@ -1,30 +1,29 @@
-from flask import Flask, request, jsonify, send_from_directory, make_response
+from flask import Flask, request, jsonify, send_from_directory, make_response, g
+from werkzeug.middleware.proxy_fix import ProxyFix
 from flask_expects_json import expects_json
 import os
-import base64
-import json
-from src.extract_features import extract_features, UserInteractionData
-from datetime import datetime
-import uuid
-from user_agents import parse
-import torch
-import joblib
-import jwt
-from cryptography.hazmat.primitives import serialization
+import time
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.backends import default_backend
-from model.model_definitions import NeuralNet
-from datetime import datetime, timezone
 from dotenv import load_dotenv
 import logging
-from jsonschema import validate, ValidationError
 from flask_cors import cross_origin
-from src.validation_schemas import store_schema, update_schema, interaction_payload_schema
-from src.handlers.serve import serve_index, serve_file, get_public_key
-from src.handlers.challenge import captcha_challenge
+from src.validation_schemas import store_schema, update_schema, update_batch_schema, interaction_payload_schema, interaction_chunk_schema
+from src.handlers.serve import serve_index, serve_file, get_public_key, get_asset_manifest
+from src.handlers.challenge import captcha_challenge, captcha_challenge_events
 from src.handlers.store import store_data
-from src.handlers.update import update_label
+from src.handlers.update import update_label, update_labels_batch
+from src.handlers.profile import profile_worker
 from src.shared_variables import request_counter, counter_file, _train_and_reload
+import src.shared_variables as shared_variables
+from src.admission import AdmissionController
+from src.session_store import SessionStore
+from src.static_assets import StaticAssetCache
+from src.tenants import site_for_token, bearer_token
+from src.cascade import Cascade
+from src.access_log import AccessLog, StageTimer
+from src.traffic_capture import TrafficCapture
+from src.profiler import SamplingProfiler
 
 app = Flask(__name__)
 
@@ -35,50 +34,94 @@ load_dotenv()
 AUTH_TOKEN = os.getenv('AUTH_TOKEN')
 PUBLIC_AUTH_TOKEN = os.getenv('PUBLIC_AUTH_TOKEN')
 
-# Configure logging
-#logging.basicConfig(level=logging.INFO, format='%(asctime)s - %name)s - %levelname)s - %message)s', handlers=[logging.FileHandler('access.log'), logging.StreamHandler()])
+# Trust X-Forwarded-For from this many reverse proxies (e.g. 1 behind traefik) so rate limits see the client IP
+TRUSTED_PROXIES = int(os.getenv('TRUSTED_PROXIES', '0'))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
+
+# Rate limits and concurrency limit applied before any challenge work is done
+admission = AdmissionController.from_env()
+
+# Running feature aggregates of sessions streaming their events to /api/challenge/events
+session_store = SessionStore.from_env()
+
+# Rules and linear screen scoring obvious cases before the network (src/cascade.py)
+cascade = Cascade.from_env()
+
+# Access log records are formatted and written by a background thread (src/access_log.py)
+access_log = AccessLog.from_env()
+
+# Opt-in recording of challenge traffic for benchmarks/replay_traffic.py (src/traffic_capture.py)
+traffic_capture = TrafficCapture.from_env()
+
+# Sampling profiler behind /api/admin/profile (src/profiler.py)
+profiler = SamplingProfiler.from_env()
+
+# Middleware to start the request clock; handlers mark their stages on g.stages
+@app.before_request
+def start_request_timer():
+    g.started_at = time.perf_counter()
+    g.stages = StageTimer()
 
 # Middleware to log responses
 @app.after_request
 def log_response_info(response):
     try:
-        logging.info('%s - - [%s] "%s %s %s" %s "%s" "%s" %s %s',
-            request.remote_addr,
-            datetime.now().strftime('%d/%b/%Y:%H:%M:%S %z'),
-            request.method,
-            request.path,
-            request.scheme.upper(),
-            request.environ.get('SERVER_PROTOCOL'),
-            request.headers.get('Referer', '-'),
-            request.headers.get('User-Agent', '-'),
-            response.status_code,
-            request.content_length)
+        stages = g.get('stages')
+        access_log.record(
+            request.method, request.path, response.status_code, g.get('started_at', time.perf_counter()),
+            request.content_length, response.content_length, request.remote_addr,
+            request.headers.get('User-Agent'), request.headers.get('Referer'), stages.stages if stages is not None else None
+        )
     except Exception as e:
-        logging.error(f"Error logging response info")
+        logging.error(f"Error logging response info: {e}")
+    if traffic_capture.enabled:
+        try:
+            traffic_capture.record(
+                request.method, request.path, g.get('started_at', time.perf_counter()), request.get_data(),
+                request.headers.get('User-Agent'), request.cookies.get('session_id'),
+                site_for_token(bearer_token(request.headers.get('Authorization'))), response.status_code, response.get_data()
+            )
+        except Exception as e:
+            logging.error(f"Error capturing request: {e}")
     return response
 
 # Middleware to check for the static token in the Authorization header
 @app.before_request
 def check_authentication():
-    if request.endpoint in ['serve_index_route', 'serve_file_route', 'get_public_key_route', 'captcha_challenge_route']:
+    if request.endpoint in ['serve_index_route', 'serve_file_route', 'get_asset_manifest_route', 'get_public_key_route', 'captcha_challenge_route', 'captcha_challenge_events_route']:
         return  # Skip authentication for these endpoints
     auth_header = request.headers.get('Authorization')
     if not auth_header or auth_header.split()[1] != AUTH_TOKEN:
         return jsonify({'error': 'Unauthorized'}), 401
 
+# Middleware to shed abusive or excess challenge traffic before it costs any CPU
+@app.before_request
+def admit_request():
+    if request.endpoint not in ['captcha_challenge_route', 'captcha_challenge_events_route'] or request.method == 'OPTIONS':
+        return
+    rejection = admission.admit(request.remote_addr, request.cookies.get('session_id'))
+    g.stages.mark('admission')
+    if rejection is not None:
+        return reject_request(rejection)
+    g.admitted = True
+
+# Same CORS handling as the challenge routes, so browsers can read the 429 from another origin
+@cross_origin()
+def reject_request(reason):
+    response = jsonify({'error': 'Too many requests', 'reason': reason})
+    response.status_code = 429
+    response.headers['Retry-After'] = '1'
+    return response
+
+@app.teardown_request
+def release_admission(exception=None):
+    if g.pop('admitted', False):
+        admission.release()
+
 
 # Load the trained model and the one-hot encoder
-model_path = 'model/neural_net_model_weights.pth'
-encoder_path = 'model/onehot_encoder.pkl'
-if os.path.exists(model_path) and os.path.exists(encoder_path):
-    encoder = joblib.load(encoder_path)
-    model = NeuralNet()
-    model.load_state_dict(torch.load(model_path))
-    model.eval()
-else:
-    model = None
-    encoder = None
-    print("Model or encoder not found. Defaulting to dummy prediction.")
+shared_variables.load_model()
 
 # Load the private key for signing JWT
 # if the key is not found, let's creat them
@@ -107,13 +150,20 @@ else:
     request_counter = 0
 
 # Serve the static files from the html directory
+static_assets = StaticAssetCache('./html')
+
 @app.route('/', methods=['GET'])
 def serve_index_route():
-    return serve_index()
+    return serve_index(static_assets)
 
 @app.route('/<path:path>', methods=['GET'])
 def serve_file_route(path):
-    return serve_file(path)
+    return serve_file(static_assets, path)
+
+# Endpoint to look up the content-hashed (immutable) URLs of the static files
+@app.route('/api/assets', methods=['GET'])
+def get_asset_manifest_route():
+    return get_asset_manifest(static_assets)
 
 # Endpoint to serve the public key
 @app.route('/api/public_key', methods=['GET'])
@@ -124,7 +174,39 @@ def get_public_key_route():
 @app.route('/api/challenge', methods=['POST'])
 @cross_origin()
 def captcha_challenge_route():
-    return captcha_challenge(PUBLIC_AUTH_TOKEN, interaction_payload_schema, model, encoder, PRIVATE_KEY)
+    site_id = site_for_token(bearer_token(request.headers.get('Authorization')))
+    model, encoder, linear = shared_variables.current_model(site_id)
+    return captcha_challenge(
+        PUBLIC_AUTH_TOKEN, interaction_payload_schema, model, encoder, PRIVATE_KEY, session_store, site_id, linear, cascade
+    )
+
+# Endpoint to stream interaction events before the challenge
+@app.route('/api/challenge/events', methods=['POST'])
+@cross_origin()
+def captcha_challenge_events_route():
+    site_id = site_for_token(bearer_token(request.headers.get('Authorization')))
+    return captcha_challenge_events(PUBLIC_AUTH_TOKEN, interaction_chunk_schema, session_store, site_id)
+
+# Endpoint to read the admission control counters
+@app.route('/api/admin/admission', methods=['GET'])
+def admission_stats_route():
+    return jsonify(dict(admission.stats(), streaming_sessions=session_store.stats(), access_log=access_log.stats(),
+                        traffic_capture=traffic_capture.stats()))
+
+# Endpoint to read the per-site model cache counters
+@app.route('/api/admin/models', methods=['GET'])
+def model_cache_stats_route():
+    return jsonify(shared_variables.tenant_models.stats())
+
+# Endpoint to read how often each scoring cascade stage decides
+@app.route('/api/admin/cascade', methods=['GET'])
+def cascade_stats_route():
+    return jsonify(cascade.stats())
+
+# Endpoint to sample the stacks of this worker for a few seconds
+@app.route('/api/admin/profile', methods=['GET'])
+def profile_route():
+    return profile_worker(profiler)
 
 # Endpoint to store data
 # A label is required to store the data. You can use an existing tool (reCaptcha, altCaptcha, etc) to generate a label
@@ -139,16 +221,14 @@ def store_data_route():
 def update_label_route():
     return update_label(update_schema)
 
+# Endpoint to update the labels of many interactions in one call
+@app.route('/api/update/batch', methods=['POST'])
+@expects_json(update_batch_schema)
+def update_labels_batch_route():
+    return update_labels_batch(update_batch_schema)
 
 
-def _train_and_reload():
-    os.system('python3 model/train.py')
-    global model, encoder
-    model = torch.load(model_path)
-    encoder = joblib.load(encoder_path)
-    print("Model and encoder reloaded.")
 
-    
 if __name__ == '__main__':
     env = os.getenv('FLASK_ENV', 'development')
     debug_mode = env != 'production'
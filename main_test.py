@@ -4,6 +4,7 @@ import pytest
 from flask import Flask
 import base64
 import json
+import math
 import jwt
 
 sys.path.append(os.path.abspath("."))  # Add current directory
@@ -18,6 +19,15 @@ def client():
     with flask_app.test_client() as client:
         yield client
 
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    """Run the test from an empty directory, so stored interactions, the catalog and request_counter.txt stay out of the repo."""
+    from src import catalog
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('data')
+    monkeypatch.setattr(catalog, 'CATALOG_PATH', str(tmp_path / 'data' / 'catalog.sqlite3'))
+    return tmp_path / 'data'
+
 def test_public_key(client):
     """Test the public key endpoint."""
     headers = {'Authorization': f'Bearer {flask_app.config["AUTH_TOKEN"]}'}
@@ -158,3 +168,957 @@ def test_store_endpoint(client):
     assert os.path.exists(file_path)
     # Clean up the file after test
     os.remove(file_path)
+
+def test_model_bundle_round_trip(tmp_path):
+    """Test that a saved model bundle loads back with matching predictions."""
+    import torch
+    from model.model_definitions import NeuralNet
+    from src.model_bundle import save_bundle, load_bundle, latest_bundle_path
+    from src.extract_features import FEATURE_COUNT
+    from src.device_encoder import DeviceEncoder
+    encoder = DeviceEncoder(['Other', 'iPhone'])
+    model = NeuralNet(FEATURE_COUNT + encoder.width)
+    bundle_path = save_bundle(model, encoder, {'accuracy': 0.9}, artifacts_dir=str(tmp_path))
+    assert latest_bundle_path(str(tmp_path)) == bundle_path
+    bundle = load_bundle(bundle_path)
+    assert bundle.input_size == FEATURE_COUNT + 3
+    assert bundle.manifest['metrics']['accuracy'] == 0.9
+    assert bundle.encoder.encode('iPhone') == [0.0, 1.0, 0.0]
+    assert bundle.encoder.encode('Pixel 9') == [0.0, 0.0, 1.0]
+    sample = torch.rand(1, bundle.input_size)
+    with torch.no_grad():
+        assert torch.allclose(bundle.model(sample), model(sample))
+
+def test_model_bundle_integrity_check(tmp_path):
+    """Test that a tampered model bundle is rejected."""
+    from model.model_definitions import NeuralNet
+    from src.model_bundle import save_bundle, load_bundle, ModelBundleError
+    from src.extract_features import FEATURE_COUNT
+    from src.device_encoder import DeviceEncoder
+    bundle_path = save_bundle(NeuralNet(FEATURE_COUNT + 2), DeviceEncoder(['Other']), artifacts_dir=str(tmp_path))
+    with open(os.path.join(bundle_path, 'encoder.json'), 'w') as f:
+        json.dump({'categories': ['Other', 'iPhone'], 'unknown_bucket': True}, f)
+    with pytest.raises(ModelBundleError):
+        load_bundle(bundle_path)
+
+def test_shared_model_generations(tmp_path):
+    """Test that workers map published weights and switch to a newly published generation."""
+    import torch
+    from model.model_definitions import NeuralNet
+    from src.model_bundle import save_bundle
+    from src.shared_model import SharedModelReader, publish_bundle
+    from src.extract_features import FEATURE_COUNT
+    from src.device_encoder import DeviceEncoder
+    artifacts_dir = str(tmp_path / 'artifacts')
+    shared_dir = str(tmp_path / 'shared')
+    reader = SharedModelReader(shared_dir)
+    assert reader.current() == (None, None, None)
+
+    first = NeuralNet(FEATURE_COUNT + 2)
+    assert publish_bundle(save_bundle(first, DeviceEncoder(['Other']), artifacts_dir=artifacts_dir), shared_dir) == 1
+    model, encoder, linear = reader.current()
+    sample = torch.rand(1, FEATURE_COUNT + 2)
+    with torch.no_grad():
+        assert torch.allclose(model(sample), first(sample))
+    assert encoder.categories == ['Other']
+    assert linear is None
+
+    second = NeuralNet(FEATURE_COUNT + 3)
+    bundle_path = save_bundle(second, DeviceEncoder(['Other', 'iPhone']), artifacts_dir=artifacts_dir)
+    assert publish_bundle(bundle_path, shared_dir) == 2
+    assert publish_bundle(bundle_path, shared_dir) == 2  # Already published, nothing to do
+    model, encoder, linear = reader.current()
+    assert reader.generation == 2
+    sample = torch.rand(1, FEATURE_COUNT + 3)
+    with torch.no_grad():
+        assert torch.allclose(model(sample), second(sample))
+
+    # A generation deleted before the reader attached it: the mapped one keeps serving until the next request
+    third = NeuralNet(FEATURE_COUNT + 3)
+    assert publish_bundle(save_bundle(third, DeviceEncoder(['Other', 'iPhone']), artifacts_dir=artifacts_dir), shared_dir) == 3
+    os.rename(os.path.join(shared_dir, 'gen-3.bin'), os.path.join(shared_dir, 'gen-3.moved'))
+    assert reader.current()[0] is model
+    assert reader.generation == 2
+    os.rename(os.path.join(shared_dir, 'gen-3.moved'), os.path.join(shared_dir, 'gen-3.bin'))
+    model, _, _ = reader.current()
+    assert reader.generation == 3
+    with torch.no_grad():
+        assert torch.allclose(model(sample), third(sample))
+
+    # A truncated generation is skipped until the next one is published
+    fourth = NeuralNet(FEATURE_COUNT + 3)
+    assert publish_bundle(save_bundle(fourth, DeviceEncoder(['Other', 'iPhone']), artifacts_dir=artifacts_dir), shared_dir) == 4
+    gen_4 = os.path.join(shared_dir, 'gen-4.bin')
+    with open(gen_4, 'rb') as f:
+        intact = f.read()
+    with open(gen_4, 'wb') as f:
+        f.write(intact[:len(intact) // 2])
+    assert reader.current()[0] is model
+    assert reader.generation == 3
+    with open(gen_4, 'wb') as f:
+        f.write(b'')
+    assert reader.current()[0] is model
+    assert publish_bundle(save_bundle(NeuralNet(FEATURE_COUNT + 3), DeviceEncoder(['Other', 'iPhone']), artifacts_dir=artifacts_dir), shared_dir) == 5
+    reader.current()
+    assert reader.generation == 5
+
+def test_shared_model_falls_back_to_local_bundle(tmp_path, monkeypatch):
+    """Test a worker that cannot map the published generation loads its own copy instead of serving the placeholder."""
+    from model.model_definitions import NeuralNet
+    from src import model_bundle, shared_model
+    from src.extract_features import FEATURE_COUNT
+    from src.device_encoder import DeviceEncoder
+    import src.shared_variables as shared_variables
+    encoder = DeviceEncoder(['Other'])
+    bundle_path = model_bundle.save_bundle(NeuralNet(FEATURE_COUNT + encoder.width), encoder, artifacts_dir=str(tmp_path / 'artifacts'))
+    os.makedirs(tmp_path / 'shared')
+    shared_model._write_control(str(tmp_path / 'shared'), 1)  # Names a generation file that is gone
+    for name in ['model', 'encoder', 'linear', 'model_version']:
+        monkeypatch.setattr(shared_variables, name, None)
+    monkeypatch.setattr(shared_variables, 'shared_model', shared_model.SharedModelReader(str(tmp_path / 'shared')))
+    monkeypatch.setattr(shared_variables, 'publish_bundle', lambda: 1)
+    monkeypatch.setattr(shared_variables, 'latest_bundle_path', lambda: bundle_path)
+    monkeypatch.setattr(shared_variables, 'load_bundle', lambda: model_bundle.load_bundle(bundle_path))
+    shared_variables.load_model()
+    assert shared_variables.model is not None
+    assert shared_variables.current_model()[0] is shared_variables.model
+
+def test_update_labels_batch(client, data_dir):
+    """Test the batch update endpoint labels every stored interaction and reports unknown ones."""
+    from src import catalog
+    headers = {'Authorization': f'Bearer {flask_app.config["AUTH_TOKEN"]}'}
+    payload = base64.b64encode(json.dumps({
+        'interactions': {},
+        'duration': 1000,
+        'viewport': {},
+        'loadTimestamp': 1234567890
+    }).encode('utf-8')).decode('utf-8')
+    interaction_ids = []
+    for _ in range(2):
+        rv = client.post('/api/store', json={'data': payload}, headers=headers)
+        interaction_ids.append(rv.get_json()['interaction_id'])
+    with open(data_dir / 'corrupt-interaction.json', 'w') as f:
+        f.write('{"interaction_id": ')
+    update_data = {'updates': [
+        {'interaction_id': interaction_ids[0], 'label': 0},
+        {'interaction_id': 'corrupt-interaction', 'label': 0},
+        {'interaction_id': interaction_ids[1], 'label': 0},
+        {'interaction_id': interaction_ids[1], 'label': 1},
+        {'interaction_id': 'missing-interaction', 'label': 1}
+    ]}
+    rv = client.post('/api/update/batch', json=update_data, headers=headers)
+    assert rv.status_code == 200
+    response_data = rv.get_json()
+    assert response_data['updated'] == 2
+    assert response_data['not_found'] == ['missing-interaction']
+    assert response_data['failed'] == [{'interaction_id': 'corrupt-interaction', 'error': 'JSONDecodeError'}]
+    assert catalog.label_counts() == {0: 1, 1: 1}
+
+    # Ids cannot leave the data directory
+    rv = client.post('/api/update/batch', json={'updates': [{'interaction_id': '../main', 'label': 1}]}, headers=headers)
+    assert rv.status_code == 400
+    for interaction_id, label in zip(interaction_ids, [0, 1]):
+        with open(data_dir / f'{interaction_id}.json', 'r') as f:
+            assert json.load(f)['label'] == label
+    assert os.path.exists('request_counter.txt')
+
+def test_train_and_reload_runs_in_background(monkeypatch):
+    """Test retraining does not hold up the request that triggers it and runs once at a time."""
+    import time
+    import src.shared_variables as shared_variables
+    reloads = []
+    monkeypatch.setattr(shared_variables, 'train_command', [sys.executable, '-c', 'import time; time.sleep(0.5)'])
+    monkeypatch.setattr(shared_variables, 'load_model', lambda: reloads.append(time.monotonic()))
+    started_at = time.monotonic()
+    thread = shared_variables._train_and_reload()
+    assert time.monotonic() - started_at < 0.4
+    assert shared_variables._train_and_reload() is None  # Already training
+    thread.join(timeout=10)
+    assert len(reloads) == 1 and reloads[0] - started_at >= 0.5
+
+    # A failed run keeps the current model
+    monkeypatch.setattr(shared_variables, 'train_command', [sys.executable, '-c', 'raise SystemExit(1)'])
+    shared_variables._train_and_reload().join(timeout=10)
+    assert len(reloads) == 1
+
+def test_update_labels_batch_requires_auth(client):
+    """Test the batch update endpoint rejects unauthenticated calls."""
+    rv = client.post('/api/update/batch', json={'updates': [{'interaction_id': 'x', 'label': 1}]})
+    assert rv.status_code == 401
+
+def test_catalog_tracks_labels(client, data_dir, monkeypatch):
+    """Test that the catalog follows stored interactions and label updates."""
+    from src import catalog
+    headers = {'Authorization': f'Bearer {flask_app.config["AUTH_TOKEN"]}'}
+    payload = base64.b64encode(json.dumps({
+        'interactions': {},
+        'duration': 1000,
+        'viewport': {},
+        'loadTimestamp': 1234567890,
+        'label': 1
+    }).encode('utf-8')).decode('utf-8')
+    interaction_ids = []
+    for _ in range(3):
+        rv = client.post('/api/store', json={'data': payload}, headers=headers)
+        interaction_ids.append(rv.get_json()['interaction_id'])
+    assert catalog.label_counts() == {1: 3}
+    catalog.record_training_run(3)
+
+    rv = client.post('/api/update/batch', json={'updates': [{'interaction_id': interaction_ids[0], 'label': 0}]}, headers=headers)
+    assert rv.status_code == 200
+    assert catalog.label_counts() == {0: 1, 1: 2}
+    assert catalog.class_balance()[1] == pytest.approx(2 / 3)
+    assert catalog.labelled_since_last_train() == 1
+    assert sorted(catalog.labelled_interaction_ids()) == sorted(interaction_ids)
+
+    # A catalog created after the files were stored: labelling an interaction it does not know adds it
+    monkeypatch.setattr(catalog, 'CATALOG_PATH', str(data_dir / 'new-catalog.sqlite3'))
+    rv = client.post('/api/update/batch', json={'updates': [{'interaction_id': interaction_ids[1], 'label': 0}]}, headers=headers)
+    assert rv.status_code == 200
+    assert catalog.labelled_interaction_ids() == [interaction_ids[1]]
+    assert catalog.label_counts() == {0: 1}
+
+    # The files stored before are indexed once, without touching the known rows
+    assert catalog.index_legacy('data') == 2
+    assert catalog.index_missing('data') == 0
+    with open(data_dir / 'copied-interaction.json', 'w') as f:
+        json.dump({'interaction_id': 'copied-interaction', 'label': 1}, f)
+    assert catalog.index_legacy('data') == 0  # Only once
+    assert catalog.index_missing('data') == 1
+    os.remove(data_dir / 'copied-interaction.json')
+    assert sorted(catalog.labelled_interaction_ids()) == sorted(interaction_ids + ['copied-interaction'])
+    assert catalog.label_counts() == {0: 2, 1: 2}
+
+    # Rebuilding from the files gives the same counts
+    assert catalog.rebuild('data') == 3
+    assert catalog.label_counts() == {0: 2, 1: 1}
+
+def test_admission_rate_limit(client, monkeypatch):
+    """Test that challenges over the per-IP rate are rejected with 429 before any work is done."""
+    import main
+    from src.admission import AdmissionController
+    admission = AdmissionController(ip_rate=0.001, ip_burst=2, session_rate=1, session_burst=1, max_concurrent=4)
+    monkeypatch.setattr(main, 'admission', admission)
+    headers = {'Authorization': f'Bearer {flask_app.config["AUTH_TOKEN"]}', 'Origin': 'https://shop.example'}
+    responses = [client.post('/api/challenge', json={'data': {}}, headers=headers) for _ in range(3)]
+    statuses = [rv.status_code for rv in responses]
+    assert statuses[:2] != [429, 429]
+    assert statuses[2] == 429
+    # Readable by the page that embeds the captcha, like any other challenge response
+    assert responses[2].headers.get('Access-Control-Allow-Origin') == responses[0].headers.get('Access-Control-Allow-Origin') == 'https://shop.example'
+    assert responses[2].headers['Retry-After'] == '1'
+    stats = admission.stats()
+    assert stats['admitted'] == 2
+    assert stats['rejected_rate_limited'] == 1
+    rv = client.get('/api/admin/admission', headers=headers)
+    assert rv.status_code == 200
+
+def test_admission_concurrency_limit():
+    """Test the global concurrency limit sheds load and token buckets expire."""
+    from src.admission import AdmissionController, TokenBucketTable
+    admission = AdmissionController(ip_rate=100, ip_burst=100, session_rate=100, session_burst=100, max_concurrent=1)
+    assert admission.admit('10.0.0.1') is None
+    assert admission.admit('10.0.0.2') == 'overloaded'
+    admission.release()
+    assert admission.admit('10.0.0.2') is None
+    admission.release()
+
+    buckets = TokenBucketTable(rate=1, burst=1, ttl=10, shards=1)
+    assert buckets.allow('a', now=0)
+    assert not buckets.allow('a', now=0.5)
+    assert buckets.allow('b', now=20)  # 'a' has been idle longer than the TTL
+    assert len(buckets) == 1
+
+def _random_interactions(rng, length):
+    events = {
+        'mouseMovements': [{'x': rng.uniform(0, 1000), 'y': rng.uniform(0, 800), 'time': i * 16 + rng.random()} for i in range(length)],
+        'keyPresses': [{'key': 'a', 'time': i * 120 + rng.random()} for i in range(rng.randint(0, length))],
+        'scrollEvents': [{'scrollTop': rng.uniform(0, 5000), 'time': i * 30 + rng.random()} for i in range(rng.randint(0, length))],
+        'formInteractions': [{'time': i * 900 + rng.random()} for i in range(rng.randint(0, 4))],
+        'touchEvents': [
+            {'x': rng.uniform(0, 400), 'y': rng.uniform(0, 800), 'force': rng.random(),
+             'type': rng.choice(['start', 'move', 'end']), 'time': i * 20 + rng.random()}
+            for i in range(rng.randint(0, length))
+        ],
+        'mouseClicks': [{'type': rng.choice(['down', 'up']), 'time': i * 80 + rng.random()} for i in range(rng.randint(0, length))]
+    }
+    return events
+
+# Per-feature reference implementations, one pass over the events per feature.
+# The fused engine in src/extract_features.py must give exactly these results;
+# benchmarks/feature_extraction_bench.py times it against them.
+
+def calculate_avg_mouse_speed(mouse_movements: list):
+    if len(mouse_movements) < 2:
+        return 0
+    total_distance = 0
+    total_time = 0
+    for i in range(1, len(mouse_movements)):
+        dx = mouse_movements[i]['x'] - mouse_movements[i - 1]['x']
+        dy = mouse_movements[i]['y'] - mouse_movements[i - 1]['y']
+        dt = mouse_movements[i]['time'] - mouse_movements[i - 1]['time']
+        total_distance += math.sqrt(dx * dx + dy * dy)
+        total_time += dt
+    return total_distance / total_time
+
+def calculate_avg_key_press_interval(key_presses: list):
+    if len(key_presses) < 2:
+        return 0
+    total_interval = 0
+    for i in range(1, len(key_presses)):
+        total_interval += key_presses[i]['time'] - key_presses[i - 1]['time']
+    return total_interval / (len(key_presses) - 1)
+
+def calculate_avg_scroll_speed(scroll_events: list):
+    if len(scroll_events) < 2:
+        return 0
+    total_scroll = 0
+    total_time = 0
+    for i in range(1, len(scroll_events)):
+        ds = scroll_events[i]['scrollTop'] - scroll_events[i - 1]['scrollTop']
+        dt = scroll_events[i]['time'] - scroll_events[i - 1]['time']
+        total_scroll += abs(ds)
+        total_time += dt
+    return total_scroll / total_time
+
+def calculate_form_completion_time(form_interactions: list):
+    if len(form_interactions) < 2:
+        return 0
+    return form_interactions[-1]['time'] - form_interactions[0]['time']
+
+def calculate_mouse_linearity(mouse_movements: list):
+    if len(mouse_movements) < 2:
+        return 0
+    start_x = mouse_movements[0]['x']
+    start_y = mouse_movements[0]['y']
+    end_x = mouse_movements[-1]['x']
+    end_y = mouse_movements[-1]['y']
+    total_distance = math.sqrt((end_x - start_x) ** 2 + (end_y - start_y) ** 2)
+
+    actual_distance = 0
+    for i in range(1, len(mouse_movements)):
+        dx = mouse_movements[i]['x'] - mouse_movements[i - 1]['x']
+        dy = mouse_movements[i]['y'] - mouse_movements[i - 1]['y']
+        actual_distance += math.sqrt(dx * dx + dy * dy)
+
+    return total_distance / actual_distance
+
+def calculate_avg_touch_pressure(touch_events: list):
+    if len(touch_events) == 0:
+        return 0
+    total_pressure = sum(event['force'] for event in touch_events)
+    return total_pressure / len(touch_events)
+
+def calculate_avg_touch_movement(touch_events: list):
+    if len(touch_events) < 2:
+        return 0
+    total_movement = 0
+    for i in range(1, len(touch_events)):
+        dx = touch_events[i]['x'] - touch_events[i - 1]['x']
+        dy = touch_events[i]['y'] - touch_events[i - 1]['y']
+        total_movement += math.sqrt(dx * dx + dy * dy)
+    return total_movement / (len(touch_events) - 1)
+
+def calculate_avg_click_duration(mouse_clicks: list):
+    if len(mouse_clicks) < 2:
+        return 0
+    total_duration = 0
+    click_count = 0
+    for i in range(1, len(mouse_clicks)):
+        if 'type' in mouse_clicks[i] and 'type' in mouse_clicks[i - 1]:
+            if mouse_clicks[i]['type'] == 'up' and mouse_clicks[i - 1]['type'] == 'down':
+                total_duration += mouse_clicks[i]['time'] - mouse_clicks[i - 1]['time']
+                click_count += 1
+    return total_duration / click_count if click_count > 0 else 0
+
+def calculate_avg_touch_duration(touch_events: list):
+    if len(touch_events) < 2:
+        return 0
+    total_duration = 0
+    touch_count = 0
+    for i in range(1, len(touch_events)):
+        if touch_events[i]['type'] == 'end' and touch_events[i - 1]['type'] == 'start':
+            total_duration += touch_events[i]['time'] - touch_events[i - 1]['time']
+            touch_count += 1
+    return total_duration / touch_count if touch_count > 0 else 0
+
+def reference_feature_vector(data):
+    return [
+        calculate_avg_mouse_speed(data.mouse_movements),
+        calculate_avg_key_press_interval(data.key_presses),
+        calculate_avg_scroll_speed(data.scroll_events),
+        calculate_form_completion_time(data.form_interactions),
+        len(data.mouse_movements) + len(data.key_presses) + len(data.scroll_events)
+        + len(data.form_interactions) + len(data.touch_events) + len(data.mouse_clicks),
+        calculate_mouse_linearity(data.mouse_movements),
+        calculate_avg_touch_pressure(data.touch_events),
+        calculate_avg_touch_movement(data.touch_events),
+        calculate_avg_click_duration(data.mouse_clicks),
+        calculate_avg_touch_duration(data.touch_events),
+        data.duration
+    ]
+
+def test_fused_features_match_reference():
+    """Test that the fused feature engine gives exactly the per-feature reference results, in one pass or in chunks."""
+    import random
+    from src import extract_features as ef
+    rng = random.Random(1234)
+    for length in [0, 1, 2, 3, 50]:
+        for _ in range(20):
+            interactions = _random_interactions(rng, length)
+            data = ef.UserInteractionData(
+                interactions['mouseMovements'], interactions['keyPresses'], interactions['scrollEvents'],
+                interactions['formInteractions'], interactions['touchEvents'], interactions['mouseClicks'], 12345
+            )
+            reference = reference_feature_vector(data)
+            try:
+                assert ef.extract_feature_vector(data) == reference
+            except ZeroDivisionError:
+                continue
+
+            session = ef.SessionAccumulator()
+            for start in range(0, max(length, 1), 7):
+                session.feed({key: events[start:start + 7] for key, events in interactions.items()})
+            session.duration = 12345
+            assert session.feature_vector() == reference
+            assert ef.extract_features(data).to_vector() == reference
+
+def test_streamed_challenge_matches_batch(client):
+    """Test a challenge streamed in chunks gets the same features as one with the full event log."""
+    import random
+    from src.extract_features import extract_feature_vector, UserInteractionData
+    interactions = _random_interactions(random.Random(7), 40)
+    headers = {'Authorization': f'Bearer {os.getenv("PUBLIC_AUTH_TOKEN")}', 'Cookie': 'session_id=streamed-session'}
+    chunks = [{'seq': seq, 'interactions': {key: events[start:start + 10] for key, events in interactions.items()}}
+              for seq, start in enumerate(range(0, 30, 10))]
+    for chunk in chunks[:2]:
+        rv = client.post('/api/challenge/events', json=dict(chunk, streamId='streamed-page'), headers=headers)
+        assert rv.status_code == 200
+    # A retried chunk the server already folded is not counted twice
+    rv = client.post('/api/challenge/events', json=dict(chunks[1], streamId='streamed-page'), headers=headers)
+    assert rv.get_json()['interaction_count'] == sum(len(events[:20]) for events in interactions.values())
+
+    # Another page of the same browser (same cookie) that did not stream does not get these events
+    rv = client.post('/api/challenge', json={'data': {'interactions': {}, 'duration': 1000, 'viewport': {}, 'loadTimestamp': 1}},
+                     headers=headers)
+    assert rv.status_code == 200
+
+    payload = {
+        'interactions': {key: events[30:] for key, events in interactions.items()},
+        'duration': 5000,
+        'viewport': {'width': 1280, 'height': 720},
+        'loadTimestamp': 1234567890
+    }
+    # Chunks the page could not deliver go with the challenge
+    rv = client.post('/api/challenge', json={'data': payload, 'save': True, 'streamId': 'streamed-page', 'streamedChunks': 3,
+                                             'chunks': chunks[1:]}, headers=headers)
+    assert rv.status_code == 200
+    interaction_id = jwt.decode(rv.get_json()['token'], options={'verify_signature': False})['interaction_id']
+    file_path = os.path.join('data', f'{interaction_id}.json')
+    with open(file_path) as f:
+        record = json.load(f)
+    os.remove(file_path)
+    expected = extract_feature_vector(UserInteractionData(
+        interactions['mouseMovements'], interactions['keyPresses'], interactions['scrollEvents'],
+        interactions['formInteractions'], interactions['touchEvents'], interactions['mouseClicks'], 5000
+    ))
+    assert record['features'] == expected
+
+    # The stream is consumed by its challenge, and stream ids are validated
+    rv = client.post('/api/challenge', json={'data': payload, 'save': True, 'streamId': 'streamed-page'}, headers=headers)
+    interaction_id = jwt.decode(rv.get_json()['token'], options={'verify_signature': False})['interaction_id']
+    file_path = os.path.join('data', f'{interaction_id}.json')
+    with open(file_path) as f:
+        assert 'features' not in json.load(f)
+    os.remove(file_path)
+    rv = client.post('/api/challenge/events', json={'streamId': '../x', 'seq': 0, 'interactions': {}}, headers=headers)
+    assert rv.status_code == 400
+    rv = client.post('/api/challenge/events', json={'streamId': 'streamed-page', 'interactions': {}}, headers=headers)
+    assert rv.status_code == 400
+    rv = client.post('/api/challenge', json={'data': payload, 'streamId': 7}, headers=headers)
+    assert rv.status_code == 400
+
+    # A worker that did not get every chunk of the stream refuses the later chunks and to score it
+    rv = client.post('/api/challenge/events', json={'streamId': 'partial-page', 'seq': 1, 'interactions': chunks[1]['interactions']},
+                     headers=headers)
+    assert rv.status_code == 409
+    assert rv.get_json()['expectedSeq'] == 0
+    rv = client.post('/api/challenge', json={'data': payload, 'streamId': 'partial-page', 'streamedChunks': 2}, headers=headers)
+    assert rv.status_code == 409
+    rv = client.post('/api/challenge', json={'data': payload, 'streamId': 'unknown-page', 'streamedChunks': 1}, headers=headers)
+    assert rv.status_code == 409
+
+def test_session_store_bounds():
+    """Test the streaming session store expires idle sessions and caps its size."""
+    from src.session_store import SessionStore, IncompleteStream, OutOfOrderChunk
+    store = SessionStore(max_sessions=2, ttl=10, shards=1)
+    chunk = {'keyPresses': [{'key': 'a', 'time': 0}, {'key': 'b', 'time': 100}]}
+    assert store.feed('a', chunk, now=0) == 2
+    assert store.feed('a', chunk, now=1) == 4
+    store.feed('b', chunk, now=2)
+    store.feed('c', chunk, now=3)  # over capacity, the least recently fed session goes
+    assert store.take('a', now=3) is None
+    assert store.take('b', now=20) is None  # idle longer than the TTL
+    assert store.take('c', now=3).interaction_count == 2
+    assert store.take('c', now=3) is None
+    assert store.stats()['evicted'] == 1
+    # Chunks numbered below the next expected one are duplicates
+    assert store.feed('d', chunk, seq=0, now=4) == 2
+    assert store.feed('d', chunk, seq=0, now=4) == 2
+    assert store.feed('d', chunk, seq=1, now=4) == 4
+    assert store.stats()['duplicate_chunks'] == 1
+    # A chunk numbered above the next expected one is not folded, so the missing one still counts when it arrives
+    with pytest.raises(OutOfOrderChunk) as e:
+        store.feed('d', chunk, seq=3, now=4)
+    assert e.value.expected_seq == 2
+    assert store.stats()['out_of_order_chunks'] == 1
+    assert store.feed('d', chunk, seq=2, now=4) == 6
+    assert store.feed('d', chunk, seq=3, now=4) == 8
+    with pytest.raises(IncompleteStream):
+        store.take('d', chunk_count=5, now=4)
+    assert store.stats()['incomplete_streams'] == 1
+
+def test_challenge_memory_within_thresholds():
+    """Test the challenge path stays within the checked-in memory thresholds (benchmarks/memory_thresholds.json)."""
+    import subprocess
+    result = subprocess.run(
+        [sys.executable, 'benchmarks/memory_harness.py', '--quick'], capture_output=True, text=True, timeout=600
+    )
+    assert result.returncode == 0, result.stdout + result.stderr
+
+def test_static_assets(client):
+    """Test captcha.js is served compressed, versioned and revalidated from memory."""
+    import gzip
+    with open('html/captcha.js', 'rb') as f:
+        script = f.read()
+    rv = client.get('/captcha.js', headers={'Accept-Encoding': 'gzip, deflate'})
+    assert rv.status_code == 200
+    assert rv.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(rv.data) == script
+    assert rv.headers['Vary'] == 'Accept-Encoding'
+    etag = rv.headers['ETag']
+
+    rv = client.get('/captcha.js', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    assert rv.status_code == 304
+    rv = client.get('/captcha.js', headers={'If-None-Match': etag})
+    assert rv.status_code == 200  # the identity variant has its own ETag
+    assert rv.data == script
+
+    versioned_url = client.get('/api/assets').get_json()['/captcha.js']
+    rv = client.get(versioned_url)
+    assert rv.status_code == 200
+    assert 'immutable' in rv.headers['Cache-Control']
+    assert rv.data == script
+
+    # brotli is preferred when the browser accepts it
+    import brotli
+    rv = client.get('/captcha.js', headers={'Accept-Encoding': 'gzip, deflate, br'})
+    assert rv.headers['Content-Encoding'] == 'br'
+    assert brotli.decompress(rv.data) == script
+
+def test_static_assets_reload(tmp_path):
+    """Test changed, added and removed files are picked up."""
+    from src.static_assets import StaticAssetCache
+    (tmp_path / 'a.js').write_text('let a = 1;')
+    assets = StaticAssetCache(str(tmp_path), check_interval=0)
+    status, headers, body = assets.respond('a.js')
+    assert (status, body) == (200, b'let a = 1;')
+    first_url = assets.manifest()['/a.js']
+
+    (tmp_path / 'a.js').write_text('let a = 22;')
+    (tmp_path / 'b.css').write_text('body {}')
+    assert assets.respond('a.js')[2] == b'let a = 1;'  # Requests never re-scan the directory
+    assets.reload()
+    assert assets.respond('a.js')[2] == b'let a = 22;'
+    assert assets.manifest()['/a.js'] != first_url
+    assert assets.respond(first_url.lstrip('/')) is None
+    assert assets.respond('b.css')[0] == 200
+
+    # The watcher thread picks up changes on its own
+    import time
+    watched = StaticAssetCache(str(tmp_path), check_interval=0.01)
+    (tmp_path / 'b.css').unlink()
+    deadline = time.monotonic() + 5
+    while watched.respond('b.css') is not None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    watched.close()
+    assert watched.respond('b.css') is None
+
+def test_device_encoder():
+    """Test device families map to their one-hot slot, rare and unseen ones to the unknown bucket."""
+    from sklearn.preprocessing import OneHotEncoder
+    from src.device_encoder import DeviceEncoder
+    families = ['iPhone', 'Other', 'iPhone', 'Pixel 7', 'Other', 'K']
+    encoder = DeviceEncoder.fit(families)
+    assert encoder.categories == ['Other', 'iPhone']
+    assert encoder.transform(['iPhone', 'K', 'Galaxy S24']) == [[0.0, 1.0, 0.0], [0.0, 0.0, 1.0], [0.0, 0.0, 1.0]]
+
+    # Without the unknown bucket (bundles from before it existed) the slots match OneHotEncoder
+    sklearn_encoder = OneHotEncoder(sparse_output=False).fit([[family] for family in families])
+    legacy = DeviceEncoder.from_json({'categories': list(sklearn_encoder.categories_[0])})
+    for family in set(families):
+        assert legacy.encode(family) == list(sklearn_encoder.transform([[family]]).flatten())
+    assert legacy.encode('Galaxy S24') == [0.0] * legacy.width
+
+def test_parse_site_keys():
+    """Test SITE_KEYS maps each public key to its site and rejects malformed entries."""
+    from src.tenants import parse_site_keys
+    assert parse_site_keys('shop=pk_shop, blog=pk_blog,') == {'pk_shop': 'shop', 'pk_blog': 'blog'}
+    assert parse_site_keys(None) == {}
+    with pytest.raises(ValueError):
+        parse_site_keys('../etc=pk')
+
+def test_tenant_model_cache(tmp_path):
+    """Test site models load on demand, fall back to the global model and are evicted least recently used first."""
+    from model.model_definitions import NeuralNet
+    from src.model_bundle import save_bundle, latest_bundle_path
+    from src.tenants import TenantModelCache, site_artifacts_dir
+    from src.extract_features import FEATURE_COUNT
+    from src.device_encoder import DeviceEncoder
+    sites_dir = str(tmp_path)
+    for site_id in ['a', 'b']:
+        save_bundle(NeuralNet(FEATURE_COUNT + 2), DeviceEncoder(['Other']), artifacts_dir=site_artifacts_dir(site_id, sites_dir))
+    model_size = os.path.getsize(os.path.join(latest_bundle_path(site_artifacts_dir('a', sites_dir)), 'model.pt'))
+
+    cache = TenantModelCache(memory_budget=model_size, check_interval=60, sites_dir=sites_dir)
+    assert cache.get('a', now=0)[1].categories == ['Other']
+    assert cache.get('a', now=1) is not None
+    assert cache.get('c', now=1) is None  # No bundle: scored by the global model
+    assert cache.get('b', now=2) is not None  # Over budget: 'a' is evicted
+    stats = cache.stats()
+    assert stats['sites_cached'] == 1 and stats['evictions'] == 1
+    assert stats['hits'] == 1 and stats['loads'] == 2 and stats['fallbacks'] == 1
+
+    # A newer bundle is picked up once the check interval has passed
+    encoder = DeviceEncoder(['Other', 'iPhone'])
+    save_bundle(NeuralNet(FEATURE_COUNT + encoder.width), encoder, artifacts_dir=site_artifacts_dir('b', sites_dir))
+    assert cache.get('b', now=3)[1].categories == ['Other']
+    assert cache.get('b', now=70)[1].categories == ['Other', 'iPhone']
+
+def test_site_challenge_recorded(client, data_dir, monkeypatch):
+    """Test a challenge made with a site key is accepted and saved with its site."""
+    import random
+    from src import catalog, tenants
+    monkeypatch.setattr(tenants, 'SITE_KEYS', {'pk_shop': 'shop'})
+    payload = {
+        'interactions': _random_interactions(random.Random(3), 10),
+        'duration': 2000,
+        'viewport': {'width': 1280, 'height': 720},
+        'loadTimestamp': 1234567890
+    }
+    rv = client.post('/api/challenge', json={'data': payload, 'save': True}, headers={'Authorization': 'Bearer pk_shop'})
+    assert rv.status_code == 200
+    interaction_id = jwt.decode(rv.get_json()['token'], options={'verify_signature': False})['interaction_id']
+    with open(data_dir / f'{interaction_id}.json') as f:
+        assert json.load(f)['site_id'] == 'shop'
+    assert catalog.label_counts() == {}
+
+    rv = client.post('/api/challenge', json={'data': payload}, headers={'Authorization': 'Bearer pk_unknown'})
+    assert rv.status_code == 401
+
+def test_model_cache_stats_requires_auth(client):
+    """Test the per-site model cache counters are only served to the admin token."""
+    assert client.get('/api/admin/models').status_code == 401
+    headers = {'Authorization': f'Bearer {flask_app.config["AUTH_TOKEN"]}'}
+    rv = client.get('/api/admin/models', headers=headers)
+    assert rv.status_code == 200
+    assert 'memory_budget' in rv.get_json()
+
+def test_cascade_stages(monkeypatch):
+    """Test obvious payloads are scored by the rules or the linear screen and the rest by the network."""
+    import torch
+    from user_agents import parse
+    from model.model_definitions import NeuralNet
+    from src.cascade import Cascade, CascadeRules, LinearScreen
+    from src.handlers.challenge import score_interaction
+    from src.extract_features import FEATURE_COUNT, extract_feature_vector, UserInteractionData
+    from src.device_encoder import DeviceEncoder
+    encoder = DeviceEncoder(['Other'])
+    model = NeuralNet(FEATURE_COUNT + encoder.width).eval()
+    cascade = Cascade(CascadeRules(min_events=2, min_duration=100, bot_score=0.0))
+    payload = {'interactions': {'mouseMovements': [{'x': 1, 'y': 1, 'time': 0}, {'x': 5, 'y': 9, 'time': 40}]}, 'duration': 1000}
+
+    assert score_interaction({'interactions': {}, 'duration': 1000}, '', model, encoder, cascade=cascade)[0] == 0.0
+    assert score_interaction(dict(payload, duration=50), '', model, encoder, cascade=cascade)[0] == 0.0
+    # Without a model the placeholder is returned whatever the payload
+    assert score_interaction({'interactions': {}, 'duration': 1000}, '', None, None, cascade=cascade)[0] == 0.5
+
+    undecided = LinearScreen([0.0] * model.fc1.in_features, 0.0, 0.1, 0.9)  # Always 0.5
+    score = score_interaction(payload, '', model, encoder, linear=undecided, cascade=cascade)[0]
+    device = encoder.encode(parse('').device.family)
+    vector = extract_feature_vector(UserInteractionData(payload['interactions']['mouseMovements'], [], [], [], [], [], 1000))
+    with torch.no_grad():
+        assert score == pytest.approx(model(torch.tensor([vector + device], dtype=torch.float32)).item())
+
+    confident = LinearScreen([0.0] * model.fc1.in_features, 5.0, 0.1, 0.9)
+    assert score_interaction(payload, '', model, encoder, linear=confident, cascade=cascade)[0] > 0.99
+    stats = cascade.stats()['stages']
+    assert [stats[stage]['decided'] for stage in ['rules', 'linear', 'network']] == [2, 1, 1]
+
+    # Configured rule thresholds change scores, so serving only uses the cascade when asked to
+    monkeypatch.delenv('CASCADE_ENABLED', raising=False)
+    assert score_interaction({'interactions': {}, 'duration': 1000}, '', model, encoder, cascade=Cascade.from_env())[0] != 0.0
+
+def test_linear_screen_training(tmp_path):
+    """Test the linear screen only claims the bands it scored at the target precision and ships in the bundle."""
+    import random
+    from model.train import train_linear
+    from model.model_definitions import NeuralNet
+    from src.model_bundle import save_bundle, load_bundle
+    from src.extract_features import FEATURE_COUNT
+    from src.device_encoder import DeviceEncoder
+    rng = random.Random(0)
+    width = FEATURE_COUNT + 2
+    X = [[rng.gauss(label * 4, 1)] + [rng.random() for _ in range(width - 1)] for label in [0, 1] * 200]
+    y = [0, 1] * 200
+    linear = train_linear(X, y, target_precision=0.99)
+    assert 0 < linear.low < linear.high < 1
+    decided = [(linear.decide(x), label) for x, label in zip(X, y) if linear.decide(x) is not None]
+    assert len(decided) > len(X) / 2
+    assert sum((score > 0.5) == (label == 1) for score, label in decided) / len(decided) >= 0.99
+
+    bundle = load_bundle(save_bundle(NeuralNet(width), DeviceEncoder(['Other']), artifacts_dir=str(tmp_path), linear=linear))
+    assert bundle.linear.to_json() == linear.to_json()
+
+def test_hyperparameter_search():
+    """Test the search cross-validates every candidate in worker processes and selects within the latency budget."""
+    import random
+    from model.search import search, select, candidates
+    assert len(candidates()) == 108
+    assert len(candidates(samples=5)) == 5 and candidates(samples=5) == candidates(samples=5)
+
+    rng = random.Random(0)
+    X = [[rng.gauss(label * 3, 1) for _ in range(6)] for label in [0, 1] * 40]
+    y = [0, 1] * 40
+    configs = [{'hidden_sizes': hidden_sizes, 'lr': 0.01, 'epochs': 3, 'batch_size': 16} for hidden_sizes in [[4, 2], [16, 8]]]
+    results = search(X, y, configs, folds=2, jobs=2)
+    assert [r['config'] for r in results] == configs
+    assert [r['num_params'] for r in results] == [6 * 4 + 4 + 4 * 2 + 2 + 2 + 1, 6 * 16 + 16 + 16 * 8 + 8 + 8 + 1]
+    assert all(0 <= r['accuracy'] <= 1 and r['latency_us'] > 0 for r in results)
+
+    fast = {'config': 'fast', 'accuracy': 0.9, 'num_params': 10, 'latency_us': 10}
+    slow = {'config': 'slow', 'accuracy': 0.97, 'num_params': 1000, 'latency_us': 50}
+    assert select([fast, slow])['config'] == 'slow'
+    assert select([fast, slow], latency_budget_us=20)['config'] == 'fast'
+    assert select([fast, slow], latency_budget_us=5) is None
+
+def test_shared_model_hidden_sizes(tmp_path):
+    """Test a bundle with non-default hidden sizes is rebuilt from its manifest in shared memory."""
+    import torch
+    from model.model_definitions import NeuralNet
+    from src.model_bundle import save_bundle
+    from src.shared_model import SharedModelReader, publish_bundle
+    from src.extract_features import FEATURE_COUNT
+    from src.device_encoder import DeviceEncoder
+    model = NeuralNet(FEATURE_COUNT + 2, (16, 8))
+    publish_bundle(save_bundle(model, DeviceEncoder(['Other']), artifacts_dir=str(tmp_path / 'artifacts')), str(tmp_path / 'shared'))
+    shared, _, _ = SharedModelReader(str(tmp_path / 'shared')).current()
+    assert shared.hidden_sizes == (16, 8)
+    sample = torch.rand(1, FEATURE_COUNT + 2)
+    with torch.no_grad():
+        assert torch.allclose(shared(sample), model(sample))
+
+def test_generated_sessions(tmp_path, monkeypatch):
+    """Test generated sessions are deterministic across workers, valid payloads and indexed in the catalog."""
+    import gzip
+    from benchmarks.generate_sessions import generate, generate_session
+    from src import catalog
+    from src.handlers.challenge import validate_interaction_payload
+    from src.validation_schemas import interaction_payload_schema
+    from src.extract_features import extract_feature_vector, UserInteractionData
+    monkeypatch.setattr(catalog, 'CATALOG_PATH', str(tmp_path / 'catalog.sqlite3'))
+    expected = [generate_session(7, index, sites=3) for index in range(40)]
+    assert {record['label'] for record in expected} == {0, 1}
+
+    assert generate(40, str(tmp_path / 'jsonl'), 'jsonl.gz', seed=7, sites=3, jobs=2, chunk_size=15) == 40
+    records = []
+    for filename in sorted(os.listdir(tmp_path / 'jsonl')):
+        with gzip.open(tmp_path / 'jsonl' / filename, 'rt') as f:
+            records += [json.loads(line) for line in f]
+    assert records == expected
+
+    # Only files written to the data directory are indexed unless asked for
+    assert generate(40, str(tmp_path / 'files'), 'files', seed=7, sites=3, jobs=2, chunk_size=15) == 40
+    assert catalog.label_counts() == {}
+    assert generate(40, str(tmp_path / 'files'), 'files', seed=7, sites=3, jobs=2, chunk_size=15, index_catalog=True) == 40
+    assert sum(catalog.label_counts().values()) == 40
+    for record in expected:
+        with open(tmp_path / 'files' / f'{record["interaction_id"]}.json') as f:
+            assert json.load(f) == record
+        payload = {'interactions': record['interaction_data'], 'duration': record['duration'],
+                   'viewport': record['viewport'], 'loadTimestamp': record['load_timestamp']}
+        assert validate_interaction_payload(payload, interaction_payload_schema) is None
+        interactions = record['interaction_data']
+        extract_feature_vector(UserInteractionData(
+            interactions['mouseMovements'], interactions['keyPresses'], interactions['scrollEvents'],
+            interactions['formInteractions'], interactions['touchEvents'], interactions['mouseClicks'], record['duration']
+        ))
+
+def test_access_log(tmp_path, monkeypatch):
+    """Test access log records are sampled, written as JSON lines and errors are kept when the queue is full."""
+    import time
+    import threading
+    from src.access_log import AccessLog
+    log_path = str(tmp_path / 'access.log')
+    access_log = AccessLog(log_path, sample_rate=0.0, queue_size=1)
+    access_log.record('POST', '/api/challenge', 200, time.perf_counter())  # Sampled out
+    access_log.record('POST', '/api/challenge', 429, time.perf_counter())
+    assert access_log.flush()
+
+    # With the listener stuck writing and the queue full, successes are dropped and errors written inline
+    with access_log._write_lock:
+        access_log.record('GET', '/api/public_key', 200, time.perf_counter())
+        while access_log._queue.qsize():
+            time.sleep(0.001)
+        access_log.record('GET', '/api/assets', 200, time.perf_counter())
+        access_log.record('GET', '/captcha.js', 200, time.perf_counter())
+        error = threading.Thread(target=access_log.record, args=('POST', '/api/update', 500, time.perf_counter()))
+        error.start()
+    error.join()
+    assert access_log.flush()
+    access_log.close()
+
+    with open(log_path) as f:
+        lines = [json.loads(line) for line in f]
+    assert sorted((line['path'], line['status']) for line in lines) == [
+        ('/api/assets', 200), ('/api/challenge', 429), ('/api/public_key', 200), ('/api/update', 500)
+    ]
+    stats = access_log.stats()
+    assert (stats['sampled_out'], stats['dropped'], stats['written_inline']) == (1, 1, 1)
+
+    # Off unless ACCESS_LOG is set
+    monkeypatch.delenv('ACCESS_LOG', raising=False)
+    assert AccessLog.from_env().path is None
+
+def test_access_log_stage_timings(client, tmp_path, monkeypatch):
+    """Test challenges are logged with the time spent in each stage."""
+    import main
+    from src.access_log import AccessLog
+    access_log = AccessLog(str(tmp_path / 'access.log'))
+    monkeypatch.setattr(main, 'access_log', access_log)
+    payload = {'interactions': {}, 'duration': 1000, 'viewport': {}, 'loadTimestamp': 1234567890}
+    rv = client.post('/api/challenge', json={'data': payload}, headers={'Authorization': f'Bearer {os.getenv("PUBLIC_AUTH_TOKEN")}'})
+    assert rv.status_code == 200
+    assert access_log.flush()
+    access_log.close()
+    with open(tmp_path / 'access.log') as f:
+        line = json.loads(f.readline())
+    assert (line['method'], line['path'], line['status']) == ('POST', '/api/challenge', 200)
+    assert list(line['stages_ms']) == ['admission', 'validate', 'score', 'sign']
+    assert line['latency_ms'] >= sum(line['stages_ms'].values()) - 0.01
+
+def test_traffic_capture(client, tmp_path, monkeypatch):
+    """Test captured challenge traffic is sanitized and keeps the session of streamed events."""
+    import main
+    from src.traffic_capture import TrafficCapture
+    capture = TrafficCapture(str(tmp_path / 'traffic.jsonl'), salt='test')
+    monkeypatch.setattr(main, 'traffic_capture', capture)
+    headers = {'Authorization': f'Bearer {os.getenv("PUBLIC_AUTH_TOKEN")}', 'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64)'}
+    client.set_cookie('session_id', 'secret-session', domain='localhost')
+    key_presses = [{'key': 'p', 'time': 10}, {'key': '7', 'time': 130}, {'key': '!', 'time': 250}, {'key': 'Backspace', 'time': 400}]
+    rv = client.post('/api/challenge/events', json={'streamId': 'captured-page', 'seq': 0, 'interactions': {'keyPresses': key_presses}}, headers=headers)
+    assert rv.status_code == 200
+    payload = {'interactions': {}, 'duration': 1000, 'viewport': {}, 'loadTimestamp': 1234567890}
+    rv = client.post('/api/challenge', json={'data': payload, 'save': False}, headers=headers)
+    assert rv.status_code == 200
+    client.get('/api/public_key', headers={'Authorization': f'Bearer {os.getenv("AUTH_TOKEN")}'})  # Not captured
+    assert capture.flush()
+    capture.close()
+
+    with open(tmp_path / 'traffic.jsonl') as f:
+        events, challenge = [json.loads(line) for line in f]
+    assert [events['path'], challenge['path']] == ['/api/challenge/events', '/api/challenge']
+    assert events['session'] == challenge['session'] == capture.pseudonym('secret-session') != 'secret-session'
+    assert [key['key'] for key in events['body']['interactions']['keyPresses']] == ['a', '0', '.', 'Backspace']
+    assert challenge['body'] == {'data': payload, 'save': False}
+    assert challenge['user_agent'] == 'Mozilla/5.0 (X11; Linux x86_64)'
+    assert challenge['score'] == jwt.decode(rv.get_json()['token'], options={'verify_signature': False})['score']
+    assert challenge['status'] == 200 and challenge['latency_ms'] > 0 and challenge['time'] >= events['time']
+    assert os.getenv('PUBLIC_AUTH_TOKEN') not in json.dumps([events, challenge])
+
+def test_traffic_capture_rotation_and_replay_requests(tmp_path):
+    """Test capture files rotate, sessions are sampled as a whole and the replay tool rebuilds requests in order."""
+    import time
+    from src.traffic_capture import TrafficCapture
+    from benchmarks.replay_traffic import load_capture, build_request
+    path = str(tmp_path / 'traffic.jsonl')
+    capture = TrafficCapture(path, max_bytes=2000, backups=2)
+    body = json.dumps({'data': {'interactions': {}, 'duration': 1000}, 'save': True}).encode('utf-8')
+    for i in range(40):
+        capture.record('POST', '/api/challenge', time.perf_counter(), body, 'test-agent', f'session-{i}', None, 400, b'{}')
+        assert capture.flush()
+    capture.close()
+    assert sorted(os.listdir(tmp_path)) == ['traffic.jsonl', 'traffic.jsonl.1', 'traffic.jsonl.2']
+    assert capture.stats()['rotations'] > 2
+    assert all(os.path.getsize(tmp_path / name) <= 2000 for name in os.listdir(tmp_path))
+
+    # Every request of a session gets the same sampling decision
+    sampled = TrafficCapture(None, sample_rate=0.5)
+    for i in range(20):
+        session = sampled.pseudonym(f'session-{i}')
+        assert len({sampled._sampled(session) for _ in range(5)}) == 1
+
+    records = load_capture([path, path + '.2', path + '.1'])
+    times = [record['time'] for record in records]
+    assert times == sorted(times) and len(records) < 40
+    request = build_request('127.0.0.1:5000', records[0], 'token')
+    head, _, sent = request.partition(b'\r\n\r\n')
+    assert json.loads(sent) == {'data': {'interactions': {}, 'duration': 1000}}  # save is dropped by default
+    assert f'Cookie: session_id={records[0]["session"]}'.encode('latin-1') in head
+    assert b'Authorization: Bearer token' in head
+
+def test_cold_start_imports(tmp_path):
+    """Test the web worker without a model and list_labels.py start without the ML stack."""
+    from benchmarks.import_time_bench import SCENARIOS, TARGETS_FILE, loaded_modules
+    with open(TARGETS_FILE) as f:
+        targets = json.load(f)
+    os.makedirs(tmp_path / 'data')
+    for scenario in ['web worker', 'list_labels.py']:
+        modules = loaded_modules(SCENARIOS[scenario], str(tmp_path))
+        assert not set(modules) & set(targets[scenario]['forbidden_modules']), (scenario, modules)
+    assert 'torch' in targets['list_labels.py']['forbidden_modules']
+
+def test_profile_endpoint(client):
+    """Test the profiler samples the stacks of busy request threads, within its caps and only for admins."""
+    import threading
+    import main
+    from model.model_definitions import NeuralNet
+    from src.device_encoder import DeviceEncoder
+    from src.extract_features import FEATURE_COUNT
+    from src.handlers.challenge import score_interaction
+    encoder = DeviceEncoder(['Other'])
+    model = NeuralNet(FEATURE_COUNT + encoder.width).eval()
+    payload = {'interactions': {'mouseMovements': [{'x': i, 'y': i, 'time': i * 16} for i in range(200)]}, 'duration': 5000}
+    stop = threading.Event()
+
+    def busy():
+        while not stop.is_set():
+            score_interaction(payload, 'Mozilla/5.0 (X11; Linux x86_64)', model, encoder)
+
+    worker = threading.Thread(target=busy)
+    worker.start()
+    headers = {'Authorization': f'Bearer {os.getenv("AUTH_TOKEN")}'}
+    try:
+        rv = client.get('/api/admin/profile?seconds=0.5&interval_ms=5', headers=headers)
+        rv_lines = client.get('/api/admin/profile?seconds=0.3&interval_ms=5&lines=1&format=json', headers=headers)
+    finally:
+        stop.set()
+        worker.join()
+
+    assert rv.status_code == 200
+    assert rv.headers['Content-Type'].startswith('text/plain')
+    assert int(rv.headers['X-Profile-Samples']) > 0
+    stacks = dict(line.rsplit(' ', 1) for line in rv.get_data(as_text=True).splitlines())
+    assert any(stack.endswith('src/handlers/challenge.py:score_interaction') or
+               'src/handlers/challenge.py:score_interaction;' in stack for stack in stacks)
+    assert all(int(count) > 0 for count in stacks.values())
+    result = rv_lines.get_json()
+    assert result['samples'] > 0 and 0 <= result['overhead'] < 1
+    assert any('src/handlers/challenge.py:score_interaction:' in stack for stack in result['stacks'])
+
+    assert client.get('/api/admin/profile?seconds=0.1').status_code == 401
+    assert client.get(f'/api/admin/profile?seconds={main.profiler.max_seconds + 1}', headers=headers).status_code == 400
+    assert client.get('/api/admin/profile?seconds=0.1&interval_ms=0.01', headers=headers).status_code == 400
+    assert client.get('/api/admin/profile?seconds=0.1&format=svg', headers=headers).status_code == 400
+    with main.profiler._running:
+        assert client.get('/api/admin/profile?seconds=0.1', headers=headers).status_code == 409
@@ -14,11 +14,12 @@ class InteractionDataset(Dataset):
         return torch.tensor(self.data[idx], dtype=torch.float32), torch.tensor(self.labels[idx], dtype=torch.float32)
 
 class NeuralNet(nn.Module):
-    def __init__(self, input_size = 13):
+    def __init__(self, input_size = 13, hidden_sizes = (64, 32)):
         super(NeuralNet, self).__init__()
-        self.fc1 = nn.Linear(input_size, 64)  # First fully connected layer with 64 neurons
-        self.fc2 = nn.Linear(64, 32)  # Second fully connected layer with 32 neurons
-        self.fc3 = nn.Linear(32, 1)  # Output layer with 1 neuron for binary classification
+        self.hidden_sizes = tuple(hidden_sizes)  # Recorded in the bundle manifest to rebuild the model
+        self.fc1 = nn.Linear(input_size, hidden_sizes[0])  # First fully connected layer (64 neurons by default)
+        self.fc2 = nn.Linear(hidden_sizes[0], hidden_sizes[1])  # Second fully connected layer (32 neurons by default)
+        self.fc3 = nn.Linear(hidden_sizes[1], 1)  # Output layer with 1 neuron for binary classification
         self.sigmoid = nn.Sigmoid()  # Sigmoid activation function for binary classification
 
     def forward(self, x):
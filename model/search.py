@@ -0,0 +1,177 @@
+import sys
+import os
+import json
+import time
+import random
+import argparse
+import itertools
+import warnings
+import torch
+import torch.multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from torch.utils.data import TensorDataset
+from sklearn.model_selection import StratifiedKFold
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from model.model_definitions import NeuralNet
+from model.train import load_data, fit_network, network_accuracy, train
+
+##################
+# Hyperparameter search
+#
+# Runs k-fold cross-validation of every candidate setting of the search space (the full grid,
+# or --random N samples of it) in a pool of worker processes, each limited to
+# --threads-per-worker torch threads. The feature matrix is loaded once and put in shared
+# memory, so workers index into the same pages instead of each loading the data; the fold
+# splits are shared the same way, so a task only names its candidate and fold.
+# Every candidate is then timed on single-sample inference of its frozen model, the way the
+# server runs it, and the most accurate candidate within the latency budget is selected
+# (fewest parameters on ties). Results are written to --output; --train retrains the
+# selected setting on the usual 80/20 split and publishes it as a model bundle.
+#
+# to run this, run `python model/search.py [--random 20] [--folds 5] [--latency-budget-us 100] [--train]`
+##################
+
+SEARCH_SPACE = {
+    'hidden_sizes': [[16, 8], [32, 16], [64, 32], [128, 64]],
+    'lr': [0.0003, 0.001, 0.003],
+    'epochs': [10, 20, 40],
+    'batch_size': [16, 32, 64]
+}
+ACCURACY_GOAL = 0.95
+LATENCY_SAMPLES = 2000
+RESULTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'search_results.json')
+
+# Set in every worker by _init_worker
+_features = None
+_labels = None
+_splits = None
+
+
+def candidates(space=SEARCH_SPACE, samples=None, seed=0):
+    # The full grid, or `samples` settings drawn from it without replacement
+    grid = [dict(zip(space, values)) for values in itertools.product(*space.values())]
+    if samples is not None and samples < len(grid):
+        grid = random.Random(seed).sample(grid, samples)
+    return grid
+
+
+def _init_worker(features, labels, splits, threads):
+    global _features, _labels, _splits
+    torch.set_num_threads(threads)
+    _features, _labels, _splits = features, labels, splits
+
+
+def _fit_fold(candidate_index, config, fold, seed):
+    # Runs in a worker: trains one candidate on one fold and scores it on the held-out part
+    torch.manual_seed(seed)
+    train_index, test_index = _splits[fold]
+    model = fit_network(
+        TensorDataset(_features[train_index], _labels[train_index]), _features.shape[1], config, verbose=False
+    )
+    return candidate_index, network_accuracy(model, TensorDataset(_features[test_index], _labels[test_index]))
+
+
+def inference_latency_us(input_size, hidden_sizes, samples=LATENCY_SAMPLES):
+    # Single-sample latency of the frozen model, as loaded by the server; does not depend on the weights
+    model = NeuralNet(input_size, hidden_sizes).eval()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', FutureWarning)
+        frozen = torch.jit.freeze(torch.jit.script(model))
+    sample = torch.rand(1, input_size)
+    with torch.no_grad():
+        for _ in range(samples // 10):
+            frozen(sample)
+        start = time.perf_counter()
+        for _ in range(samples):
+            frozen(sample)
+    return (time.perf_counter() - start) / samples * 1e6
+
+
+def search(X, y, configs, folds=5, jobs=None, threads_per_worker=1, seed=42):
+    # Returns one result per config: settings, mean/min fold accuracy, parameter count and latency
+    features = torch.tensor(X, dtype=torch.float32).share_memory_()
+    labels = torch.tensor(y, dtype=torch.float32).share_memory_()
+    splits = [
+        (torch.from_numpy(train_index).share_memory_(), torch.from_numpy(test_index).share_memory_())
+        for train_index, test_index in StratifiedKFold(n_splits=folds, shuffle=True, random_state=seed).split(X, y)
+    ]
+
+    fold_accuracies = [[] for _ in configs]
+    context = torch.multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(
+        max_workers=jobs or os.cpu_count() or 1, mp_context=context,
+        initializer=_init_worker, initargs=(features, labels, splits, threads_per_worker)
+    ) as executor:
+        futures = [
+            executor.submit(_fit_fold, index, config, fold, seed + fold)
+            for index, config in enumerate(configs)
+            for fold in range(len(splits))
+        ]
+        for done, future in enumerate(futures, 1):
+            index, accuracy = future.result()
+            fold_accuracies[index].append(accuracy)
+            print(f'\r{done}/{len(futures)} folds trained', end='', flush=True)
+    print()
+
+    # Timed one after the other once the pool is gone, so workers do not skew the latencies
+    input_size = features.shape[1]
+    results = []
+    for config, accuracies in zip(configs, fold_accuracies):
+        model = NeuralNet(input_size, config['hidden_sizes'])
+        results.append({
+            'config': config,
+            'accuracy': sum(accuracies) / len(accuracies),
+            'min_fold_accuracy': min(accuracies),
+            'num_params': sum(p.numel() for p in model.parameters()),
+            'latency_us': inference_latency_us(input_size, config['hidden_sizes'])
+        })
+    return results
+
+
+def select(results, latency_budget_us=None):
+    # The most accurate candidate within the latency budget, fewest parameters on ties
+    eligible = [r for r in results if latency_budget_us is None or r['latency_us'] <= latency_budget_us]
+    if not eligible:
+        return None
+    return max(eligible, key=lambda r: (r['accuracy'], -r['num_params']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cross-validated hyperparameter search for the network')
+    parser.add_argument('--folds', type=int, default=5, help='cross-validation folds')
+    parser.add_argument('--random', type=int, help='evaluate this many random settings instead of the full grid')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='worker processes')
+    parser.add_argument('--threads-per-worker', type=int, default=1, help='torch threads of each worker')
+    parser.add_argument('--latency-budget-us', type=float, help='only select models at most this slow per sample')
+    parser.add_argument('--site', help='search on the interactions of this site only')
+    parser.add_argument('--output', default=RESULTS_FILE, help='where to write the results')
+    parser.add_argument('--train', action='store_true', help='train and publish the selected setting')
+    args = parser.parse_args()
+    data_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data'))
+
+    X, y, _ = load_data(data_dir, args.site)
+    configs = candidates(samples=args.random)
+    print(f'Cross-validating {len(configs)} settings x {args.folds} folds on {len(X)} samples with {args.jobs} workers')
+    results = search(X, y, configs, args.folds, args.jobs, args.threads_per_worker)
+
+    results.sort(key=lambda r: r['accuracy'], reverse=True)
+    for r in results:
+        goal = '*' if r['accuracy'] >= ACCURACY_GOAL else ' '
+        print(f"{goal} accuracy {r['accuracy'] * 100:6.2f}% (min fold {r['min_fold_accuracy'] * 100:6.2f}%)  "
+              f"{r['num_params']:>6} params  {r['latency_us']:6.1f} us/sample  {r['config']}")
+    best = select(results, args.latency_budget_us)
+    with open(args.output, 'w') as f:
+        json.dump({'latency_budget_us': args.latency_budget_us, 'best': best, 'results': results}, f, indent=2)
+    print(f'Results written to {args.output}')
+    if best is None:
+        sys.exit(f'No setting within the {args.latency_budget_us} us latency budget')
+    print(f"Selected {best['config']}: accuracy {best['accuracy'] * 100:.2f}%, {best['latency_us']:.1f} us/sample")
+    if best['accuracy'] < ACCURACY_GOAL:
+        print(f'Warning: the selected setting is below the {ACCURACY_GOAL * 100:.0f}% accuracy goal')
+
+    if args.train:
+        train(data_dir, args.site, best['config'])
+
+
+if __name__ == '__main__':
+    main()
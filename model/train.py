@@ -2,23 +2,47 @@ import sys
 import os
 import torch
 import json
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import torch.nn as nn
 import torch.optim as optim
 from torch.utils.data import DataLoader
 from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import OneHotEncoder
-import joblib
+from sklearn.linear_model import LogisticRegression
+from sklearn.preprocessing import StandardScaler
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from src.extract_features import UserInteractionData, extract_features
+from src.extract_features import UserInteractionData, extract_feature_vector, FEATURE_EXTRACTOR_VERSION, FEATURE_NAMES
+from src.cascade import Cascade, LinearScreen, STAGES
 from model.model_definitions import InteractionDataset, NeuralNet
+from src.model_bundle import save_bundle, prune_bundles, ARTIFACTS_DIR
+from src.tenants import site_artifacts_dir
+from src.device_encoder import DeviceEncoder
+from src import catalog
+from datetime import datetime, timezone
 
-# Function to load data from the data directory
-def load_data(data_dir):
+# Sites with fewer labelled interactions than this are left to the global model
+MIN_SITE_SAMPLES = int(os.getenv('MIN_SITE_SAMPLES', '500'))
+
+# Network and optimizer settings; model/search.py looks for better ones
+DEFAULT_CONFIG = {'hidden_sizes': [64, 32], 'lr': 0.001, 'epochs': 20, 'batch_size': 32}
+
+# The cascade linear screen only decides where it was at least this accurate on the training split
+CASCADE_TARGET_PRECISION = float(os.getenv('CASCADE_TARGET_PRECISION', '0.99'))
+
+# Function to load data from the data directory (only one site's interactions when site_id is given)
+def load_data(data_dir, site_id=None):
     X = []
     y = []
     device_types = []
     print(f"Loading data from {data_dir}")  # Debug statement to check the data directory    
-    for filename in os.listdir(data_dir):
+    indexed = catalog.index_legacy(data_dir)  # Once: files written before the catalog existed
+    if indexed:
+        print(f"Indexed {indexed} interactions into the catalog.")
+    # Only open the files the catalog knows to be labelled
+    filenames = [f'{interaction_id}.json' for interaction_id in catalog.labelled_interaction_ids(site_id)]
+    for filename in filenames:
         try:
             if filename.endswith('.json'):
                 file_path = os.path.join(data_dir, filename)
@@ -35,13 +59,16 @@ def load_data(data_dir):
                         mouse_clicks=interaction_data.get('mouseClicks', []),
                         duration=data['duration']
                     )
-                    features = extract_features(user_interaction_data)
-                    feature_values = list(features.__dict__.values())
+                    if data.get('features') is not None and data.get('feature_version') == FEATURE_EXTRACTOR_VERSION:
+                        # Streamed sessions only saved their last events; the record carries the session features
+                        feature_values = data['features']
+                    else:
+                        feature_values = extract_feature_vector(user_interaction_data)
 
-                    device_types.append(data['user_agent']['device'])
                     if 'label' in data and data['label'] is not None:
                         y.append(data['label'])  # Convert label to float
                         X.append(feature_values)
+                        device_types.append(data['user_agent']['device'])  # Keep device types aligned with X
                     else:
                         print(f"Warning: 'label' key not found or is None in {file_path}. Skipping this file.")
         except json.JSONDecodeError as e:
@@ -50,72 +77,205 @@ def load_data(data_dir):
         except KeyError as e:
             print(f"KeyError: {e} in file {file_path}")
             continue
+        except FileNotFoundError:
+            print(f"Warning: {filename} is in the catalog but not in {data_dir}. Run `python -m src.catalog rebuild`.")
+            continue
     print(f"Loaded {len(X)} samples.")  # Debug statement to check the number of loaded samples
 
-    # One-hot encode device types
-    encoder = OneHotEncoder(sparse_output=False)
-    device_types_encoded = encoder.fit_transform([[dt] for dt in device_types])
-    joblib.dump(encoder, 'model/onehot_encoder.pkl')  # Save the one-hot encoder
+    # One-hot encode device types, rare ones into the unknown bucket (category table shipped in the model bundle)
+    encoder = DeviceEncoder.fit(device_types)
+    device_types_encoded = encoder.transform(device_types)
 
     # Append one-hot encoded device types to features
-    X = [x + list(device_types_encoded[i]) for i, x in enumerate(X)]
+    X = [x + device_types_encoded[i] for i, x in enumerate(X)]
 
-    return X, y
+    return X, y, encoder
 
-# Main function to train and evaluate the neural network
-def main():
-    data_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data'))
-    X, y = load_data(data_dir)
-    
-    # Split the data into training and testing sets
-    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
-    
-    # Create DataLoader for training and testing sets
-    train_dataset = InteractionDataset(X_train, y_train)
-    test_dataset = InteractionDataset(X_test, y_test)
-    train_loader = DataLoader(train_dataset, batch_size=32, shuffle=True)  # Batch size of 32 for training
-    test_loader = DataLoader(test_dataset, batch_size=32, shuffle=False)  # Batch size of 32 for testing
-    
-    # Initialize the neural network
-    input_size = len(X[0])
-    model = NeuralNet(input_size)
-    print(f"Training neural network with input size: {input_size}")  # Debug statement to check the input size
-    print(f"Training set size: {len(X_train)}")  # Debug statement to check the training set size
-    print(f"Number of features: {len(X[0])}")  # Debug statement to check the number of features
-    print(f"Number of params: {sum(p.numel() for p in model.parameters())}")  # Debug statement to check the number of parameters
+# Function to fit the linear screen of the scoring cascade (src/cascade.py) on the training split
+def train_linear(X_train, y_train, target_precision=CASCADE_TARGET_PRECISION):
+    if len(set(y_train)) < 2:
+        return None  # Nothing to separate
+    # Standardize for the solver, then fold the scaling into the weights so serving needs no scaler
+    scaler = StandardScaler().fit(X_train)
+    regression = LogisticRegression(max_iter=1000).fit(scaler.transform(X_train), y_train)
+    weights = regression.coef_[0] / scaler.scale_
+    bias = regression.intercept_[0] - float((weights * scaler.mean_).sum())
+    linear = LinearScreen(weights.tolist(), bias, -1.0, 2.0)
+    low, high = confident_thresholds([linear.probability(x) for x in X_train], y_train, target_precision)
+    linear.low, linear.high = low, high
+    return linear
+
+# Function to find the widest bands [0, low] and [high, 1] in which the linear screen reaches the target precision
+def confident_thresholds(probabilities, labels, target_precision):
+    ranked = sorted(zip(probabilities, labels))
+    low, high = -1.0, 2.0  # Never decides
+    correct = 0
+    for count, (probability, label) in enumerate(ranked, 1):
+        correct += label == 0
+        if correct / count >= target_precision:
+            low = probability
+    correct = 0
+    for count, (probability, label) in enumerate(reversed(ranked), 1):
+        correct += label == 1
+        if correct / count >= target_precision:
+            high = probability
+    # Keep the bands apart so no probability can fall in both
+    if low >= high:
+        low, high = -1.0, 2.0
+    return low, high
+
+# Function to replay the held-out split through the cascade and through the network alone
+def evaluate_cascade(model, linear, X_test, y_test):
+    cascade = Cascade.from_env()
+    cascade.enabled = True  # Evaluated even while serving has it off, to decide whether to turn it on
+    count_index, duration_index = FEATURE_NAMES.index('interaction_count'), FEATURE_NAMES.index('duration')
+    decided = {stage: [0, 0] for stage in STAGES}  # stage -> [decisions, correct decisions]
+    cascade_seconds = 0.0
+    network_seconds = 0.0
+    with torch.no_grad():
+        for x, label in zip(X_test, y_test):
+            started_at = time.perf_counter()
+            score = cascade.check_rules(x[count_index], x[duration_index])
+            stage = 'rules'
+            if score is None:
+                score, stage = cascade.check_linear(linear, x), 'linear'
+            if score is None:
+                score, stage = model(torch.tensor(x, dtype=torch.float32).unsqueeze(0)).item(), 'network'
+            cascade_seconds += time.perf_counter() - started_at
+            decided[stage][0] += 1
+            decided[stage][1] += (score > 0.5) == (label == 1)
+
+            started_at = time.perf_counter()
+            model(torch.tensor(x, dtype=torch.float32).unsqueeze(0))
+            network_seconds += time.perf_counter() - started_at
+
+    total = len(X_test)
+    return {
+        'stages': {
+            stage: {'share': count / total, 'accuracy': correct / count if count else None}
+            for stage, (count, correct) in decided.items()
+        },
+        'accuracy': sum(correct for _, correct in decided.values()) / total,
+        'latency_us': cascade_seconds / total * 1e6,
+        'network_latency_us': network_seconds / total * 1e6
+    }
+
+# Function to train a network with the given settings on a dataset of (features, label) pairs
+def fit_network(train_dataset, input_size, config=DEFAULT_CONFIG, verbose=True):
+    train_loader = DataLoader(train_dataset, batch_size=config['batch_size'], shuffle=True)
+    model = NeuralNet(input_size, config['hidden_sizes'])
     criterion = nn.BCELoss()  # Binary Cross-Entropy Loss for binary classification
-    optimizer = optim.Adam(model.parameters(), lr=0.001)  # Adam optimizer with learning rate of 0.001
-    
-    # Train the neural network
-    num_epochs = 20  # Number of epochs for training
+    optimizer = optim.Adam(model.parameters(), lr=config['lr'])  # Adam optimizer
+
+    num_epochs = config['epochs']
     for epoch in range(num_epochs):
         model.train()
         for data, labels in train_loader:
             optimizer.zero_grad()  # Zero the gradients
             outputs = model(data)  # Forward pass
-            loss = criterion(outputs.squeeze(), labels)  # Compute the loss
+            loss = criterion(outputs.view(-1), labels)  # Compute the loss
             loss.backward()  # Backward pass
             optimizer.step()  # Update the weights
-        
-        print(f'Epoch [{epoch+1}/{num_epochs}], Loss: {loss.item():.4f}')  # Print the loss for each epoch
-    
-    # Evaluate the neural network
+
+        if verbose:
+            print(f'Epoch [{epoch+1}/{num_epochs}], Loss: {loss.item():.4f}')  # Print the loss for each epoch
     model.eval()
+    return model
+
+# Function to compute the accuracy of a network on a dataset of (features, label) pairs
+def network_accuracy(model, test_dataset):
+    test_loader = DataLoader(test_dataset, batch_size=32, shuffle=False)  # Batch size of 32 for testing
     correct = 0
     total = 0
     with torch.no_grad():
         for data, labels in test_loader:
             outputs = model(data)
-            predicted = (outputs.squeeze() > 0.5).float()  # Convert probabilities to binary predictions
+            predicted = (outputs.view(-1) > 0.5).float()  # Convert probabilities to binary predictions
             total += labels.size(0)
             correct += (predicted == labels).sum().item()
+    return correct / total
+
+# Function to train and evaluate the neural network of one site, or the global one
+def train(data_dir, site_id=None, config=DEFAULT_CONFIG):
+    started_at = datetime.now(timezone.utc).isoformat()  # Labels arriving while training count towards the next run
+    X, y, encoder = load_data(data_dir, site_id)
+    
+    # Split the data into training and testing sets
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
+    
+    # Create datasets for training and testing sets
+    train_dataset = InteractionDataset(X_train, y_train)
+    test_dataset = InteractionDataset(X_test, y_test)
     
-    accuracy = correct / total  # Compute the accuracy
+    # Train the neural network
+    input_size = len(X[0])
+    print(f"Training neural network with input size: {input_size}, settings: {config}")  # Debug statement to check the input size
+    print(f"Training set size: {len(X_train)}")  # Debug statement to check the training set size
+    print(f"Number of features: {len(X[0])}")  # Debug statement to check the number of features
+    model = fit_network(train_dataset, input_size, config)
+    print(f"Number of params: {sum(p.numel() for p in model.parameters())}")  # Debug statement to check the number of parameters
+    
+    # Evaluate the neural network
+    accuracy = network_accuracy(model, test_dataset)  # Compute the accuracy
     print(f'Model accuracy: {accuracy * 100:.2f}%')  # Print the accuracy
+
+    # Fit the cascade linear screen and evaluate the cascade against the network alone
+    linear = train_linear(X_train, y_train)
+    cascade_metrics = evaluate_cascade(model, linear, X_test, y_test)
+    for stage, stage_metrics in cascade_metrics['stages'].items():
+        stage_accuracy = f"{stage_metrics['accuracy'] * 100:.2f}%" if stage_metrics['accuracy'] is not None else '-'
+        print(f"Cascade {stage}: decides {stage_metrics['share'] * 100:.1f}% of the test set, accuracy {stage_accuracy}")
+    print(f"Cascade accuracy: {cascade_metrics['accuracy'] * 100:.2f}% in {cascade_metrics['latency_us']:.1f}us/sample "
+          f"(network alone: {accuracy * 100:.2f}% in {cascade_metrics['network_latency_us']:.1f}us/sample)")
     
-    # Save the trained model weights and the one-hot encoder
-    torch.save(model.state_dict(), 'model/neural_net_model_weights.pth')  # Save the model weights
-    print('Model weights and one-hot encoder saved to model/neural_net_model_weights.pth and model/onehot_encoder.pkl')
+    # Save the frozen model, the encoder categories and the metrics as one versioned bundle
+    metrics = {
+        'accuracy': accuracy,
+        'train_samples': len(X_train),
+        'test_samples': len(X_test),
+        'num_params': sum(p.numel() for p in model.parameters()),
+        'config': config,
+        'cascade': cascade_metrics
+    }
+    artifacts_dir = site_artifacts_dir(site_id) if site_id is not None else ARTIFACTS_DIR
+    bundle_path = save_bundle(model, encoder, metrics, artifacts_dir, linear)
+    prune_bundles(artifacts_dir=artifacts_dir)
+    catalog.record_training_run(len(X), os.path.basename(bundle_path), started_at, site_id)
+    print(f'Model bundle saved to {bundle_path}')
+    return bundle_path
+
+def _train_site(data_dir, site_id):
+    # Runs in a worker process; the workers share the CPUs
+    torch.set_num_threads(1)
+    return train(data_dir, site_id)
+
+# Main function: `python model/train.py` trains the global model, `--site <site_id>` one site's model and
+# `--all-sites [--jobs N]` the global model and every site with at least MIN_SITE_SAMPLES labelled interactions
+def main():
+    parser = argparse.ArgumentParser(description='Train the global model and/or per-site models')
+    parser.add_argument('--site', help='train only the model of this site')
+    parser.add_argument('--all-sites', action='store_true', help='train the global model and every site model')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='site models trained in parallel')
+    args = parser.parse_args()
+    data_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data'))
+
+    if args.site:
+        train(data_dir, args.site)
+        return
+    train(data_dir)
+    if not args.all_sites:
+        return
+
+    sites = sorted(site_id for site_id, count in catalog.labelled_counts_by_site().items() if count >= MIN_SITE_SAMPLES)
+    print(f"Training {len(sites)} site models with {args.jobs} workers")
+    # spawn, so the workers do not inherit this process's catalog connection
+    with ProcessPoolExecutor(max_workers=args.jobs, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {executor.submit(_train_site, data_dir, site_id): site_id for site_id in sites}
+        for future in as_completed(futures):
+            try:
+                print(f"Site {futures[future]}: model bundle saved to {future.result()}")
+            except Exception as e:
+                print(f"Site {futures[future]}: training failed: {e}")
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
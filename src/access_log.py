@@ -0,0 +1,195 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import threading
+from datetime import datetime, timezone
+
+##################
+# Asynchronous access log
+#
+# Request threads only enqueue a small tuple (method, path, status, latency, sizes, stage
+# timings, ...) on a bounded queue; a background listener thread formats the records as JSON
+# lines and writes them in batches. Successful challenges can be sampled
+# (ACCESS_LOG_SAMPLE_RATE, the rate is written with each sampled record so counts can be
+# scaled back up). Errors (status >= 400) are never sampled out, and when the queue is full
+# they are written by the request thread itself instead of being dropped; other records are
+# dropped and counted.
+#
+# ACCESS_LOG is the file to append to or '-' for stdout; the log is off when it is unset or empty.
+##################
+
+SAMPLED_PATHS = ('/api/challenge', '/api/challenge/events')
+_STOP = object()
+
+
+class StageTimer:
+    # Time spent in each named stage of a request, marked in order; kept in seconds until formatted
+    __slots__ = ('stages', '_last')
+
+    def __init__(self):
+        self.stages = {}
+        self._last = time.perf_counter()
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.stages[stage] = now - self._last
+        self._last = now
+
+
+class AccessLog:
+    def __init__(self, path=None, sample_rate=1.0, queue_size=10000, batch_size=256, flush_interval=1.0):
+        self.path = path or None
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._write_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._file = None
+        self.enqueued = 0
+        self.sampled_out = 0
+        self.dropped = 0
+        self.written_inline = 0
+        self.written = 0
+        self._listener = None
+        if self.path is not None:
+            self._listener = threading.Thread(target=self._listen, name='access-log', daemon=True)
+            self._listener.start()
+            atexit.register(self.close)
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            path=os.getenv('ACCESS_LOG'),
+            sample_rate=float(os.getenv('ACCESS_LOG_SAMPLE_RATE', '1.0')),
+            queue_size=int(os.getenv('ACCESS_LOG_QUEUE_SIZE', '10000')),
+            batch_size=int(os.getenv('ACCESS_LOG_BATCH_SIZE', '256')),
+            flush_interval=float(os.getenv('ACCESS_LOG_FLUSH_SECONDS', '1.0'))
+        )
+
+    def _count(self, counter):
+        with self._stats_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def record(self, method, path, status, started_at, request_bytes=None, response_bytes=None,
+               remote_addr=None, user_agent=None, referer=None, stages=None):
+        # Called on the request thread: no formatting, no I/O unless an error finds the queue full
+        if self.path is None:
+            return
+        latency = time.perf_counter() - started_at
+        sample_rate = None
+        if status < 400 and self.sample_rate < 1 and path in SAMPLED_PATHS:
+            if random.random() >= self.sample_rate:
+                self._count('sampled_out')
+                return
+            sample_rate = self.sample_rate
+        entry = (time.time(), method, path, status, latency, request_bytes, response_bytes,
+                 remote_addr, user_agent, referer, stages, sample_rate)
+        try:
+            self._queue.put_nowait(entry)
+            self._count('enqueued')
+        except queue.Full:
+            if status >= 400:
+                self._write([entry])
+                self._count('written_inline')
+            else:
+                self._count('dropped')
+
+    def _format(self, entry):
+        (timestamp, method, path, status, latency, request_bytes, response_bytes,
+         remote_addr, user_agent, referer, stages, sample_rate) = entry
+        line = {
+            'time': datetime.fromtimestamp(timestamp, timezone.utc).isoformat(timespec='milliseconds'),
+            'remote_addr': remote_addr,
+            'method': method,
+            'path': path,
+            'status': status,
+            'latency_ms': round(latency * 1000, 3),
+            'request_bytes': request_bytes,
+            'response_bytes': response_bytes,
+            'user_agent': user_agent,
+            'referer': referer
+        }
+        if stages:
+            line['stages_ms'] = {stage: round(seconds * 1000, 3) for stage, seconds in stages.items()}
+        if sample_rate is not None:
+            line['sample_rate'] = sample_rate
+        return json.dumps(line)
+
+    def _write(self, entries):
+        data = ''.join(self._format(entry) + '\n' for entry in entries)
+        with self._write_lock:
+            try:
+                if self.path == '-':
+                    sys.stdout.write(data)
+                    sys.stdout.flush()
+                else:
+                    if self._file is None:
+                        self._file = open(self.path, 'a')
+                    self._file.write(data)
+                    self._file.flush()
+            except (OSError, ValueError) as e:
+                logging.error(f'Failed to write {len(entries)} access log records: {e}')
+                return
+        with self._stats_lock:
+            self.written += len(entries)
+
+    def _listen(self):
+        while True:
+            try:
+                entry = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            if entry is _STOP:
+                return
+            batch = [entry]
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    entry = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if entry is _STOP:
+                    stop = True
+                    break
+                batch.append(entry)
+            self._write(batch)
+            if stop:
+                return
+
+    def flush(self, timeout=5.0):
+        # Waits until every record enqueued so far has been written
+        deadline = time.monotonic() + timeout
+        while self._listener is not None and time.monotonic() < deadline:
+            with self._stats_lock:
+                if self.written >= self.enqueued + self.written_inline:
+                    return True
+            time.sleep(0.005)
+        return self._listener is None
+
+    def close(self):
+        if self._listener is None or not self._listener.is_alive():
+            return
+        self._queue.put(_STOP)
+        self._listener.join(timeout=5.0)
+        with self._write_lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'enqueued': self.enqueued,
+                'written': self.written,
+                'sampled_out': self.sampled_out,
+                'dropped': self.dropped,
+                'written_inline': self.written_inline,
+                'queued': self._queue.qsize(),
+                'sample_rate': self.sample_rate
+            }
@@ -0,0 +1,103 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+##################
+# Admission control for /api/challenge
+#
+# Runs before any validation, user agent parsing, feature extraction, inference or signing:
+#   - per client IP and per session_id token buckets (rate + burst)
+#   - a global limit on challenges being processed concurrently
+# Buckets live in a sharded table, each shard with its own lock, and are evicted once
+# they have been idle for longer than the TTL.
+##################
+
+
+class TokenBucketTable:
+    def __init__(self, rate, burst, ttl=300, shards=64):
+        self.rate = rate
+        self.burst = burst
+        self.ttl = ttl
+        self._shards = [(OrderedDict(), threading.Lock()) for _ in range(shards)]
+
+    def allow(self, key, now=None):
+        if now is None:
+            now = time.monotonic()
+        buckets, lock = self._shards[hash(key) % len(self._shards)]
+        with lock:
+            bucket = buckets.get(key)
+            if bucket is None:
+                tokens = self.burst
+            else:
+                tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                buckets.move_to_end(key)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            buckets[key] = (tokens, now)
+
+            # Entries are kept in last-access order, so expired ones are at the front
+            expired_before = now - self.ttl
+            while buckets:
+                oldest_key = next(iter(buckets))
+                if buckets[oldest_key][1] >= expired_before:
+                    break
+                del buckets[oldest_key]
+        return allowed
+
+    def __len__(self):
+        return sum(len(buckets) for buckets, _ in self._shards)
+
+
+class AdmissionController:
+    def __init__(self, ip_rate, ip_burst, session_rate, session_burst, max_concurrent, ttl=300, shards=64):
+        self.ip_buckets = TokenBucketTable(ip_rate, ip_burst, ttl, shards)
+        self.session_buckets = TokenBucketTable(session_rate, session_burst, ttl, shards)
+        self.max_concurrent = max_concurrent
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._stats_lock = threading.Lock()
+        self.admitted = 0
+        self.rejected_rate_limited = 0
+        self.rejected_overloaded = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            ip_rate=float(os.getenv('RATE_LIMIT_IP_PER_SECOND', '10')),
+            ip_burst=float(os.getenv('RATE_LIMIT_IP_BURST', '30')),
+            session_rate=float(os.getenv('RATE_LIMIT_SESSION_PER_SECOND', '5')),
+            session_burst=float(os.getenv('RATE_LIMIT_SESSION_BURST', '15')),
+            max_concurrent=int(os.getenv('MAX_CONCURRENT_CHALLENGES', '64')),
+            ttl=float(os.getenv('RATE_LIMIT_TTL_SECONDS', '300'))
+        )
+
+    def _count(self, counter):
+        with self._stats_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def admit(self, ip, session_id=None):
+        # Returns None when admitted (the caller must call release()), otherwise the rejection reason
+        now = time.monotonic()
+        if not self.ip_buckets.allow(ip, now) or (session_id and not self.session_buckets.allow(session_id, now)):
+            self._count('rejected_rate_limited')
+            return 'rate_limited'
+        if not self._slots.acquire(blocking=False):
+            self._count('rejected_overloaded')
+            return 'overloaded'
+        self._count('admitted')
+        return None
+
+    def release(self):
+        self._slots.release()
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'admitted': self.admitted,
+                'rejected_rate_limited': self.rejected_rate_limited,
+                'rejected_overloaded': self.rejected_overloaded,
+                'tracked_ips': len(self.ip_buckets),
+                'tracked_sessions': len(self.session_buckets),
+                'max_concurrent': self.max_concurrent
+            }
@@ -0,0 +1,129 @@
+import os
+import math
+import time
+import threading
+from typing import List
+from src.extract_features import STREAM_KERNELS
+
+##################
+# Cheap-first cascade scoring
+#
+# Challenges go through increasingly expensive stages and the first confident one decides:
+#   1. rules   - constant-time checks on the event count and duration of the payload, before
+#                any feature extraction (bots submitting empty or near-empty payloads)
+#   2. linear  - a logistic regression trained alongside the network and shipped in the model
+#                bundle (linear.json); decides when its probability is outside [low, high], the
+#                band in which it was less accurate than the target precision in training
+#   3. network - the full NeuralNet forward
+# Only runs when a model is loaded; without one every challenge gets the 0.5 placeholder.
+# Off unless CASCADE_ENABLED=1: the rule thresholds are configured, not learned, so turning it
+# on changes scores. Training reports the accuracy of every stage on the held-out split to
+# check them against before enabling it.
+##################
+
+STAGES = ('rules', 'linear', 'network')
+STREAM_KEYS = tuple(kernel.key for kernel in STREAM_KERNELS)
+
+
+def count_events(interactions):
+    # Same count as the interaction_count feature, without extracting anything
+    return sum(len(interactions.get(key) or ()) for key in STREAM_KEYS)
+
+
+class CascadeRules:
+    def __init__(self, min_events=2, min_duration=100, bot_score=0.0):
+        # Payloads with fewer events than min_events or shorter than min_duration ms get bot_score
+        self.min_events = min_events
+        self.min_duration = min_duration
+        self.bot_score = bot_score
+
+    def decide(self, event_count, duration):
+        if event_count < self.min_events:
+            return self.bot_score
+        if duration is not None and duration < self.min_duration:
+            return self.bot_score
+        return None
+
+
+class LinearScreen:
+    def __init__(self, weights: List[float], bias: float, low: float, high: float):
+        self.weights = [float(weight) for weight in weights]
+        self.bias = float(bias)
+        self.low = low
+        self.high = high
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data['weights'], data['bias'], data['low'], data['high'])
+
+    def to_json(self):
+        return {'weights': self.weights, 'bias': self.bias, 'low': self.low, 'high': self.high}
+
+    def probability(self, vector: List[float]) -> float:
+        z = self.bias
+        for weight, value in zip(self.weights, vector):
+            z += weight * value
+        # Numerically stable logistic function
+        if z >= 0:
+            return 1.0 / (1.0 + math.exp(-z))
+        e = math.exp(z)
+        return e / (1.0 + e)
+
+    def decide(self, vector: List[float]):
+        probability = self.probability(vector)
+        if probability <= self.low or probability >= self.high:
+            return probability
+        return None
+
+
+class Cascade:
+    def __init__(self, rules=None, linear_enabled=True, enabled=True):
+        self.rules = rules if rules is not None else CascadeRules()
+        self.linear_enabled = linear_enabled
+        self.enabled = enabled
+        self._stats_lock = threading.Lock()
+        # stage -> [decisions, seconds spent scoring the challenges it decided]
+        self._stages = {stage: [0, 0.0] for stage in STAGES}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            rules=CascadeRules(
+                min_events=int(os.getenv('CASCADE_MIN_EVENTS', '2')),
+                min_duration=float(os.getenv('CASCADE_MIN_DURATION_MS', '100')),
+                bot_score=float(os.getenv('CASCADE_BOT_SCORE', '0.0'))
+            ),
+            linear_enabled=os.getenv('CASCADE_LINEAR', '1') == '1',
+            enabled=os.getenv('CASCADE_ENABLED', '0') == '1'
+        )
+
+    def check_rules(self, event_count, duration):
+        return self.rules.decide(event_count, duration) if self.enabled else None
+
+    def check_linear(self, linear, vector):
+        if not self.enabled or not self.linear_enabled or linear is None:
+            return None
+        return linear.decide(vector)
+
+    def record(self, stage, started_at):
+        elapsed = time.perf_counter() - started_at
+        with self._stats_lock:
+            counters = self._stages[stage]
+            counters[0] += 1
+            counters[1] += elapsed
+
+    def stats(self):
+        with self._stats_lock:
+            total = sum(decisions for decisions, _ in self._stages.values())
+            return {
+                'enabled': self.enabled,
+                'challenges': total,
+                'stages': {
+                    stage: {
+                        'decided': decisions,
+                        'share': decisions / total if total else 0.0,
+                        'mean_latency_us': seconds / decisions * 1e6 if decisions else 0.0
+                    }
+                    for stage, (decisions, seconds) in self._stages.items()
+                }
+            }
@@ -0,0 +1,338 @@
+import os
+import sys
+import json
+import sqlite3
+import logging
+import threading
+from datetime import datetime, timezone
+from src.extract_features import FEATURE_EXTRACTOR_VERSION
+
+##################
+# Dataset catalog
+#
+# A small SQLite index of every interaction stored in data/, kept up to date by the
+# store, challenge and update handlers, so label statistics and training selection
+# do not have to open every file. Label counts are maintained by triggers, so reading
+# them costs the same no matter how large the corpus grows.
+#
+# Files stored before the catalog existed are indexed once by index_legacy, which training and
+# list_labels.py run first; after that it only reads a flag. Files copied into data/ by hand
+# are indexed with `python -m src.catalog index`.
+#
+# to rebuild it from the files in data/, run `python -m src.catalog rebuild` from the root of the repo
+##################
+
+CATALOG_PATH = os.getenv('CATALOG_PATH', 'data/catalog.sqlite3')
+DATA_DIR = 'data'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS interactions (
+    interaction_id TEXT PRIMARY KEY,
+    timestamp TEXT,
+    label,
+    device TEXT,
+    feature_version INTEGER,
+    labelled_at TEXT,
+    site_id TEXT
+);
+CREATE INDEX IF NOT EXISTS interactions_labelled_at ON interactions(labelled_at);
+CREATE INDEX IF NOT EXISTS interactions_site_id ON interactions(site_id, label);
+
+CREATE TABLE IF NOT EXISTS label_counts (
+    label PRIMARY KEY,
+    count INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+
+CREATE TABLE IF NOT EXISTS training_runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    trained_at TEXT NOT NULL,
+    samples INTEGER,
+    bundle_version TEXT,
+    site_id TEXT
+);
+
+CREATE TRIGGER IF NOT EXISTS interactions_insert AFTER INSERT ON interactions BEGIN
+    INSERT INTO label_counts(label, count) SELECT NEW.label, 1 WHERE NEW.label IS NOT NULL
+        ON CONFLICT(label) DO UPDATE SET count = count + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS interactions_update AFTER UPDATE OF label ON interactions BEGIN
+    UPDATE label_counts SET count = count - 1 WHERE OLD.label IS NOT NULL AND label = OLD.label;
+    INSERT INTO label_counts(label, count) SELECT NEW.label, 1 WHERE NEW.label IS NOT NULL
+        ON CONFLICT(label) DO UPDATE SET count = count + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS interactions_delete AFTER DELETE ON interactions BEGIN
+    UPDATE label_counts SET count = count - 1 WHERE OLD.label IS NOT NULL AND label = OLD.label;
+END;
+"""
+
+UPSERT_INTERACTION = (
+    'INSERT INTO interactions(interaction_id, timestamp, label, device, feature_version, labelled_at, site_id) '
+    'VALUES (?, ?, ?, ?, ?, ?, ?) '
+    'ON CONFLICT(interaction_id) DO UPDATE SET timestamp = excluded.timestamp, label = excluded.label, '
+    'device = excluded.device, feature_version = excluded.feature_version, labelled_at = excluded.labelled_at, '
+    'site_id = excluded.site_id'
+)
+
+# Labels of interactions that may not be in the catalog yet: a missing row is inserted
+UPSERT_LABEL = (
+    'INSERT INTO interactions(interaction_id, timestamp, label, device, feature_version, labelled_at, site_id) '
+    'VALUES (?, ?, ?, ?, ?, ?, ?) '
+    'ON CONFLICT(interaction_id) DO UPDATE SET label = excluded.label, labelled_at = excluded.labelled_at'
+)
+
+# Columns added after the first release of the catalog, added to existing databases on connect
+MIGRATIONS = [
+    ('interactions', 'site_id', 'TEXT'),
+    ('training_runs', 'site_id', 'TEXT')
+]
+
+_local = threading.local()
+
+
+def _connection():
+    # One connection per thread and catalog path
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    connection = connections.get(CATALOG_PATH)
+    if connection is None:
+        directory = os.path.dirname(CATALOG_PATH)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = sqlite3.connect(CATALOG_PATH, timeout=30, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        _migrate(connection)
+        connection.executescript(SCHEMA)
+        connections[CATALOG_PATH] = connection
+    return connection
+
+
+def _migrate(connection):
+    # Runs before SCHEMA so its indexes can use the added columns
+    for table, column, column_type in MIGRATIONS:
+        columns = [row[1] for row in connection.execute(f'PRAGMA table_info({table})')]
+        if columns and column not in columns:
+            connection.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def record_interaction(interaction_id, timestamp, label, device, feature_version=FEATURE_EXTRACTOR_VERSION, site_id=None):
+    # Catalog failures are logged and never fail the request that stored the data
+    try:
+        _connection().execute(
+            UPSERT_INTERACTION,
+            (interaction_id, timestamp, label, device, feature_version, _now() if label is not None else None, site_id)
+        )
+    except sqlite3.Error as e:
+        logging.error(f'Failed to record interaction {interaction_id} in the catalog: {e}')
+
+
+def record_interactions(rows):
+    # Bulk import (generated or migrated data): rows of (interaction_id, timestamp, label, device, site_id).
+    # As in rebuild, the interaction timestamp stands in for when the label was set
+    connection = _connection()
+    connection.execute('BEGIN')
+    try:
+        connection.executemany(UPSERT_INTERACTION, [
+            (interaction_id, timestamp, label, device, FEATURE_EXTRACTOR_VERSION, timestamp if label is not None else None, site_id)
+            for interaction_id, timestamp, label, device, site_id in rows
+        ])
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+    connection.execute('COMMIT')
+
+
+def record_details(record):
+    # The catalog columns of a stored interaction record besides its id and label:
+    # (timestamp, device, feature_version, site_id)
+    return (
+        record.get('timestamp'),
+        (record.get('user_agent') or {}).get('device'),
+        record.get('feature_version', FEATURE_EXTRACTOR_VERSION),
+        record.get('site_id')
+    )
+
+
+def record_labels(labels, details=None):
+    # labels: {interaction_id: label}
+    # details: {interaction_id: record_details(record)}, used for interactions missing from the catalog
+    labelled_at = _now()
+    details = details or {}
+    connection = _connection()
+    try:
+        connection.execute('BEGIN')
+        rows = []
+        for interaction_id, label in labels.items():
+            timestamp, device, feature_version, site_id = details.get(interaction_id, (None, None, None, None))
+            rows.append((interaction_id, timestamp, label, device, feature_version, labelled_at, site_id))
+        connection.executemany(UPSERT_LABEL, rows)
+        connection.execute('COMMIT')
+    except sqlite3.Error as e:
+        if connection.in_transaction:
+            connection.execute('ROLLBACK')
+        logging.error(f'Failed to record {len(labels)} labels in the catalog: {e}')
+
+
+def record_training_run(samples, bundle_version=None, trained_at=None, site_id=None):
+    _connection().execute(
+        'INSERT INTO training_runs(trained_at, samples, bundle_version, site_id) VALUES (?, ?, ?, ?)',
+        (trained_at or _now(), samples, bundle_version, site_id)
+    )
+
+
+def label_counts():
+    rows = _connection().execute('SELECT label, count FROM label_counts WHERE count > 0 ORDER BY label')
+    return {label: count for label, count in rows}
+
+
+def class_balance():
+    counts = label_counts()
+    total = sum(counts.values())
+    return {label: count / total for label, count in counts.items()} if total else {}
+
+
+def last_training_run():
+    # Of the global model
+    return _connection().execute(
+        'SELECT trained_at FROM training_runs WHERE site_id IS NULL ORDER BY id DESC LIMIT 1'
+    ).fetchone()
+
+
+def labelled_since_last_train():
+    last_run = last_training_run()
+    if last_run is None:
+        return _connection().execute('SELECT COUNT(*) FROM interactions WHERE labelled_at IS NOT NULL').fetchone()[0]
+    return _connection().execute(
+        'SELECT COUNT(*) FROM interactions WHERE labelled_at > ?', (last_run[0],)
+    ).fetchone()[0]
+
+
+def labelled_interaction_ids(site_id=None):
+    # Every labelled interaction, or only those of one site
+    if site_id is None:
+        rows = _connection().execute('SELECT interaction_id FROM interactions WHERE label IS NOT NULL')
+    else:
+        rows = _connection().execute(
+            'SELECT interaction_id FROM interactions WHERE site_id = ? AND label IS NOT NULL', (site_id,)
+        )
+    return [interaction_id for (interaction_id,) in rows]
+
+
+def labelled_counts_by_site():
+    rows = _connection().execute(
+        'SELECT site_id, COUNT(*) FROM interactions WHERE site_id IS NOT NULL AND label IS NOT NULL GROUP BY site_id'
+    )
+    return {site_id: count for site_id, count in rows}
+
+
+def exists():
+    return os.path.exists(CATALOG_PATH)
+
+
+def index_missing(data_dir=DATA_DIR):
+    # Indexes the files of data_dir the catalog does not know, keeping the rows it has; returns how many
+    connection = _connection()
+    known = {interaction_id for (interaction_id,) in connection.execute('SELECT interaction_id FROM interactions')}
+    missing = [filename for filename in os.listdir(data_dir)
+               if filename.endswith('.json') and filename[:-len('.json')] not in known]
+    if not missing:
+        return 0
+    connection.execute('BEGIN')
+    try:
+        count = sum(_index_file(connection, data_dir, filename) for filename in missing)
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+    connection.execute('COMMIT')
+    return count
+
+
+def index_legacy(data_dir=DATA_DIR):
+    # One-time migration: indexes the files stored before the catalog existed; returns how many, 0 once done
+    connection = _connection()
+    if connection.execute("SELECT 1 FROM meta WHERE key = 'legacy_indexed'").fetchone():
+        return 0
+    count = index_missing(data_dir)
+    _mark_legacy_indexed(connection)
+    return count
+
+
+def _mark_legacy_indexed(connection):
+    connection.execute("INSERT OR REPLACE INTO meta(key, value) VALUES ('legacy_indexed', ?)", (_now(),))
+
+
+def rebuild(data_dir=DATA_DIR):
+    connection = _connection()
+    connection.execute('BEGIN')
+    try:
+        count = _rebuild(connection, data_dir)
+        _mark_legacy_indexed(connection)
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+    connection.execute('COMMIT')
+    return count
+
+
+def _rebuild(connection, data_dir):
+    connection.execute('DELETE FROM interactions')
+    connection.execute('DELETE FROM label_counts')
+    return sum(_index_file(connection, data_dir, filename) for filename in os.listdir(data_dir) if filename.endswith('.json'))
+
+
+def _index_file(connection, data_dir, filename):
+    # 1 if the file was indexed, 0 if it could not be read
+    file_path = os.path.join(data_dir, filename)
+    try:
+        with open(file_path, 'r') as f:
+            data = json.loads(f.read())
+    except (OSError, json.JSONDecodeError) as e:
+        logging.error(f'Skipping {file_path}: {e}')
+        return 0
+    label = data.get('label')
+    timestamp, device, feature_version, site_id = record_details(data)
+    # The files do not record when a label was set, so the interaction timestamp stands in for it
+    connection.execute(
+        UPSERT_INTERACTION,
+        (
+            data.get('interaction_id', filename[:-len('.json')]),
+            timestamp,
+            label,
+            device,
+            feature_version,
+            timestamp if label is not None else None,
+            site_id
+        )
+    )
+    return 1
+
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else 'stats'
+    if command == 'rebuild':
+        print(f'Catalog rebuilt with {rebuild()} interactions.')
+    elif command == 'index':
+        print(f'Indexed {index_missing()} interactions missing from the catalog.')
+    elif command == 'stats':
+        counts = label_counts()
+        for label, share in class_balance().items():
+            print(f'Label: {label}, Count: {counts[label]}, Share: {share * 100:.1f}%')
+        print(f'Labelled since last training run: {labelled_since_last_train()}')
+    else:
+        sys.exit(f'Unknown command {command}. Use rebuild, index or stats.')
+
+
+if __name__ == '__main__':
+    main()
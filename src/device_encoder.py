@@ -0,0 +1,49 @@
+from collections import Counter
+from typing import List
+
+##################
+# Device family one-hot encoding
+#
+# Maps a user agent device family to its one-hot slot with a dict lookup. The one-hot rows
+# are built once when the encoder is created, so encoding a request costs one lookup.
+# Families not seen in training (or seen fewer than MIN_DEVICE_SAMPLES times) go to the
+# unknown bucket, the last slot, instead of failing the request.
+# Training exports the category table into the model bundle (encoder.json).
+##################
+
+# Families seen fewer times than this in training are folded into the unknown bucket, so the
+# model learns a weight for it
+MIN_DEVICE_SAMPLES = 2
+
+
+class DeviceEncoder:
+    def __init__(self, categories: List[str], unknown_bucket: bool = True):
+        self.categories = [str(category) for category in categories]
+        self.unknown_bucket = unknown_bucket
+        self.width = len(self.categories) + (1 if unknown_bucket else 0)
+        self.index = {category: i for i, category in enumerate(self.categories)}
+        # Shared between requests, callers copy them (e.g. with list concatenation) and never mutate them
+        self._rows = {category: self._row(i) for category, i in self.index.items()}
+        self._unknown_row = self._row(len(self.categories) if unknown_bucket else None)
+
+    def _row(self, slot):
+        return [1.0 if i == slot else 0.0 for i in range(self.width)]
+
+    @classmethod
+    def fit(cls, families: List[str], min_samples: int = MIN_DEVICE_SAMPLES):
+        counts = Counter(str(family) for family in families)
+        return cls(sorted(family for family, count in counts.items() if count >= min_samples))
+
+    @classmethod
+    def from_json(cls, data):
+        # Bundles written before the unknown bucket existed have no 'unknown_bucket' key
+        return cls(data['categories'], data.get('unknown_bucket', False))
+
+    def to_json(self):
+        return {'categories': self.categories, 'unknown_bucket': self.unknown_bucket}
+
+    def encode(self, family: str) -> List[float]:
+        return self._rows.get(family, self._unknown_row)
+
+    def transform(self, families: List[str]) -> List[List[float]]:
+        return [list(self.encode(str(family))) for family in families]
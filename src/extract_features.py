@@ -1,6 +1,10 @@
 from typing import List, Dict
+from itertools import islice
 import math
 
+# Bump whenever a feature definition changes so stale model bundles are rejected
+FEATURE_EXTRACTOR_VERSION = 1
+
 class UserInteractionData:
     def __init__(self, 
         mouse_movements: List[Dict[str, float]], 
@@ -46,131 +50,303 @@ class ExtractedFeatures:
         self.duration = duration
 
 
-def extract_features(data: UserInteractionData) -> ExtractedFeatures:
-    avg_mouse_speed = calculate_avg_mouse_speed(data.mouse_movements)
-    avg_key_press_interval = calculate_avg_key_press_interval(data.key_presses)
-    avg_scroll_speed = calculate_avg_scroll_speed(data.scroll_events)
-    form_completion_time = calculate_form_completion_time(data.form_interactions)
-    interaction_count = len(data.mouse_movements) + len(data.key_presses) + len(data.scroll_events) + len(data.form_interactions) + len(data.touch_events) + len(data.mouse_clicks)
-    mouse_linearity = calculate_mouse_linearity(data.mouse_movements)
-    avg_touch_pressure = calculate_avg_touch_pressure(data.touch_events)
-    avg_touch_movement = calculate_avg_touch_movement(data.touch_events)
-    avg_click_duration = calculate_avg_click_duration(data.mouse_clicks)
-    avg_touch_duration = calculate_avg_touch_duration(data.touch_events)
-
-    return ExtractedFeatures(
-        avg_mouse_speed,
-        avg_key_press_interval,
-        avg_scroll_speed,
-        form_completion_time,
-        interaction_count,
-        mouse_linearity,
-        avg_touch_pressure,
-        avg_touch_movement,
-        avg_click_duration,
-        avg_touch_duration,
-        data.duration
-    )
-
-
-def calculate_avg_mouse_speed(mouse_movements: List[Dict[str, float]]) -> float:
-    if len(mouse_movements) < 2:
-        return 0
-    total_distance = 0
-    total_time = 0
-    for i in range(1, len(mouse_movements)):
-        dx = mouse_movements[i]['x'] - mouse_movements[i - 1]['x']
-        dy = mouse_movements[i]['y'] - mouse_movements[i - 1]['y']
-        dt = mouse_movements[i]['time'] - mouse_movements[i - 1]['time']
-        total_distance += math.sqrt(dx * dx + dy * dy)
-        total_time += dt
-    return total_distance / total_time
-
-
-def calculate_avg_key_press_interval(key_presses: List[Dict[str, float]]) -> float:
-    if len(key_presses) < 2:
-        return 0
-    total_interval = 0
-    for i in range(1, len(key_presses)):
-        total_interval += key_presses[i]['time'] - key_presses[i - 1]['time']
-    return total_interval / (len(key_presses) - 1)
+    def to_vector(self) -> List[float]:
+        return [getattr(self, name) for name in FEATURE_NAMES]
 
 
-def calculate_avg_scroll_speed(scroll_events: List[Dict[str, float]]) -> float:
-    if len(scroll_events) < 2:
-        return 0
-    total_scroll = 0
-    total_time = 0
-    for i in range(1, len(scroll_events)):
-        ds = scroll_events[i]['scrollTop'] - scroll_events[i - 1]['scrollTop']
-        dt = scroll_events[i]['time'] - scroll_events[i - 1]['time']
-        total_scroll += abs(ds)
-        total_time += dt
-    return total_scroll / total_time
-
-
-def calculate_form_completion_time(form_interactions: List[Dict[str, float]]) -> float:
-    if len(form_interactions) < 2:
-        return 0
-    return form_interactions[-1]['time'] - form_interactions[0]['time']
+##################
+# Fused feature engine
+#
+# Every event stream has a kernel that walks its events once and accumulates the
+# per-segment quantities the features need (segment lengths, time deltas, press pairs...).
+# Features are declared in FEATURES with the stream and quantities they read, and are
+# computed from the kernel state, so quantities shared by several features (e.g. the mouse
+# path length used by speed and linearity) are computed once. Kernels keep the last event
+# they saw, so a stream can be fed in several chunks and gives the same result as one pass.
+#
+# FEATURES defines the order of the feature vector used by serving and training.
+##################
 
+SESSION = 'session'
 
-def calculate_mouse_linearity(mouse_movements: List[Dict[str, float]]) -> float:
-    if len(mouse_movements) < 2:
-        return 0
-    start_x = mouse_movements[0]['x']
-    start_y = mouse_movements[0]['y']
-    end_x = mouse_movements[-1]['x']
-    end_y = mouse_movements[-1]['y']
-    total_distance = math.sqrt((end_x - start_x) ** 2 + (end_y - start_y) ** 2)
 
-    actual_distance = 0
-    for i in range(1, len(mouse_movements)):
-        dx = mouse_movements[i]['x'] - mouse_movements[i - 1]['x']
-        dy = mouse_movements[i]['y'] - mouse_movements[i - 1]['y']
-        actual_distance += math.sqrt(dx * dx + dy * dy)
+class StreamKernel:
+    # Payload key of the stream, matching UserInteractionData attribute, quantities it accumulates
+    key = None
+    attribute = None
+    quantities = ('count', 'first', 'last')
 
-    return total_distance / actual_distance
+    def __init__(self):
+        self.count = 0
+        self.first = None
+        self.last = None
 
+    def feed(self, events: List[Dict[str, float]]):
+        if not events:
+            return
+        if self.first is None:
+            self.first = events[0]
+        self._accumulate(events)
+        self.count += len(events)
+        self.last = events[-1]
 
-def calculate_avg_touch_pressure(touch_events: List[Dict[str, float]]) -> float:
-    if len(touch_events) == 0:
-        return 0
-    total_pressure = sum(event['force'] for event in touch_events)
-    return total_pressure / len(touch_events)
+    def _accumulate(self, events):
+        pass
 
+    def _start(self, events):
+        # (previous event, events to pair with it); the first pair may span the previous chunk
+        if self.last is None:
+            return events[0], islice(events, 1, None)
+        return self.last, events
 
-def calculate_avg_touch_movement(touch_events: List[Dict[str, float]]) -> float:
-    if len(touch_events) < 2:
-        return 0
-    total_movement = 0
-    for i in range(1, len(touch_events)):
-        dx = touch_events[i]['x'] - touch_events[i - 1]['x']
-        dy = touch_events[i]['y'] - touch_events[i - 1]['y']
-        total_movement += math.sqrt(dx * dx + dy * dy)
-    return total_movement / (len(touch_events) - 1)
 
+class MouseMovementKernel(StreamKernel):
+    key = 'mouseMovements'
+    attribute = 'mouse_movements'
+    quantities = StreamKernel.quantities + ('path_length', 'elapsed')
 
-def calculate_avg_click_duration(mouse_clicks: List[Dict[str, float]]) -> float:
-    if len(mouse_clicks) < 2:
-        return 0
-    total_duration = 0
-    click_count = 0
-    for i in range(1, len(mouse_clicks)):
-        if 'type' in mouse_clicks[i] and 'type' in mouse_clicks[i - 1]:
-            if mouse_clicks[i]['type'] == 'up' and mouse_clicks[i - 1]['type'] == 'down':
-                total_duration += mouse_clicks[i]['time'] - mouse_clicks[i - 1]['time']
-                click_count += 1
-    return total_duration / click_count if click_count > 0 else 0
-
-
-def calculate_avg_touch_duration(touch_events: List[Dict[str, float]]) -> float:
-    if len(touch_events) < 2:
+    def __init__(self):
+        super().__init__()
+        self.path_length = 0
+        self.elapsed = 0
+
+    def _accumulate(self, events):
+        path_length = self.path_length
+        elapsed = self.elapsed
+        sqrt = math.sqrt
+        previous, remaining = self._start(events)
+        for event in remaining:
+            dx = event['x'] - previous['x']
+            dy = event['y'] - previous['y']
+            path_length += sqrt(dx * dx + dy * dy)
+            elapsed += event['time'] - previous['time']
+            previous = event
+        self.path_length = path_length
+        self.elapsed = elapsed
+
+
+class KeyPressKernel(StreamKernel):
+    key = 'keyPresses'
+    attribute = 'key_presses'
+    quantities = StreamKernel.quantities + ('interval_sum',)
+
+    def __init__(self):
+        super().__init__()
+        self.interval_sum = 0
+
+    def _accumulate(self, events):
+        interval_sum = self.interval_sum
+        previous, remaining = self._start(events)
+        for event in remaining:
+            interval_sum += event['time'] - previous['time']
+            previous = event
+        self.interval_sum = interval_sum
+
+
+class ScrollKernel(StreamKernel):
+    key = 'scrollEvents'
+    attribute = 'scroll_events'
+    quantities = StreamKernel.quantities + ('scroll_sum', 'elapsed')
+
+    def __init__(self):
+        super().__init__()
+        self.scroll_sum = 0
+        self.elapsed = 0
+
+    def _accumulate(self, events):
+        scroll_sum = self.scroll_sum
+        elapsed = self.elapsed
+        previous, remaining = self._start(events)
+        for event in remaining:
+            scroll_sum += abs(event['scrollTop'] - previous['scrollTop'])
+            elapsed += event['time'] - previous['time']
+            previous = event
+        self.scroll_sum = scroll_sum
+        self.elapsed = elapsed
+
+
+class FormInteractionKernel(StreamKernel):
+    key = 'formInteractions'
+    attribute = 'form_interactions'
+
+
+class TouchKernel(StreamKernel):
+    key = 'touchEvents'
+    attribute = 'touch_events'
+    quantities = StreamKernel.quantities + ('force_sum', 'movement_sum', 'press_duration_sum', 'press_count')
+
+    def __init__(self):
+        super().__init__()
+        self.force_sum = 0
+        self.movement_sum = 0
+        self.press_duration_sum = 0
+        self.press_count = 0
+
+    def _accumulate(self, events):
+        force_sum = self.force_sum
+        movement_sum = self.movement_sum
+        press_duration_sum = self.press_duration_sum
+        press_count = self.press_count
+        for event in events:
+            force_sum += event['force']
+        sqrt = math.sqrt
+        previous, remaining = self._start(events)
+        for event in remaining:
+            dx = event['x'] - previous['x']
+            dy = event['y'] - previous['y']
+            movement_sum += sqrt(dx * dx + dy * dy)
+            if event['type'] == 'end' and previous['type'] == 'start':
+                press_duration_sum += event['time'] - previous['time']
+                press_count += 1
+            previous = event
+        self.force_sum = force_sum
+        self.movement_sum = movement_sum
+        self.press_duration_sum = press_duration_sum
+        self.press_count = press_count
+
+
+class MouseClickKernel(StreamKernel):
+    key = 'mouseClicks'
+    attribute = 'mouse_clicks'
+    quantities = StreamKernel.quantities + ('press_duration_sum', 'press_count')
+
+    def __init__(self):
+        super().__init__()
+        self.press_duration_sum = 0
+        self.press_count = 0
+
+    def _accumulate(self, events):
+        press_duration_sum = self.press_duration_sum
+        press_count = self.press_count
+        previous, remaining = self._start(events)
+        for event in remaining:
+            if 'type' in event and 'type' in previous:
+                if event['type'] == 'up' and previous['type'] == 'down':
+                    press_duration_sum += event['time'] - previous['time']
+                    press_count += 1
+            previous = event
+        self.press_duration_sum = press_duration_sum
+        self.press_count = press_count
+
+
+STREAM_KERNELS = [
+    MouseMovementKernel, KeyPressKernel, ScrollKernel, FormInteractionKernel, TouchKernel, MouseClickKernel
+]
+
+
+class Feature:
+    def __init__(self, name: str, stream: str, needs: tuple, compute):
+        self.name = name
+        self.stream = stream
+        self.needs = needs
+        self.compute = compute
+
+
+def _avg_mouse_speed(k):
+    return k.path_length / k.elapsed if k.count >= 2 else 0
+
+
+def _mouse_linearity(k):
+    if k.count < 2:
         return 0
-    total_duration = 0
-    touch_count = 0
-    for i in range(1, len(touch_events)):
-        if touch_events[i]['type'] == 'end' and touch_events[i - 1]['type'] == 'start':
-            total_duration += touch_events[i]['time'] - touch_events[i - 1]['time']
-            touch_count += 1
-    return total_duration / touch_count if touch_count > 0 else 0
+    straight_distance = math.sqrt((k.last['x'] - k.first['x']) ** 2 + (k.last['y'] - k.first['y']) ** 2)
+    return straight_distance / k.path_length
+
+
+def _avg_interval(k):
+    return k.interval_sum / (k.count - 1) if k.count >= 2 else 0
+
+
+def _avg_scroll_speed(k):
+    return k.scroll_sum / k.elapsed if k.count >= 2 else 0
+
+
+def _form_completion_time(k):
+    return k.last['time'] - k.first['time'] if k.count >= 2 else 0
+
+
+def _avg_touch_pressure(k):
+    return k.force_sum / k.count if k.count > 0 else 0
+
+
+def _avg_touch_movement(k):
+    return k.movement_sum / (k.count - 1) if k.count >= 2 else 0
+
+
+def _avg_press_duration(k):
+    return k.press_duration_sum / k.press_count if k.press_count > 0 else 0
+
+
+FEATURES = [
+    Feature('avg_mouse_speed', 'mouseMovements', ('path_length', 'elapsed'), _avg_mouse_speed),
+    Feature('avg_key_press_interval', 'keyPresses', ('interval_sum',), _avg_interval),
+    Feature('avg_scroll_speed', 'scrollEvents', ('scroll_sum', 'elapsed'), _avg_scroll_speed),
+    Feature('form_completion_time', 'formInteractions', ('first', 'last'), _form_completion_time),
+    Feature('interaction_count', SESSION, ('interaction_count',), lambda s: s.interaction_count),
+    Feature('mouse_linearity', 'mouseMovements', ('first', 'last', 'path_length'), _mouse_linearity),
+    Feature('avg_touch_pressure', 'touchEvents', ('force_sum',), _avg_touch_pressure),
+    Feature('avg_touch_movement', 'touchEvents', ('movement_sum',), _avg_touch_movement),
+    Feature('avg_click_duration', 'mouseClicks', ('press_duration_sum', 'press_count'), _avg_press_duration),
+    Feature('avg_touch_duration', 'touchEvents', ('press_duration_sum', 'press_count'), _avg_press_duration),
+    Feature('duration', SESSION, ('duration',), lambda s: s.duration)
+]
+
+
+def _check_registry():
+    # Fail at import time if a feature reads a quantity its stream kernel does not produce
+    quantities = {kernel.key: kernel.quantities for kernel in STREAM_KERNELS}
+    quantities[SESSION] = ('interaction_count', 'duration')
+    names = set()
+    for feature in FEATURES:
+        if feature.name in names:
+            raise ValueError(f'Feature {feature.name} is registered twice')
+        names.add(feature.name)
+        if feature.stream not in quantities:
+            raise ValueError(f'Feature {feature.name} reads unknown stream {feature.stream}')
+        missing = set(feature.needs) - set(quantities[feature.stream])
+        if missing:
+            raise ValueError(f'Feature {feature.name} needs {sorted(missing)} which {feature.stream} does not provide')
+
+
+_check_registry()
+
+FEATURE_NAMES = [feature.name for feature in FEATURES]
+
+# Number of values extract_features produces (device one-hot columns are appended after these)
+FEATURE_COUNT = len(FEATURES)
+
+
+class SessionAccumulator:
+    # Running state of every stream of one session
+    def __init__(self):
+        self.streams = {kernel.key: kernel() for kernel in STREAM_KERNELS}
+        self.duration = None
+
+    def feed(self, interactions: Dict[str, List[Dict[str, float]]]):
+        # interactions is shaped like the payload: {'mouseMovements': [...], 'keyPresses': [...], ...}
+        for key, events in interactions.items():
+            kernel = self.streams.get(key)
+            if kernel is not None:
+                kernel.feed(events)
+
+    @property
+    def interaction_count(self):
+        return sum(kernel.count for kernel in self.streams.values())
+
+    def feature_vector(self) -> List[float]:
+        return [
+            feature.compute(self if feature.stream == SESSION else self.streams[feature.stream])
+            for feature in FEATURES
+        ]
+
+
+def extract_feature_vector(data: UserInteractionData) -> List[float]:
+    session = SessionAccumulator()
+    for kernel in session.streams.values():
+        kernel.feed(getattr(data, kernel.attribute))
+    session.duration = data.duration
+    return session.feature_vector()
+
+
+def extract_features(data: UserInteractionData) -> ExtractedFeatures:
+    return ExtractedFeatures(*extract_feature_vector(data))
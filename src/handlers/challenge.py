@@ -1,22 +1,32 @@
-from flask import request, jsonify, make_response
+from flask import request, jsonify, make_response, g
 from flask_cors import cross_origin
-from jsonschema import validate, ValidationError
-from src.extract_features import extract_features, UserInteractionData
-from user_agents import parse
-import torch
+from jsonschema import ValidationError
+from jsonschema.validators import validator_for
+from jsonschema.exceptions import best_match
+from functools import lru_cache
+from src.extract_features import extract_feature_vector, UserInteractionData, FEATURE_EXTRACTOR_VERSION
+from src.cascade import count_events
+from src import catalog
+from src.validation_schemas import challenge_stream_schema
+from src.session_store import IncompleteStream, OutOfOrderChunk
 import uuid
 import json
-import jwt
 from datetime import datetime, timezone
 import logging
 import os
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
+import time
 
+# torch, user_agents, jwt and cryptography are imported on first use so importing the app stays fast
+# (see benchmarks/import_time_bench.py); once loaded, the import statements are dictionary lookups
 
-def captcha_challenge(PUBLIC_AUTH_TOKEN, interaction_payload_schema, model, encoder, PRIVATE_KEY):
+
+def captcha_challenge(PUBLIC_AUTH_TOKEN, interaction_payload_schema, model, encoder, PRIVATE_KEY, session_store=None, site_id=None,
+                      linear=None, cascade=None):
+    # site_id is set when the request was made with the public key of a site (see src/tenants.py)
+    # Stage timings go to the access log (g.stages, see src/access_log.py)
+    stages = g.get('stages')
     auth_header = request.headers.get('Authorization')
-    if not auth_header or auth_header.split()[1] != PUBLIC_AUTH_TOKEN:
+    if not auth_header or (auth_header.split()[1] != PUBLIC_AUTH_TOKEN and site_id is None):
         return jsonify({'error': 'Unauthorized'}), 401
 
     interaction_payload = request.json.get('data')
@@ -24,114 +34,238 @@ def captcha_challenge(PUBLIC_AUTH_TOKEN, interaction_payload_schema, model, enco
     if not interaction_payload:
         return jsonify({'error': 'No data provided'}), 400
 
-    # Validate the interaction payload
+    # Validate the interaction payload and the id of the stream it completes
+    error = (validate_interaction_payload(interaction_payload, interaction_payload_schema)
+             or validate_interaction_payload(request.json, challenge_stream_schema))
+    if stages is not None:
+        stages.mark('validate')
+    if error:
+        return jsonify({'error': error}), 400
+
+    # Get user agent from headers
+    user_agent_string = request.headers.get('User-Agent')
+
+    # Check for session_id cookie
+    session_id = request.cookies.get('session_id')
+    if not session_id:
+        session_id = str(uuid.uuid4())
+
+    # Events this page already streamed to /api/challenge/events
+    try:
+        session = take_streamed_session(session_store, request.json)
+    except IncompleteStream as e:
+        return jsonify({'error': 'Streamed events are incomplete on this worker', 'reason': str(e)}), 409
+
+    # Extract features and make prediction
+    score, user_agent = score_interaction(interaction_payload, user_agent_string, model, encoder, session, linear, cascade)
+    if stages is not None:
+        stages.mark('score')
+
+    # Generate interaction_id
+    interaction_id = str(uuid.uuid4())
+
+    # Save interaction data if requested
+    if save_interaction == True:
+        save_interaction_record(build_interaction_record(
+            session_id, interaction_id, interaction_payload, score, user_agent, request.headers.get('Referer', ''),
+            session.feature_vector() if session is not None else None, site_id
+        ))
+        if stages is not None:
+            stages.mark('save')
+
+    token = sign_token(score, interaction_id, PRIVATE_KEY)
+    if stages is not None:
+        stages.mark('sign')
+
+    response = make_response(jsonify({'token': token}))
+    response.set_cookie('session_id', session_id)
+    return response
+
+
+def captcha_challenge_events(PUBLIC_AUTH_TOKEN, interaction_chunk_schema, session_store, site_id=None):
+    auth_header = request.headers.get('Authorization')
+    if not auth_header or (auth_header.split()[1] != PUBLIC_AUTH_TOKEN and site_id is None):
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    chunk = request.json
+    error = validate_interaction_payload(chunk, interaction_chunk_schema)
+    if error:
+        return jsonify({'error': error}), 400
+
+    # Chunks are keyed by the stream id of the page, not the session cookie shared by every page of the browser
+    session_id = request.cookies.get('session_id')
+    if not session_id:
+        session_id = str(uuid.uuid4())
+    try:
+        interaction_count = session_store.feed(chunk['streamId'], chunk['interactions'], chunk['seq'])
+    except OutOfOrderChunk as e:
+        # The client resends its chunks from expectedSeq on
+        return jsonify({'error': 'Chunk out of order', 'reason': str(e), 'expectedSeq': e.expected_seq}), 409
+
+    response = make_response(jsonify({'interaction_count': interaction_count}))
+    response.set_cookie('session_id', session_id)
+    return response
+
+
+# The steps below do not depend on Flask so the asyncio server (asgi.py) can share them
+
+_validators = {}
+
+
+def _validator(schema):
+    # jsonschema.validate re-checks the schema itself on every call; build each validator once
+    cached = _validators.get(id(schema))
+    if cached is None or cached[0] is not schema:
+        cached = _validators[id(schema)] = (schema, validator_for(schema)(schema))
+    return cached[1]
+
+
+def validate_interaction_payload(interaction_payload, interaction_payload_schema):
     try:
-        validate(instance=interaction_payload, schema=interaction_payload_schema)
+        error = best_match(_validator(interaction_payload_schema).iter_errors(interaction_payload))
+        if error is not None:
+            raise error
     except json.JSONDecodeError:
         logging.error('Invalid JSON format')
-        return jsonify({'error': 'Invalid JSON format'}), 400
+        return 'Invalid JSON format'
     except ValidationError as e:
         logging.error(f'JSON validation error: {e.message}')
-        return jsonify({'error': f'JSON validation error: {e.message}'}), 400
+        return f'JSON validation error: {e.message}'
+    return None
+
+
+def take_streamed_session(session_store, body):
+    # The aggregates of the events streamed with body's streamId, or None for challenges that did not stream
+    # Chunks the page still had queued are folded first; those the store already folded are dropped by their seq
+    # Raises IncompleteStream when chunks of the stream went to another worker or a queued chunk skips one
+    stream_id = body.get('streamId')
+    if session_store is None or not stream_id:
+        return None
+    for chunk in body.get('chunks') or ():
+        session_store.feed(stream_id, chunk['interactions'], chunk['seq'])
+    return session_store.take(stream_id, body.get('streamedChunks'))
+
 
+def score_interaction(interaction_payload, user_agent_string, model, encoder, session=None, linear=None, cascade=None):
+    # session: the SessionAccumulator of events streamed earlier, if any; the payload holds the rest
+    # linear, cascade: the bundle's LinearScreen and the Cascade deciding which stage scores (see src/cascade.py)
     interaction_data = interaction_payload.get('interactions')
     duration = interaction_payload.get('duration')
-    viewport = interaction_payload.get('viewport')
-    load_timestamp = interaction_payload.get('loadTimestamp')
-    device_type = interaction_payload.get('deviceType')
-
-    # Get user agent from headers
-    user_agent_string = request.headers.get('User-Agent')
+    started_at = time.perf_counter()
 
     # Parse user agent
+    from user_agents import parse
     user_agent = parse(user_agent_string)
-    
-    # Convert interaction data to UserInteractionData object
-    user_interaction_data = UserInteractionData(
-        mouse_movements=interaction_data.get('mouseMovements', []),
-        key_presses=interaction_data.get('keyPresses', []),
-        scroll_events=interaction_data.get('scrollEvents', []),
-        form_interactions=interaction_data.get('formInteractions', []),
-        touch_events=interaction_data.get('touchEvents', []),
-        mouse_clicks=interaction_data.get('mouseClicks', []),
-        duration=duration
-    )
 
-    # Extract features
-    features = extract_features(user_interaction_data)
+    if session is not None:
+        session.feed(interaction_data)
+        session.duration = duration
+
+    # Obvious bots are scored from the event count and duration alone
+    if model is not None and cascade is not None:
+        event_count = session.interaction_count if session is not None else count_events(interaction_data)
+        score = cascade.check_rules(event_count, duration)
+        if score is not None:
+            cascade.record('rules', started_at)
+            return score, user_agent
 
-    # One-hot encode device type
+    # Extract features (fixed order, see FEATURES in src/extract_features.py)
+    if session is not None:
+        feature_vector = session.feature_vector()
+    else:
+        # Convert interaction data to UserInteractionData object
+        user_interaction_data = UserInteractionData(
+            mouse_movements=interaction_data.get('mouseMovements', []),
+            key_presses=interaction_data.get('keyPresses', []),
+            scroll_events=interaction_data.get('scrollEvents', []),
+            form_interactions=interaction_data.get('formInteractions', []),
+            touch_events=interaction_data.get('touchEvents', []),
+            mouse_clicks=interaction_data.get('mouseClicks', []),
+            duration=duration
+        )
+        feature_vector = extract_feature_vector(user_interaction_data)
+
+    # One-hot encode device type (unseen device families go to the unknown bucket)
     if encoder is not None and hasattr(user_agent, 'device') and hasattr(user_agent.device, 'family'):
-        device_type_encoded = encoder.transform([[user_agent.device.family]]).flatten()
+        device_type_encoded = encoder.encode(user_agent.device.family)
     else:
         device_type_encoded = [0]
+    model_input = feature_vector + device_type_encoded
+
+    # Confident linear screen scores skip the network
+    if model is not None and cascade is not None:
+        score = cascade.check_linear(linear, model_input)
+        if score is not None:
+            cascade.record('linear', started_at)
+            return score, user_agent
+
+    # Without a model every challenge gets the 0.5 placeholder
+    if model is None:
+        return 0.5, user_agent
 
-    # Convert features to tensor
-    features_tensor = torch.tensor([
-        features.avg_mouse_speed,
-        features.avg_key_press_interval,
-        features.avg_scroll_speed,
-        features.form_completion_time,
-        features.interaction_count,
-        features.mouse_linearity,
-        features.avg_touch_pressure,
-        features.avg_touch_movement,
-        features.avg_click_duration,
-        features.avg_touch_duration,
-        features.duration
-    ] + list(device_type_encoded), dtype=torch.float32).unsqueeze(0)
+    # Convert features to tensor (torch is loaded with the model)
+    import torch
+    features_tensor = torch.tensor(model_input, dtype=torch.float32).unsqueeze(0)
 
     # Make prediction
     with torch.no_grad():
-        if model is not None:
-            prediction = model(features_tensor)
-        else:
-            prediction = torch.tensor([0.5])
+        prediction = model(features_tensor)
 
-    # Check for session_id cookie
-    session_id = request.cookies.get('session_id')
-    if not session_id:
-        session_id = str(uuid.uuid4())
+    if cascade is not None:
+        cascade.record('network', started_at)
+    return prediction.item(), user_agent
 
-    # Generate interaction_id
-    interaction_id = str(uuid.uuid4())
 
-    # Save interaction data if requested
-    if save_interaction == True:
-        timestamp = datetime.now(timezone.utc)
-        data_to_save = {
-            'session_id': session_id,
-            'interaction_id': interaction_id,
-            'timestamp': timestamp.isoformat(),
-            'interaction_data': interaction_data,
-            'duration': duration,
-            'answer': prediction.item(),
-            'user_agent': {
-                'browser': user_agent.browser.family,
-                'browser_version': user_agent.browser.version_string,
-                'os': user_agent.os.family,
-                'os_version': user_agent.os.version_string,
-                'device': user_agent.device.family
-            },
-            'referrer': request.headers.get('Referer', ''),
-            'viewport': viewport,
-            'load_timestamp': load_timestamp
-        }
-        with open(f'data/{interaction_id}.json', 'w') as f:
-            json.dump(data_to_save, f)
-
-    # Serialize the private key to PEM format
-    if isinstance(PRIVATE_KEY, rsa.RSAPrivateKey):
-        PRIVATE_KEY_PEM = PRIVATE_KEY.private_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PrivateFormat.PKCS8,
-            encryption_algorithm=serialization.NoEncryption()
-        ).decode('utf-8')
-    else:
-        PRIVATE_KEY_PEM = PRIVATE_KEY.decode('utf-8')
+def build_interaction_record(session_id, interaction_id, interaction_payload, score, user_agent, referrer, features=None, site_id=None):
+    # features is given for streamed sessions, whose payload only holds the events sent last
+    timestamp = datetime.now(timezone.utc)
+    record = {
+        'session_id': session_id,
+        'interaction_id': interaction_id,
+        'timestamp': timestamp.isoformat(),
+        'interaction_data': interaction_payload.get('interactions'),
+        'duration': interaction_payload.get('duration'),
+        'answer': score,
+        'user_agent': {
+            'browser': user_agent.browser.family,
+            'browser_version': user_agent.browser.version_string,
+            'os': user_agent.os.family,
+            'os_version': user_agent.os.version_string,
+            'device': user_agent.device.family
+        },
+        'referrer': referrer,
+        'viewport': interaction_payload.get('viewport'),
+        'load_timestamp': interaction_payload.get('loadTimestamp'),
+        'feature_version': FEATURE_EXTRACTOR_VERSION
+    }
+    if features is not None:
+        record['features'] = features
+    if site_id is not None:
+        record['site_id'] = site_id
+    return record
 
-    token = jwt.encode({'score': prediction.item(), 'interaction_id': interaction_id}, PRIVATE_KEY_PEM, algorithm='RS256')
 
-    response = make_response(jsonify({'token': token}))
-    response.set_cookie('session_id', session_id)
-    return response
\ No newline at end of file
+def save_interaction_record(data_to_save):
+    with open(f'data/{data_to_save["interaction_id"]}.json', 'w') as f:
+        f.write(json.dumps(data_to_save))
+    catalog.record_interaction(
+        data_to_save['interaction_id'], data_to_save['timestamp'], None, data_to_save['user_agent']['device'],
+        site_id=data_to_save.get('site_id')
+    )
+
+
+@lru_cache(maxsize=4)
+def _load_private_key(private_key_pem):
+    # Parsing a PEM key validates the whole RSA key, which costs far more than signing
+    from cryptography.hazmat.primitives import serialization
+    return serialization.load_pem_private_key(private_key_pem, password=None)
+
+
+def sign_token(score, interaction_id, PRIVATE_KEY):
+    # Sign with the key object directly instead of round-tripping it through PEM on every request
+    import jwt
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    if not isinstance(PRIVATE_KEY, rsa.RSAPrivateKey):
+        PRIVATE_KEY = _load_private_key(PRIVATE_KEY)
+
+    return jwt.encode({'score': score, 'interaction_id': interaction_id}, PRIVATE_KEY, algorithm='RS256')
@@ -0,0 +1,46 @@
+from flask import request, jsonify, make_response
+from src.profiler import ProfilerError, collapsed
+
+PROFILE_FORMATS = ('collapsed', 'json')
+
+
+def profile_worker(profiler):
+    try:
+        seconds, interval, include_idle, lines, output_format = parse_profile_args(request.args)
+        result = profiler.profile(seconds, interval, include_idle, lines)
+    except ProfilerError as e:
+        return jsonify({'error': str(e)}), 400
+    if result is None:
+        return jsonify({'error': 'A profile is already running on this worker'}), 409
+
+    if output_format == 'json':
+        return jsonify(result)
+    response = make_response(collapsed(result))
+    response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    for name, value in profile_headers(result):
+        response.headers[name] = value
+    return response
+
+
+# The steps below do not depend on Flask so the asyncio server (asgi.py) can share them
+
+def parse_profile_args(args):
+    # ?seconds=5&interval_ms=10&idle=0&lines=0&format=collapsed -> (seconds, interval, include_idle, lines, format)
+    try:
+        seconds = float(args.get('seconds', '5'))
+        interval = float(args.get('interval_ms', '10')) / 1000
+    except ValueError:
+        raise ProfilerError('seconds and interval_ms must be numbers')
+    output_format = args.get('format', 'collapsed')
+    if output_format not in PROFILE_FORMATS:
+        raise ProfilerError(f'format must be one of {", ".join(PROFILE_FORMATS)}')
+    return seconds, interval, args.get('idle') == '1', args.get('lines') == '1', output_format
+
+
+def profile_headers(result):
+    return [
+        ('X-Profile-Samples', str(result['samples'])),
+        ('X-Profile-Duration-Ms', f'{result["duration"] * 1000:.0f}'),
+        ('X-Profile-Interval-Ms', f'{result["interval_ms"]:g}'),
+        ('X-Profile-Overhead', f'{result["overhead"]:.4f}')
+    ]
@@ -1,23 +1,33 @@
-from flask import send_from_directory, jsonify
+from flask import request, jsonify, abort, Response
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import rsa
 
-# Serve the static files from the html directory
+# Serve the static files from the html directory (kept in memory by src/static_assets.py)
 
-def serve_index():
-    return send_from_directory('./html', 'index.html')
+def serve_index(static_assets):
+    return serve_file(static_assets, 'index.html')
 
 
-def serve_file(path):
-    return send_from_directory('./html', path)
+def serve_file(static_assets, path):
+    result = static_assets.respond(path, request.headers.get('Accept-Encoding'), request.headers.get('If-None-Match'))
+    if result is None:
+        abort(404)
+    status, headers, body = result
+    return Response(body, status=status, headers=headers)
+
+
+def get_asset_manifest(static_assets):
+    return jsonify(static_assets.manifest())
 
 
 def get_public_key(PUBLIC_KEY):
+    return jsonify({'public_key': public_key_pem(PUBLIC_KEY)})
+
+
+def public_key_pem(PUBLIC_KEY):
     if isinstance(PUBLIC_KEY, rsa.RSAPublicKey):
-        public_key_pem = PUBLIC_KEY.public_bytes(
+        return PUBLIC_KEY.public_bytes(
             encoding=serialization.Encoding.PEM,
             format=serialization.PublicFormat.SubjectPublicKeyInfo
         ).decode('utf-8')
-    else:
-        public_key_pem = PUBLIC_KEY.decode('utf-8')
-    return jsonify({'public_key': public_key_pem})
\ No newline at end of file
+    return PUBLIC_KEY.decode('utf-8')
@@ -4,17 +4,31 @@ import base64
 import json
 import uuid
 from datetime import datetime, timezone
-from user_agents import parse
 import os
-from src.shared_variables import request_counter
+from src.shared_variables import request_counter, counter_file, _train_and_reload
+from src.extract_features import FEATURE_EXTRACTOR_VERSION
+from src import catalog
 
 def store_data(store_schema):
-    global request_counter
     data = request.json.get('data')
     session_id = request.json.get('session_id')
     if not data:
         return jsonify({'error': 'Data is required'}), 400
 
+    # Check for session_id cookie if not provided in the body
+    if not session_id:
+        session_id = request.cookies.get('session_id')
+
+    interaction_id, session_id = store_interaction(
+        data, session_id, request.headers.get('User-Agent'), request.json.get('site_id')
+    )
+
+    response = make_response(jsonify({'message': 'Data stored successfully', 'interaction_id': interaction_id}))
+    response.set_cookie('session_id', session_id)
+    return response
+
+
+def store_interaction(data, session_id, user_agent_string, site_id=None):
     # Decode the base64 data
     decoded_data = base64.b64decode(data)
     interaction_payload = json.loads(decoded_data)
@@ -25,19 +39,14 @@ def store_data(store_schema):
     load_timestamp = interaction_payload.get('loadTimestamp')
     label = interaction_payload.get('label')
 
-    # Get user agent from headers
-    user_agent_string = request.headers.get('User-Agent')
-
-    # Check for session_id cookie if not provided in the body
     if not session_id:
-        session_id = request.cookies.get('session_id')
-        if not session_id:
-            session_id = str(uuid.uuid4())
+        session_id = str(uuid.uuid4())
 
     # Generate interaction_id
     interaction_id = str(uuid.uuid4())
 
-    # Parse user agent
+    # Parse user agent (user_agents loads its regexes on import, so only on first use)
+    from user_agents import parse
     user_agent = parse(user_agent_string)
 
     # Save interaction data to a JSON file
@@ -57,18 +66,20 @@ def store_data(store_schema):
             'device': user_agent.device.family
         },
         'viewport': viewport,
-        'load_timestamp': load_timestamp
+        'load_timestamp': load_timestamp,
+        'feature_version': FEATURE_EXTRACTOR_VERSION
     }
+    if site_id is not None:
+        data_to_save['site_id'] = site_id
     with open(f'data/{interaction_id}.json', 'w') as f:
         json.dump(data_to_save, f)
+    catalog.record_interaction(interaction_id, timestamp.isoformat(), label, user_agent.device.family, site_id=site_id)
 
     # Increment request counter
     if label is not None:
         _increment_request_counter()
 
-    response = make_response(jsonify({'message': 'Data stored successfully', 'interaction_id': interaction_id}))
-    response.set_cookie('session_id', session_id)
-    return response
+    return interaction_id, session_id
 
 
 def _increment_request_counter():
@@ -82,10 +93,3 @@ def _increment_request_counter():
             f.write(str(request_counter))
         _train_and_reload()
 
-
-def _train_and_reload():
-    os.system('python3 model/train.py')
-    global model, encoder
-    model = torch.load(model_path)
-    encoder = joblib.load(encoder_path)
-    print("Model and encoder reloaded.")
\ No newline at end of file
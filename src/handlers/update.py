@@ -2,7 +2,9 @@ from flask import request, jsonify
 from flask_expects_json import expects_json
 import os
 import json
+import logging
 from src.shared_variables import request_counter, counter_file, _train_and_reload
+from src import catalog
 
 def update_label(update_schema):
     interaction_id = request.json.get('interaction_id')
@@ -10,10 +12,27 @@ def update_label(update_schema):
     if not interaction_id or new_label is None:
         return jsonify({'error': 'Interaction ID and label are required'}), 400
 
+    if not apply_label(interaction_id, new_label):
+        return jsonify({'error': 'Interaction ID not found'}), 404
+
+    return jsonify({'message': 'Label updated successfully'})
+
+
+def update_labels_batch(update_batch_schema):
+    updates = request.json.get('updates')
+    if not updates:
+        return jsonify({'error': 'At least one update is required'}), 400
+
+    updated, not_found, failed = apply_labels(updates)
+
+    return jsonify({'message': 'Labels updated successfully', 'updated': updated, 'not_found': not_found, 'failed': failed})
+
+
+def apply_label(interaction_id, new_label):
     # Find the file
     file_path = f'data/{interaction_id}.json'
     if not os.path.exists(file_path):
-        return jsonify({'error': 'Interaction ID not found'}), 404
+        return False
 
     # Load the existing data
     with open(file_path, 'r') as f:
@@ -25,15 +44,53 @@ def update_label(update_schema):
     # Save the updated data back to the file
     with open(file_path, 'w') as f:
         json.dump(data, f)
+    catalog.record_labels({interaction_id: new_label}, {interaction_id: catalog.record_details(data)})
 
     _increment_request_counter()
+    return True
 
-    return jsonify({'message': 'Label updated successfully'})
+
+def apply_labels(updates):
+    # Group the updates per interaction so each file is read and written once (last label wins)
+    labels = {}
+    for update in updates:
+        labels[update['interaction_id']] = update['label']
+
+    updated = {}
+    details = {}
+    not_found = []
+    failed = []
+    for interaction_id, new_label in labels.items():
+        try:
+            with open(f'data/{interaction_id}.json', 'r+') as f:
+                data = json.loads(f.read())
+                data['label'] = new_label
+                # json.dumps uses the C encoder, json.dump streams through the pure python one
+                f.seek(0)
+                f.write(json.dumps(data))
+                f.truncate()
+        except FileNotFoundError:
+            not_found.append(interaction_id)
+            continue
+        except (OSError, ValueError, TypeError) as e:
+            # A corrupt or unreadable record fails on its own; the rest of the batch is still applied
+            logging.error(f'Failed to label interaction {interaction_id}: {e}')
+            failed.append({'interaction_id': interaction_id, 'error': type(e).__name__})
+            continue
+        updated[interaction_id] = new_label
+        details[interaction_id] = catalog.record_details(data)
+
+    # One catalog transaction and one counter write for the whole batch
+    if updated:
+        catalog.record_labels(updated, details)
+        _increment_request_counter(len(updated))
+
+    return len(updated), not_found, failed
 
 
-def _increment_request_counter():
+def _increment_request_counter(count=1):
     global request_counter, counter_file
-    request_counter += 1
+    request_counter += count
     with open(counter_file, 'w') as f:
         f.write(str(request_counter))
     if request_counter >= 10000:
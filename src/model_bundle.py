@@ -0,0 +1,217 @@
+import os
+import json
+import hashlib
+import shutil
+import warnings
+from datetime import datetime, timezone
+from src.extract_features import FEATURE_EXTRACTOR_VERSION, FEATURE_COUNT
+from src.device_encoder import DeviceEncoder
+from src.cascade import LinearScreen
+
+##################
+# Versioned model artifact bundles
+#
+# model/artifacts/
+#   LATEST                 <- name of the current bundle
+#   20240101T000000Z/
+#     manifest.json        <- versions, input width, metrics and sha256 of every file
+#     model.pt             <- frozen TorchScript model
+#     weights.pt           <- raw state dict, used to publish the weights to shared memory
+#     encoder.json         <- device family category table used for one-hot encoding (DeviceEncoder)
+#     linear.json          <- optional linear screen of the scoring cascade (src/cascade.py)
+##################
+
+ARTIFACTS_DIR = 'model/artifacts'
+BUNDLE_FORMAT_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+MODEL_FILE = 'model.pt'
+WEIGHTS_FILE = 'weights.pt'
+ENCODER_FILE = 'encoder.json'
+LINEAR_FILE = 'linear.json'
+LATEST_FILE = 'LATEST'
+
+
+class ModelBundleError(Exception):
+    pass
+
+
+class ModelBundle:
+    def __init__(self, model, encoder, manifest, path, linear=None):
+        self.model = model
+        self.encoder = encoder
+        self.linear = linear
+        self.manifest = manifest
+        self.path = path
+
+    @property
+    def version(self):
+        return self.manifest['version']
+
+    @property
+    def input_size(self):
+        return self.manifest['input_size']
+
+
+def _sha256(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _write_json_atomic(file_path, data):
+    tmp_path = f'{file_path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, file_path)
+
+
+def save_bundle(model, encoder, metrics=None, artifacts_dir=ARTIFACTS_DIR, linear=None):
+    import torch
+    input_size = FEATURE_COUNT + encoder.width
+    version = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')
+    bundle_path = os.path.join(artifacts_dir, version)
+    tmp_path = os.path.join(artifacts_dir, f'.{version}.tmp')
+    os.makedirs(tmp_path)
+
+    # Freeze the scripted model so loading does not need the python class definitions
+    model.eval()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', FutureWarning)
+        frozen = torch.jit.freeze(torch.jit.script(model))
+        torch.jit.save(frozen, os.path.join(tmp_path, MODEL_FILE))
+    torch.save(model.state_dict(), os.path.join(tmp_path, WEIGHTS_FILE))
+
+    with open(os.path.join(tmp_path, ENCODER_FILE), 'w') as f:
+        json.dump(encoder.to_json(), f)
+    files = [MODEL_FILE, WEIGHTS_FILE, ENCODER_FILE]
+    if linear is not None:
+        with open(os.path.join(tmp_path, LINEAR_FILE), 'w') as f:
+            json.dump(linear.to_json(), f)
+        files.append(LINEAR_FILE)
+
+    manifest = {
+        'format_version': BUNDLE_FORMAT_VERSION,
+        'version': version,
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'feature_extractor_version': FEATURE_EXTRACTOR_VERSION,
+        'feature_count': FEATURE_COUNT,
+        'input_size': input_size,
+        'architecture': {'class': type(model).__name__, 'input_size': input_size, 'hidden_sizes': list(model.hidden_sizes)},
+        'metrics': metrics or {},
+        'files': {file_name: _sha256(os.path.join(tmp_path, file_name)) for file_name in files}
+    }
+    _write_json_atomic(os.path.join(tmp_path, MANIFEST_FILE), manifest)
+
+    # Publish the bundle, then point LATEST at it
+    os.rename(tmp_path, bundle_path)
+    with open(os.path.join(artifacts_dir, f'.{LATEST_FILE}.tmp'), 'w') as f:
+        f.write(version)
+    os.replace(os.path.join(artifacts_dir, f'.{LATEST_FILE}.tmp'), os.path.join(artifacts_dir, LATEST_FILE))
+    return bundle_path
+
+
+def latest_bundle_path(artifacts_dir=ARTIFACTS_DIR):
+    latest_file = os.path.join(artifacts_dir, LATEST_FILE)
+    if not os.path.exists(latest_file):
+        return None
+    with open(latest_file, 'r') as f:
+        version = f.read().strip()
+    return os.path.join(artifacts_dir, version)
+
+
+def read_manifest(bundle_path):
+    manifest_path = os.path.join(bundle_path, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        raise ModelBundleError(f'Manifest not found in {bundle_path}')
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+
+    if manifest.get('format_version') != BUNDLE_FORMAT_VERSION:
+        raise ModelBundleError(f'Unsupported bundle format: {manifest.get("format_version")}')
+    if manifest.get('feature_extractor_version') != FEATURE_EXTRACTOR_VERSION:
+        raise ModelBundleError(
+            f'Bundle was trained with feature extractor v{manifest.get("feature_extractor_version")}, '
+            f'server runs v{FEATURE_EXTRACTOR_VERSION}')
+
+    # Integrity check every file listed in the manifest
+    for file_name, expected in manifest.get('files', {}).items():
+        file_path = os.path.join(bundle_path, file_name)
+        if not os.path.exists(file_path):
+            raise ModelBundleError(f'{file_name} missing from {bundle_path}')
+        if _sha256(file_path) != expected:
+            raise ModelBundleError(f'Checksum mismatch for {file_name} in {bundle_path}')
+    return manifest
+
+
+def read_encoder(bundle_path):
+    with open(os.path.join(bundle_path, ENCODER_FILE), 'r') as f:
+        return DeviceEncoder.from_json(json.load(f))
+
+
+def read_linear(bundle_path, manifest):
+    # Bundles trained before the scoring cascade existed have no linear screen
+    if LINEAR_FILE not in manifest.get('files', {}):
+        return None
+    with open(os.path.join(bundle_path, LINEAR_FILE), 'r') as f:
+        linear = LinearScreen.from_json(json.load(f))
+    if len(linear.weights) != manifest['input_size']:
+        raise ModelBundleError(f'Linear screen has {len(linear.weights)} weights for an input width of {manifest["input_size"]}')
+    return linear
+
+
+def read_weights(bundle_path, manifest):
+    if WEIGHTS_FILE not in manifest.get('files', {}):
+        raise ModelBundleError(f'{bundle_path} does not contain raw weights')
+    import torch
+    return torch.load(os.path.join(bundle_path, WEIGHTS_FILE), map_location='cpu', weights_only=True)
+
+
+def load_bundle(bundle_path=None, warm_up_passes=3):
+    if bundle_path is None:
+        bundle_path = latest_bundle_path()
+        if bundle_path is None:
+            raise ModelBundleError(f'No model bundle published in {ARTIFACTS_DIR}')
+
+    manifest = read_manifest(bundle_path)
+
+    encoder = read_encoder(bundle_path)
+    if manifest['input_size'] != manifest['feature_count'] + encoder.width:
+        raise ModelBundleError(
+            f'Input width {manifest["input_size"]} does not match {manifest["feature_count"]} features '
+            f'+ {encoder.width} device slots')
+    linear = read_linear(bundle_path, manifest)
+
+    # torch is only imported once there is a model to load, so the server without one (and the
+    # tools reading manifests) start without it
+    import torch
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', FutureWarning)
+        model = torch.jit.load(os.path.join(bundle_path, MODEL_FILE), map_location='cpu')
+    model.eval()
+
+    bundle = ModelBundle(model, encoder, manifest, bundle_path, linear)
+    warm_up(bundle, warm_up_passes)
+    return bundle
+
+
+def warm_up(bundle, passes=3):
+    # Run a few dummy requests so the first real request does not pay for lazy initialization
+    import torch
+    sample = torch.zeros(1, bundle.input_size, dtype=torch.float32)
+    with torch.no_grad():
+        for _ in range(passes):
+            bundle.model(sample)
+
+
+def prune_bundles(keep=3, artifacts_dir=ARTIFACTS_DIR):
+    current = latest_bundle_path(artifacts_dir)
+    versions = sorted(
+        name for name in os.listdir(artifacts_dir)
+        if not name.startswith('.') and os.path.isdir(os.path.join(artifacts_dir, name))
+    )
+    for version in versions[:-keep]:
+        path = os.path.join(artifacts_dir, version)
+        if path != current:
+            shutil.rmtree(path)
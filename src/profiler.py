@@ -0,0 +1,142 @@
+import os
+import sys
+import time
+import threading
+
+##################
+# On-demand sampling profiler
+#
+# /api/admin/profile samples the Python stacks of every thread of the worker that receives
+# it (sys._current_frames) for a few seconds and returns them aggregated in the collapsed
+# format of flamegraph.pl and speedscope ("root;caller;leaf count" per line). Frames are
+# labelled file:function (file:function:line with lines=1, which tells feature extraction,
+# inference and signing apart inside score_interaction and captcha_challenge).
+#
+# Safe under live load:
+#   - one profile at a time per worker; the sampling loop runs on the thread of the request
+#   - the duration is capped (PROFILER_MAX_SECONDS) and the sampling interval floored
+#     (PROFILER_MIN_INTERVAL_MS)
+#   - the time spent taking a sample, during which the sampler holds the GIL, is kept below
+#     PROFILER_MAX_OVERHEAD of the interval by doubling the interval whenever it is exceeded
+#   - stacks are cut at MAX_DEPTH frames and at most PROFILER_MAX_STACKS distinct stacks are
+#     kept, the rest are counted under [truncated]
+# Threads waiting for work (idle) are left out unless idle=1.
+##################
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+MAX_DEPTH = 128
+MAX_INTERVAL = 0.1
+TRUNCATED = '[truncated]'
+
+# Leaf frames of threads blocked waiting for work: (file name, function)
+IDLE_FRAMES = {
+    ('threading.py', 'wait'),
+    ('queue.py', 'get'),
+    ('selectors.py', 'select'),
+    ('thread.py', '_worker'),
+    ('socketserver.py', 'serve_forever'),
+    ('threading.py', '_wait_for_tstate_lock')
+}
+
+
+class ProfilerError(ValueError):
+    pass
+
+
+class SamplingProfiler:
+    def __init__(self, max_seconds=30.0, min_interval=0.005, max_overhead=0.02, max_stacks=10000):
+        self.max_seconds = max_seconds
+        self.min_interval = min_interval
+        self.max_overhead = max_overhead
+        self.max_stacks = max_stacks
+        self._running = threading.Lock()
+        self._labels = {}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_seconds=float(os.getenv('PROFILER_MAX_SECONDS', '30')),
+            min_interval=float(os.getenv('PROFILER_MIN_INTERVAL_MS', '5')) / 1000,
+            max_overhead=float(os.getenv('PROFILER_MAX_OVERHEAD', '0.02')),
+            max_stacks=int(os.getenv('PROFILER_MAX_STACKS', '10000'))
+        )
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            filename = os.path.abspath(code.co_filename)
+            filename = os.path.relpath(filename, ROOT) if filename.startswith(ROOT + os.sep) else os.path.basename(filename)
+            label = self._labels[code] = f'{filename}:{code.co_name}'
+        return label
+
+    def _stack(self, frame, lines):
+        # Root first, as the collapsed format expects
+        stack = []
+        while frame is not None and len(stack) < MAX_DEPTH:
+            label = self._label(frame.f_code)
+            stack.append(f'{label}:{frame.f_lineno}' if lines else label)
+            frame = frame.f_back
+        stack.reverse()
+        return ';'.join(stack)
+
+    @staticmethod
+    def _idle(frame):
+        return (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in IDLE_FRAMES
+
+    def profile(self, seconds, interval, include_idle=False, lines=False):
+        # Samples every other thread for `seconds`; returns None when a profile is already running
+        if not 0 < seconds <= self.max_seconds:
+            raise ProfilerError(f'seconds must be greater than 0 and at most {self.max_seconds:g}')
+        if not self.min_interval <= interval <= MAX_INTERVAL:
+            raise ProfilerError(f'interval_ms must be between {self.min_interval * 1000:g} and {MAX_INTERVAL * 1000:g}')
+        if not self._running.acquire(blocking=False):
+            return None
+        try:
+            return self._sample(seconds, interval, include_idle, lines)
+        finally:
+            self._running.release()
+
+    def _sample(self, seconds, interval, include_idle, lines):
+        own_thread = threading.get_ident()
+        stacks = {}
+        samples = 0
+        sampling_time = 0.0
+        backoffs = 0
+        started_at = time.perf_counter()
+        deadline = started_at + seconds
+        while True:
+            sample_started = time.perf_counter()
+            if sample_started >= deadline:
+                break
+            frames = sys._current_frames()
+            for thread_id, frame in frames.items():
+                if thread_id == own_thread or (not include_idle and self._idle(frame)):
+                    continue
+                stack = self._stack(frame, lines)
+                if stack not in stacks and len(stacks) >= self.max_stacks:
+                    stack = TRUNCATED
+                stacks[stack] = stacks.get(stack, 0) + 1
+            frames = frame = None
+            now = time.perf_counter()
+            sampling_time += now - sample_started
+            samples += 1
+            # Mean cost of a sample against the interval: the share of time the GIL is taken from requests
+            if sampling_time / samples > self.max_overhead * interval and interval < MAX_INTERVAL:
+                interval = min(interval * 2, MAX_INTERVAL)
+                backoffs += 1
+            time.sleep(max(0.0, min(interval - (now - sample_started), deadline - now)))
+
+        duration = time.perf_counter() - started_at
+        return {
+            'stacks': stacks,
+            'samples': samples,
+            'duration': duration,
+            'interval_ms': interval * 1000,
+            'backoffs': backoffs,
+            'overhead': sampling_time / duration if duration else 0.0
+        }
+
+
+def collapsed(result):
+    # One "stack count" line per stack, most sampled first
+    return ''.join(f'{stack} {count}\n' for stack, count in sorted(result['stacks'].items(), key=lambda item: -item[1]))
@@ -0,0 +1,140 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from src.extract_features import SessionAccumulator
+
+##################
+# Streaming session aggregates
+#
+# Clients may upload interaction events in chunks while the user is still on the page
+# (POST /api/challenge/events). Sessions are keyed by the stream id captcha.js draws for each
+# page, not the session_id cookie: the cookie is shared by every page of the browser, so an
+# abandoned page would leak its events into the next challenge of another one. Each chunk
+# is folded into the session's running feature aggregates (sums, counts, last event, press
+# pairing state) and the events are dropped, so a session costs a fixed amount of memory
+# however long it runs. /api/challenge, sent with the same stream id, then only folds in the
+# events sent with it and finalizes the aggregates.
+#
+# Chunks carry a sequence number. A client retrying a chunk whose response it never got (a
+# timeout after the chunk was folded) sends it again with the same number, and chunks
+# numbered below the next expected one are dropped instead of being counted twice. A chunk
+# numbered above it is rejected with OutOfOrderChunk (409, with the expected number): folding
+# it would skip the missing chunk, which then arrives as a duplicate and is lost. The client
+# resends from the expected chunk on.
+#
+# Sessions live in a sharded table, each shard with its own lock, bounded in size and
+# evicted once idle for longer than the TTL (least recently fed first when full).
+#
+# The table belongs to the worker process. With several workers, chunks and the challenge of
+# one page may reach different ones, so the challenge says how many chunks it streamed and
+# take() raises IncompleteStream when this worker folded fewer (or the session expired) rather
+# than scoring partial aggregates; captcha.js then sends the full event log instead. Route
+# requests of a client to one worker (sticky sessions) to keep the benefit of streaming.
+##################
+
+
+class IncompleteStream(LookupError):
+    pass
+
+
+class OutOfOrderChunk(IncompleteStream):
+    def __init__(self, expected_seq, seq):
+        super().__init__(f'expected chunk {expected_seq}, got {seq}')
+        self.expected_seq = expected_seq
+
+
+class SessionStore:
+    def __init__(self, max_sessions=100000, ttl=1800, shards=64):
+        self.ttl = ttl
+        self.max_per_shard = max(1, max_sessions // shards)
+        self.max_sessions = self.max_per_shard * shards
+        self._shards = [(OrderedDict(), threading.Lock()) for _ in range(shards)]
+        self._stats_lock = threading.Lock()
+        self.evicted = 0
+        self.duplicates = 0
+        self.incomplete = 0
+        self.out_of_order = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_sessions=int(os.getenv('SESSION_STORE_MAX_SESSIONS', '100000')),
+            ttl=float(os.getenv('SESSION_STORE_TTL_SECONDS', '1800'))
+        )
+
+    def _shard(self, stream_id):
+        return self._shards[hash(stream_id) % len(self._shards)]
+
+    def feed(self, stream_id, interactions, seq=None, now=None):
+        # Folds a chunk of events into the session; returns the number of events seen so far
+        # Raises OutOfOrderChunk when chunks before seq have not been folded here
+        if now is None:
+            now = time.monotonic()
+        sessions, lock = self._shard(stream_id)
+        duplicate = False
+        with lock:
+            entry = sessions.get(stream_id)
+            if entry is None:
+                session, next_seq, folded = SessionAccumulator(), 0, 0
+            else:
+                session, _, next_seq, folded = entry
+                sessions.move_to_end(stream_id)
+            if seq is not None and seq > next_seq:
+                with self._stats_lock:
+                    self.out_of_order += 1
+                raise OutOfOrderChunk(next_seq, seq)
+            if seq is not None and seq < next_seq:
+                duplicate = True
+            else:
+                # Chunks of one session are folded one at a time and in arrival order
+                session.feed(interactions)
+                next_seq = seq + 1 if seq is not None else next_seq + 1
+                folded += 1
+            sessions[stream_id] = (session, now, next_seq, folded)
+
+            evicted = 0
+            expired_before = now - self.ttl
+            while sessions:
+                oldest_id = next(iter(sessions))
+                if sessions[oldest_id][1] >= expired_before and len(sessions) <= self.max_per_shard:
+                    break
+                del sessions[oldest_id]
+                evicted += 1
+            interaction_count = session.interaction_count
+        if evicted or duplicate:
+            with self._stats_lock:
+                self.evicted += evicted
+                self.duplicates += duplicate
+        return interaction_count
+
+    def take(self, stream_id, chunk_count=None, now=None):
+        # Removes and returns the session's aggregates, or None if nothing was streamed (or it expired)
+        # chunk_count: the number of chunks the client streamed, all of which must have been folded here
+        if not stream_id:
+            return None
+        if now is None:
+            now = time.monotonic()
+        sessions, lock = self._shard(stream_id)
+        with lock:
+            entry = sessions.pop(stream_id, None)
+        if entry is not None and entry[1] < now - self.ttl:
+            entry = None
+        folded = entry[3] if entry is not None else 0
+        if chunk_count is not None and folded < chunk_count:
+            with self._stats_lock:
+                self.incomplete += 1
+            raise IncompleteStream(f'{folded} of {chunk_count} streamed chunks reached this worker')
+        return entry[0] if entry is not None else None
+
+    def __len__(self):
+        return sum(len(sessions) for sessions, _ in self._shards)
+
+    def stats(self):
+        with self._stats_lock:
+            evicted = self.evicted
+            duplicates = self.duplicates
+            incomplete = self.incomplete
+            out_of_order = self.out_of_order
+        return {'sessions': len(self), 'max_sessions': self.max_sessions, 'evicted': evicted, 'duplicate_chunks': duplicates,
+                'out_of_order_chunks': out_of_order, 'incomplete_streams': incomplete}
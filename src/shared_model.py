@@ -0,0 +1,247 @@
+import os
+import sys
+import json
+import mmap
+import fcntl
+import struct
+import logging
+import threading
+import warnings
+from src.device_encoder import DeviceEncoder
+from src.model_bundle import (
+    read_manifest, read_encoder, read_linear, read_weights, latest_bundle_path, ModelBundleError
+)
+from src.cascade import LinearScreen
+
+##################
+# Shared-memory model weights
+#
+# The current model weights and encoder category table are published to a directory
+# (ideally on tmpfs, e.g. /dev/shm/aicaptcha) as immutable generation files:
+#
+#   control        <- magic + generation counter, mapped by every worker
+#   gen-<n>.bin    <- magic + header length + JSON header + float32 weights (64 byte aligned)
+#
+# Workers mmap the generation file read-only and build the model on top of the mapped
+# pages, so the weights exist once in the page cache no matter how many workers run.
+# Publishing writes a new generation file and then bumps the counter; each worker checks
+# the counter before a request and switches to the new generation between requests.
+# A publisher deletes the generations older than the previous one, so a worker that reads
+# the counter just before two quick publishes may find its file gone; it then keeps serving
+# the generation it has mapped and retries on the next request. A truncated or corrupt
+# generation file is logged and skipped the same way, until a newer generation is published.
+##################
+
+SHARED_MODEL_DIR = os.getenv('SHARED_MODEL_DIR')
+
+MAGIC = b'AICAPSHM'
+CONTROL_FILE = 'control'
+LOCK_FILE = '.lock'
+CONTROL_STRUCT = struct.Struct('<8sQ')
+HEADER_STRUCT = struct.Struct('<8sQ')
+ALIGNMENT = 64
+
+
+def _generation_file(shared_dir, generation):
+    return os.path.join(shared_dir, f'gen-{generation}.bin')
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _read_control(shared_dir):
+    control_path = os.path.join(shared_dir, CONTROL_FILE)
+    if not os.path.exists(control_path):
+        return 0
+    with open(control_path, 'rb') as f:
+        magic, generation = CONTROL_STRUCT.unpack(f.read(CONTROL_STRUCT.size))
+    return generation if magic == MAGIC else 0
+
+
+def _write_control(shared_dir, generation):
+    # The counter is updated in place through a shared mapping so readers never see a missing file
+    control_path = os.path.join(shared_dir, CONTROL_FILE)
+    if not os.path.exists(control_path):
+        with open(control_path, 'wb') as f:
+            f.write(CONTROL_STRUCT.pack(MAGIC, 0))
+    with open(control_path, 'r+b') as f:
+        with mmap.mmap(f.fileno(), CONTROL_STRUCT.size) as control:
+            CONTROL_STRUCT.pack_into(control, 0, MAGIC, generation)
+            control.flush()
+
+
+def _read_header(mapping):
+    magic, header_length = HEADER_STRUCT.unpack_from(mapping, 0)
+    if magic != MAGIC:
+        raise ModelBundleError('Shared model file has an invalid header')
+    header = json.loads(bytes(mapping[HEADER_STRUCT.size:HEADER_STRUCT.size + header_length]))
+    header['data_start'] = _align(HEADER_STRUCT.size + header_length)
+    return header
+
+
+def published_version(shared_dir=SHARED_MODEL_DIR):
+    # None when nothing is published or the current generation file is unreadable (it is then replaced)
+    generation = _read_control(shared_dir)
+    if generation == 0:
+        return None
+    try:
+        with open(_generation_file(shared_dir, generation), 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+                return _read_header(mapping)['version']
+    except (ModelBundleError, ValueError, KeyError, struct.error, OSError):
+        return None
+
+
+def publish_bundle(bundle_path=None, shared_dir=SHARED_MODEL_DIR):
+    if bundle_path is None:
+        bundle_path = latest_bundle_path()
+        if bundle_path is None:
+            raise ModelBundleError('No model bundle to publish')
+    manifest = read_manifest(bundle_path)
+    os.makedirs(shared_dir, exist_ok=True)
+
+    with open(os.path.join(shared_dir, LOCK_FILE), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        current = _read_control(shared_dir)
+        if current and published_version(shared_dir) == manifest['version']:
+            return current  # Another worker already published this bundle
+
+        import torch
+        state_dict = read_weights(bundle_path, manifest)
+        tensors = []
+        offset = 0
+        for name, tensor in state_dict.items():
+            tensor = tensor.detach().to(torch.float32).contiguous()
+            tensors.append((name, tensor, offset))
+            offset = _align(offset + tensor.numel() * 4)
+
+        linear = read_linear(bundle_path, manifest)
+        header = {
+            'version': manifest['version'],
+            'architecture': manifest['architecture'],
+            'encoder': read_encoder(bundle_path).to_json(),
+            'linear': linear.to_json() if linear is not None else None,
+            'tensors': [
+                {'name': name, 'shape': list(tensor.shape), 'offset': tensor_offset}
+                for name, tensor, tensor_offset in tensors
+            ]
+        }
+        header_bytes = json.dumps(header).encode('utf-8')
+        data_start = _align(HEADER_STRUCT.size + len(header_bytes))
+
+        generation = current + 1
+        file_path = _generation_file(shared_dir, generation)
+        with open(f'{file_path}.tmp', 'wb') as f:
+            f.write(HEADER_STRUCT.pack(MAGIC, len(header_bytes)))
+            f.write(header_bytes)
+            for name, tensor, tensor_offset in tensors:
+                f.seek(data_start + tensor_offset)
+                f.write(tensor.numpy().tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f'{file_path}.tmp', file_path)
+        _write_control(shared_dir, generation)
+
+        # Workers still serving an older generation keep their mapping alive after the unlink
+        for old_generation in range(1, generation - 1):
+            old_path = _generation_file(shared_dir, old_generation)
+            if os.path.exists(old_path):
+                os.remove(old_path)
+    return generation
+
+
+def _build_model(architecture):
+    from model.model_definitions import NeuralNet
+    if architecture.get('class', 'NeuralNet') != 'NeuralNet':
+        raise ModelBundleError(f'Unknown model class {architecture["class"]}')
+    # Bundles written before the hidden sizes were recorded use the default 64/32 network
+    return NeuralNet(architecture['input_size'], architecture.get('hidden_sizes', (64, 32)))
+
+
+class SharedModelReader:
+    def __init__(self, shared_dir=SHARED_MODEL_DIR):
+        self.shared_dir = shared_dir
+        self.generation = 0
+        self.version = None
+        self._control = None
+        self._mapping = None
+        self._current = (None, None, None)
+        self._bad_generation = None
+        self._lock = threading.Lock()
+
+    def _read_generation(self):
+        if self._control is None:
+            try:
+                with open(os.path.join(self.shared_dir, CONTROL_FILE), 'rb') as f:
+                    self._control = mmap.mmap(f.fileno(), CONTROL_STRUCT.size, access=mmap.ACCESS_READ)
+            except FileNotFoundError:
+                return self.generation  # Nothing published yet
+        magic, generation = CONTROL_STRUCT.unpack_from(self._control, 0)
+        return generation if magic == MAGIC else 0
+
+    def current(self):
+        # Returns (model, encoder, linear screen); called once per request, swaps to a new generation if one was published
+        generation = self._read_generation()
+        if generation != self.generation and generation != self._bad_generation:
+            with self._lock:
+                if generation != self.generation and generation != self._bad_generation:
+                    self._attach(generation)
+        return self._current
+
+    def _attach(self, generation):
+        try:
+            mapping, header, model, encoder, linear = self._map(generation)
+        except FileNotFoundError:
+            # Already replaced by a newer generation; the counter names it by the next request
+            logging.warning(f'Shared model generation {generation} is gone, keeping generation {self.generation}')
+            return
+        except (ModelBundleError, ValueError, KeyError, TypeError, RuntimeError, struct.error, OSError) as e:
+            # Truncated or corrupt: not retried until another generation is published
+            logging.error(f'Shared model generation {generation} is unreadable ({e}), keeping generation {self.generation}')
+            self._bad_generation = generation
+            return
+        self._mapping = mapping
+        self._current = (model, encoder, linear)
+        self.version = header['version']
+        self.generation = generation
+
+    def _map(self, generation):
+        import torch
+        with open(_generation_file(self.shared_dir, generation), 'rb') as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header = _read_header(mapping)
+
+        model = _build_model(header['architecture'])
+        parameters = dict(model.named_parameters())
+        with warnings.catch_warnings():
+            # The mapping is read-only on purpose; inference never writes to the weights
+            warnings.simplefilter('ignore', UserWarning)
+            for tensor in header['tensors']:
+                count = 1
+                for dim in tensor['shape']:
+                    count *= dim
+                view = torch.frombuffer(
+                    mapping, dtype=torch.float32, count=count, offset=header['data_start'] + tensor['offset']
+                ).view(tensor['shape'])
+                module_name, _, attribute = tensor['name'].rpartition('.')
+                module = model.get_submodule(module_name)
+                if tensor['name'] in parameters:
+                    setattr(module, attribute, torch.nn.Parameter(view, requires_grad=False))
+                else:
+                    setattr(module, attribute, view)
+        model.eval()
+        encoder = DeviceEncoder.from_json(header['encoder'])
+        linear = LinearScreen.from_json(header['linear']) if header.get('linear') else None
+
+        # Warm up the new generation before making it visible to requests
+        with torch.no_grad():
+            model(torch.zeros(1, header['architecture']['input_size'], dtype=torch.float32))
+        return mapping, header, model, encoder, linear
+
+
+if __name__ == '__main__':
+    # Publish the latest bundle: python -m src.shared_model [bundle_path]
+    if not SHARED_MODEL_DIR:
+        sys.exit('SHARED_MODEL_DIR is not set')
+    print(f'Published generation {publish_bundle(sys.argv[1] if len(sys.argv) > 1 else None)} to {SHARED_MODEL_DIR}')
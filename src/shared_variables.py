@@ -6,15 +6,112 @@ request_counter = 0
 # Initialize counter file
 counter_file = 'request_counter.txt'
 
+# Currently loaded model, one-hot encoder and cascade linear screen (populated by load_model)
+model = None
+encoder = None
+linear = None
+model_version = None
+
+# Legacy artifacts written by older versions of model/train.py
+legacy_model_path = 'model/neural_net_model_weights.pth'
+legacy_encoder_path = 'model/onehot_encoder.pkl'
+
 # Define _train function
 import os
-import torch
-import joblib
-from model.model_definitions import NeuralNet
+import sys
+import logging
+import threading
+import subprocess
+from src.model_bundle import load_bundle, latest_bundle_path, ModelBundleError
+from src.shared_model import SHARED_MODEL_DIR, SharedModelReader, publish_bundle
+from src.tenants import TenantModelCache
+
+# When SHARED_MODEL_DIR is set, workers map the published weights instead of loading their own copy
+shared_model = SharedModelReader(SHARED_MODEL_DIR) if SHARED_MODEL_DIR else None
+
+# Models of the sites that have their own, loaded on first use
+tenant_models = TenantModelCache.from_env()
+
+# Retraining command and the lock held while it runs (one run per worker at a time)
+train_command = [sys.executable, 'model/train.py', '--all-sites']
+_training = threading.Lock()
+
+
+def load_model():
+    global model, encoder, linear, model_version
+    if shared_model is not None and latest_bundle_path() is not None:
+        try:
+            generation = publish_bundle()
+            print(f"Model bundle published to {SHARED_MODEL_DIR} as generation {generation}")
+            # Only rely on the shared copy once this worker could map it; otherwise load its own below
+            if shared_model.current()[0] is not None:
+                return
+            logging.error(f"Could not map shared model generation {generation}, loading a local copy of the bundle")
+        except ModelBundleError as e:
+            logging.error(f"Failed to publish model bundle: {e}")
+
+    if latest_bundle_path() is not None:
+        try:
+            bundle = load_bundle()
+            model, encoder, linear, model_version = bundle.model, bundle.encoder, bundle.linear, bundle.version
+            print(f"Loaded model bundle {bundle.version} from {bundle.path}")
+            return
+        except ModelBundleError as e:
+            logging.error(f"Failed to load model bundle: {e}")
+
+    if os.path.exists(legacy_model_path) and os.path.exists(legacy_encoder_path):
+        import torch
+        import joblib
+        from model.model_definitions import NeuralNet
+        from src.device_encoder import DeviceEncoder
+        # Only the category table of the pickled OneHotEncoder is used; it has no unknown bucket
+        encoder = DeviceEncoder(joblib.load(legacy_encoder_path).categories_[0], unknown_bucket=False)
+        model = NeuralNet()
+        model.load_state_dict(torch.load(legacy_model_path))
+        model.eval()
+        linear = None
+        model_version = 'legacy'
+    else:
+        model = None
+        encoder = None
+        linear = None
+        model_version = None
+        print("Model or encoder not found. Defaulting to dummy prediction.")
+
+
+def current_model(site_id=None):
+    # The (model, encoder, linear screen) to use for the current request: the site's own model if it has one, else the global one
+    if site_id is not None:
+        tenant = tenant_models.get(site_id)
+        if tenant is not None:
+            return tenant
+    if shared_model is not None:
+        shared = shared_model.current()
+        if shared[0] is not None:
+            return shared
+    return model, encoder, linear
+
 
 def _train_and_reload():
-    os.system('python3 model/train.py')
-    global model, encoder
-    model = torch.load(model_path)
-    encoder = joblib.load(encoder_path)
-    print("Model and encoder reloaded.")
+    # Trains in a background thread so the request that reached the threshold is not held up;
+    # returns the thread, or None when a run is already in progress
+    if not _training.acquire(blocking=False):
+        print("Training already in progress, skipped.")
+        return None
+    thread = threading.Thread(target=_run_training, name='train-and-reload', daemon=True)
+    thread.start()
+    return thread
+
+
+def _run_training():
+    try:
+        result = subprocess.run(train_command)
+        if result.returncode != 0:
+            # The current model keeps serving
+            logging.error(f"Training failed with exit status {result.returncode}")
+            return
+        # Site models are picked up by tenant_models once their new bundle is published
+        load_model()
+        print("Model and encoder reloaded.")
+    finally:
+        _training.release()
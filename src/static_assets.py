@@ -0,0 +1,183 @@
+import os
+import gzip
+import hashlib
+import logging
+import threading
+import mimetypes
+
+try:
+    import brotli
+except ImportError:  # Listed in requirements.txt; an install without it only serves gzip variants
+    brotli = None
+
+##################
+# In-memory static assets
+#
+# Every file under html/ is read once and kept in memory together with its gzip and brotli
+# variants and a strong ETag. Each asset is reachable at its plain path (/captcha.js,
+# revalidated by browsers every few minutes) and at a content-hashed path (/captcha.<hash>.js)
+# that is served as immutable. Conditional requests are answered from memory. A background
+# thread re-scans the directory every check interval and swaps in re-read and recompressed
+# assets, so requests never walk the directory or compress anything (check_interval=0 only
+# reloads on an explicit reload()).
+##################
+
+STATIC_CHECK_INTERVAL = float(os.getenv('STATIC_CHECK_INTERVAL_SECONDS', '2'))
+PLAIN_CACHE_CONTROL = 'public, max-age=300'
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+# Preferred first
+ENCODINGS = ('br', 'gzip')
+
+
+class StaticAsset:
+    def __init__(self, path, body, stamp):
+        self.path = path
+        self.body = body
+        self.stamp = stamp
+        self.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        if self.content_type.startswith('text/') or self.content_type == 'application/javascript':
+            self.content_type += '; charset=utf-8'
+        self.hash = hashlib.sha256(body).hexdigest()[:16]
+        name, extension = os.path.splitext(path)
+        self.versioned_path = f'{name}.{self.hash}{extension}'
+
+        # {encoding: body}; only kept when the compressed body is actually smaller
+        self.variants = {}
+        if self.content_type.startswith(COMPRESSIBLE_TYPES):
+            compressed = {'gzip': gzip.compress(body, compresslevel=9, mtime=0)}
+            if brotli is not None:
+                compressed['br'] = brotli.compress(body, quality=11)
+            for encoding, variant in compressed.items():
+                if len(variant) < len(body):
+                    self.variants[encoding] = variant
+
+    def etag(self, encoding=None):
+        # Strong ETags have to differ between encodings of the same content
+        return f'"{self.hash}-{encoding}"' if encoding else f'"{self.hash}"'
+
+
+def _stamp(file_path):
+    stat = os.stat(file_path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _accepted_encodings(accept_encoding):
+    accepted = set()
+    for part in (accept_encoding or '').split(','):
+        coding, _, parameters = part.strip().partition(';')
+        quality = parameters.strip()
+        if quality.startswith('q='):
+            try:
+                if float(quality[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
+def _etag_matches(if_none_match, etag):
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*' or candidate.removeprefix('W/') == etag:
+            return True
+    return False
+
+
+class StaticAssetCache:
+    def __init__(self, root='html', check_interval=STATIC_CHECK_INTERVAL):
+        self.root = root
+        self.check_interval = check_interval
+        self._assets = {}
+        self._versioned = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.reload()
+        self._watcher = None
+        if check_interval > 0:
+            self._watcher = threading.Thread(target=self._watch, name='static-assets', daemon=True)
+            self._watcher.start()
+
+    def _files(self):
+        # (asset path, file path) of every file under the root
+        for directory, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                file_path = os.path.join(directory, filename)
+                yield os.path.relpath(file_path, self.root).replace(os.sep, '/'), file_path
+
+    def reload(self):
+        # Re-reads the files that changed, adds new ones and drops removed ones
+        with self._lock:
+            assets = {}
+            for path, file_path in self._files():
+                try:
+                    stamp = _stamp(file_path)
+                    current = self._assets.get(path)
+                    if current is not None and current.stamp == stamp:
+                        assets[path] = current
+                        continue
+                    with open(file_path, 'rb') as f:
+                        assets[path] = StaticAsset(path, f.read(), stamp)
+                except OSError:
+                    continue  # Removed while scanning
+            self._assets = assets
+            self._versioned = {asset.versioned_path: asset for asset in assets.values()}
+
+    def _watch(self):
+        while not self._stop.wait(self.check_interval):
+            try:
+                self._check_for_changes()
+            except Exception as e:
+                logging.error(f'Failed to check {self.root} for changed assets: {e}')
+
+    def close(self):
+        self._stop.set()
+
+    def _check_for_changes(self):
+        seen = 0
+        for path, file_path in self._files():
+            asset = self._assets.get(path)
+            try:
+                stamp = _stamp(file_path)
+            except OSError:
+                stamp = None
+            if asset is None or asset.stamp != stamp:
+                self.reload()
+                return
+            seen += 1
+        if seen != len(self._assets):
+            self.reload()
+
+    def lookup(self, path):
+        # Returns (asset, immutable) for a plain or versioned path, or (None, False)
+        asset = self._assets.get(path)
+        if asset is not None:
+            return asset, False
+        asset = self._versioned.get(path)
+        return asset, asset is not None
+
+    def manifest(self):
+        # {plain URL: versioned URL}, for embedding the assets with long-lived caching
+        return {f'/{path}': f'/{asset.versioned_path}' for path, asset in self._assets.items()}
+
+    def respond(self, path, accept_encoding=None, if_none_match=None):
+        # Returns (status, headers, body) for a GET of path, or None if there is no such asset
+        asset, immutable = self.lookup(path)
+        if asset is None:
+            return None
+        accepted = _accepted_encodings(accept_encoding)
+        encoding = next((encoding for encoding in ENCODINGS if encoding in accepted and encoding in asset.variants), None)
+        etag = asset.etag(encoding)
+        headers = [
+            ('Cache-Control', IMMUTABLE_CACHE_CONTROL if immutable else PLAIN_CACHE_CONTROL),
+            ('ETag', etag),
+            ('Vary', 'Accept-Encoding')
+        ]
+        if if_none_match and _etag_matches(if_none_match, etag):
+            return 304, headers, b''
+        headers.append(('Content-Type', asset.content_type))
+        if encoding:
+            headers.append(('Content-Encoding', encoding))
+            return 200, headers, asset.variants[encoding]
+        return 200, headers, asset.body
@@ -0,0 +1,158 @@
+import os
+import re
+import time
+import logging
+import threading
+from collections import OrderedDict
+from src.model_bundle import ARTIFACTS_DIR, MODEL_FILE, load_bundle, latest_bundle_path, ModelBundleError
+
+##################
+# Multi-tenant models
+#
+# Sites embedding the captcha can get their own public key (SITE_KEYS) so their challenges
+# are scored by a model trained on their own traffic. Per-site bundles live next to the
+# global ones:
+#
+#   model/artifacts/sites/<site_id>/LATEST, <version>/...   <- same layout as model/artifacts
+#
+# Site models are loaded on first use into an LRU cache bounded by TENANT_MODEL_CACHE_MB
+# (estimated from the size of the frozen model file) and re-checked for a newer bundle every
+# TENANT_MODEL_CHECK_SECONDS. Sites without a bundle are scored by the global model.
+##################
+
+SITES_DIR = os.path.join(ARTIFACTS_DIR, 'sites')
+SITE_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+def parse_site_keys(value):
+    # SITE_KEYS="site_a=public_key_a,site_b=public_key_b" -> {public_key: site_id}
+    site_keys = {}
+    for pair in (value or '').split(','):
+        if not pair.strip():
+            continue
+        site_id, _, key = pair.strip().partition('=')
+        if not SITE_ID_PATTERN.match(site_id) or not key:
+            raise ValueError(f'Invalid SITE_KEYS entry {pair.strip()!r}, expected site_id=public_key')
+        site_keys[key] = site_id
+    return site_keys
+
+
+SITE_KEYS = parse_site_keys(os.getenv('SITE_KEYS'))
+
+
+def bearer_token(auth_header):
+    parts = (auth_header or '').split()
+    return parts[1] if len(parts) > 1 else None
+
+
+def site_for_token(token):
+    # The site a public key belongs to, or None for the global PUBLIC_AUTH_TOKEN and unknown keys
+    return SITE_KEYS.get(token) if token else None
+
+
+def site_artifacts_dir(site_id, sites_dir=SITES_DIR):
+    if not SITE_ID_PATTERN.match(site_id):
+        raise ValueError(f'Invalid site id {site_id!r}')
+    return os.path.join(sites_dir, site_id)
+
+
+class TenantModelCache:
+    def __init__(self, memory_budget=256 * 1024 * 1024, check_interval=30, sites_dir=SITES_DIR):
+        self.memory_budget = memory_budget
+        self.check_interval = check_interval
+        self.sites_dir = sites_dir
+        # site_id -> (bundle or None when the site has no bundle, size in bytes, checked_at)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks = {}
+        self.memory_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.load_failures = 0
+        self.evictions = 0
+        self.fallbacks = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            memory_budget=int(float(os.getenv('TENANT_MODEL_CACHE_MB', '256')) * 1024 * 1024),
+            check_interval=float(os.getenv('TENANT_MODEL_CHECK_SECONDS', '30'))
+        )
+
+    def get(self, site_id, now=None):
+        # Returns the (model, encoder, linear screen) of the site, or None when the global model has to be used
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(site_id)
+            if entry is not None and now - entry[2] < self.check_interval:
+                self._entries.move_to_end(site_id)
+                self.hits += 1
+                return self._result(entry[0])
+            self.misses += 1
+            load_lock = self._load_locks.setdefault(site_id, threading.Lock())
+
+        # One load per site at a time; other sites are served meanwhile
+        with load_lock:
+            with self._lock:
+                entry = self._entries.get(site_id)
+                if entry is not None and now - entry[2] < self.check_interval:
+                    return self._result(entry[0])
+            bundle = entry[0] if entry is not None else None
+            bundle_path = latest_bundle_path(site_artifacts_dir(site_id, self.sites_dir))
+            if bundle_path is None:
+                bundle = None
+            elif bundle is None or bundle.path != bundle_path:
+                bundle = self._load(site_id, bundle_path, bundle)
+            size = os.path.getsize(os.path.join(bundle.path, MODEL_FILE)) if bundle is not None else 0
+            with self._lock:
+                self._store(site_id, (bundle, size, now))
+                return self._result(bundle)
+
+    def _load(self, site_id, bundle_path, previous):
+        try:
+            bundle = load_bundle(bundle_path)
+        except ModelBundleError as e:
+            # Keep serving the previous bundle of the site (or the global model) rather than failing requests
+            logging.error(f'Failed to load model bundle of site {site_id}: {e}')
+            with self._lock:
+                self.load_failures += 1
+            return previous
+        with self._lock:
+            self.loads += 1
+        return bundle
+
+    def _result(self, bundle):
+        # Called with the lock held
+        if bundle is None:
+            self.fallbacks += 1
+            return None
+        return bundle.model, bundle.encoder, bundle.linear
+
+    def _store(self, site_id, entry):
+        previous = self._entries.pop(site_id, None)
+        if previous is not None:
+            self.memory_used -= previous[1]
+        self._entries[site_id] = entry
+        self.memory_used += entry[1]
+        # Least recently used first; the entry just stored stays even if it alone exceeds the budget
+        while self.memory_used > self.memory_budget and len(self._entries) > 1:
+            evicted_id, evicted = self._entries.popitem(last=False)
+            self.memory_used -= evicted[1]
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sites_cached': sum(1 for bundle, _, _ in self._entries.values() if bundle is not None),
+                'sites_without_model': sum(1 for bundle, _, _ in self._entries.values() if bundle is None),
+                'memory_used': self.memory_used,
+                'memory_budget': self.memory_budget,
+                'hits': self.hits,
+                'misses': self.misses,
+                'loads': self.loads,
+                'load_failures': self.load_failures,
+                'evictions': self.evictions,
+                'fallbacks': self.fallbacks
+            }
@@ -0,0 +1,230 @@
+import os
+import json
+import hmac
+import time
+import queue
+import atexit
+import random
+import hashlib
+import logging
+import threading
+
+##################
+# Traffic capture
+#
+# Opt-in recording of the challenge traffic a worker receives, to replay it against another
+# build with benchmarks/replay_traffic.py. For every POST to /api/challenge and
+# /api/challenge/events it records the arrival time, the sanitized request body, the
+# User-Agent, a pseudonym of the session_id cookie, the site the key belongs to, and the
+# status, latency and score the worker answered with.
+#
+# Sanitizing: the Authorization header and client address are never recorded, the session
+# cookie is replaced by a keyed hash (TRAFFIC_CAPTURE_SALT; set the same salt on every worker
+# so sessions spread over workers keep one pseudonym) and typed characters are masked in key
+# presses (letters become 'a', digits '0', other characters '.'; named keys such as
+# Backspace are kept). Features only use the timing of key presses, so scores do not change.
+#
+# Sessions are sampled as a whole (TRAFFIC_CAPTURE_SAMPLE_RATE) so streamed events are kept
+# with their challenge. Like the access log, records are written by a background thread and
+# dropped (and counted) when its queue is full. The file rotates at TRAFFIC_CAPTURE_MAX_MB
+# into <file>.1 ... <file>.<TRAFFIC_CAPTURE_BACKUPS>. With several worker processes, put
+# {pid} in TRAFFIC_CAPTURE so each worker rotates its own file.
+##################
+
+CAPTURED_PATHS = ('/api/challenge', '/api/challenge/events')
+_STOP = object()
+
+
+def mask_key(key):
+    if not isinstance(key, str) or len(key) != 1:
+        return key
+    if key.isalpha():
+        return 'a'
+    if key.isdigit():
+        return '0'
+    return '.'
+
+
+def sanitize_body(path, body):
+    # The request body with typed characters masked; None when it is not a JSON object
+    try:
+        data = json.loads(body)
+    except (ValueError, UnicodeDecodeError):
+        return None
+    if not isinstance(data, dict):
+        return None
+    payload = data.get('data') if path == '/api/challenge' else data
+    interactions = payload.get('interactions') if isinstance(payload, dict) else None
+    key_presses = interactions.get('keyPresses') if isinstance(interactions, dict) else None
+    if isinstance(key_presses, list):
+        for key_press in key_presses:
+            if isinstance(key_press, dict) and 'key' in key_press:
+                key_press['key'] = mask_key(key_press['key'])
+    return data
+
+
+def token_score(response_body):
+    # The score signed into the challenge token, read without checking the signature
+    import jwt
+    try:
+        token = json.loads(response_body).get('token')
+        return jwt.decode(token, options={'verify_signature': False}).get('score') if token else None
+    except (ValueError, AttributeError, jwt.PyJWTError):
+        return None
+
+
+class TrafficCapture:
+    def __init__(self, path=None, sample_rate=1.0, max_bytes=64 * 1024 * 1024, backups=5, queue_size=10000, salt=None):
+        self.path = path.format(pid=os.getpid()) if path else None
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._salt = (salt or os.urandom(16).hex()).encode('utf-8')
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._file = None
+        self.captured = 0
+        self.sampled_out = 0
+        self.dropped = 0
+        self.written = 0
+        self.rotations = 0
+        self._listener = None
+        if self.path is not None:
+            self._listener = threading.Thread(target=self._listen, name='traffic-capture', daemon=True)
+            self._listener.start()
+            atexit.register(self.close)
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            path=os.getenv('TRAFFIC_CAPTURE'),
+            sample_rate=float(os.getenv('TRAFFIC_CAPTURE_SAMPLE_RATE', '1.0')),
+            max_bytes=int(float(os.getenv('TRAFFIC_CAPTURE_MAX_MB', '64')) * 1024 * 1024),
+            backups=int(os.getenv('TRAFFIC_CAPTURE_BACKUPS', '5')),
+            salt=os.getenv('TRAFFIC_CAPTURE_SALT')
+        )
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def _count(self, counter, amount=1):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+
+    def pseudonym(self, session_id):
+        return hmac.new(self._salt, session_id.encode('utf-8'), hashlib.sha256).hexdigest()[:32] if session_id else None
+
+    def _sampled(self, session):
+        if self.sample_rate >= 1:
+            return True
+        if session is None:
+            return random.random() < self.sample_rate
+        # Same decision for every request of a session
+        return int(session[:8], 16) / 0x100000000 < self.sample_rate
+
+    def record(self, method, path, started_at, request_body, user_agent, session_id, site_id, status, response_body):
+        # Called on the request thread: parsing, sanitizing and writing happen in the listener
+        if self.path is None or method != 'POST' or path not in CAPTURED_PATHS:
+            return
+        latency = time.perf_counter() - started_at
+        session = self.pseudonym(session_id)
+        if not self._sampled(session):
+            self._count('sampled_out')
+            return
+        entry = (time.time() - latency, path, request_body, user_agent, session, site_id, status, latency, response_body)
+        try:
+            self._queue.put_nowait(entry)
+            self._count('captured')
+        except queue.Full:
+            self._count('dropped')
+
+    def _format(self, entry):
+        arrived_at, path, request_body, user_agent, session, site_id, status, latency, response_body = entry
+        return json.dumps({
+            'time': round(arrived_at, 6),
+            'path': path,
+            'body': sanitize_body(path, request_body),
+            'user_agent': user_agent,
+            'session': session,
+            'site_id': site_id,
+            'status': status,
+            'latency_ms': round(latency * 1000, 3),
+            'score': token_score(response_body) if path == '/api/challenge' and status == 200 else None
+        })
+
+    def _write(self, entries):
+        data = ''.join(self._format(entry) + '\n' for entry in entries).encode('utf-8')
+        try:
+            if self._file is not None and self._file.tell() and self._file.tell() + len(data) > self.max_bytes:
+                self._rotate()
+            if self._file is None:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self._file = open(self.path, 'ab')
+            self._file.write(data)
+            self._file.flush()
+        except OSError as e:
+            logging.error(f'Failed to write {len(entries)} captured requests: {e}')
+            return
+        self._count('written', len(entries))
+
+    def _rotate(self):
+        # <file> -> <file>.1 -> ... -> <file>.<backups>, the oldest is deleted
+        self._file.close()
+        self._file = None
+        for index in range(self.backups, 0, -1):
+            source = f'{self.path}.{index - 1}' if index > 1 else self.path
+            if os.path.exists(source):
+                os.replace(source, f'{self.path}.{index}')
+        if self.backups == 0:
+            os.remove(self.path)
+        self._count('rotations')
+
+    def _listen(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < 256:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = any(entry is _STOP for entry in batch)
+            batch = [entry for entry in batch if entry is not _STOP]
+            if batch:
+                self._write(batch)
+            if stop:
+                return
+
+    def flush(self, timeout=5.0):
+        # Waits until every record captured so far has been written
+        deadline = time.monotonic() + timeout
+        while self._listener is not None and time.monotonic() < deadline:
+            with self._lock:
+                if self.written >= self.captured:
+                    return True
+            time.sleep(0.005)
+        return self._listener is None
+
+    def close(self):
+        if self._listener is None or not self._listener.is_alive():
+            return
+        self._queue.put(_STOP)
+        self._listener.join(timeout=5.0)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'captured': self.captured,
+                'written': self.written,
+                'sampled_out': self.sampled_out,
+                'dropped': self.dropped,
+                'rotations': self.rotations,
+                'queued': self._queue.qsize(),
+                'sample_rate': self.sample_rate
+            }
@@ -4,20 +4,44 @@ store_schema = {
     'type': 'object',
     'properties': {
         'data': {'type': 'string'},
-        'session_id': {'type': 'string'}
+        'session_id': {'type': 'string'},
+        'site_id': {'type': 'string', 'pattern': '^[A-Za-z0-9_-]{1,64}$'}
     },
     'required': ['data']
 }
 
+# Interaction ids name files in data/, so path separators and dots are refused
+interaction_id_schema = {'type': 'string', 'pattern': '^[A-Za-z0-9_-]{1,64}$'}
+
 update_schema = {
     'type': 'object',
     'properties': {
-        'interaction_id': {'type': 'string'},
+        'interaction_id': interaction_id_schema,
         'label': {'type': 'number'}
     },
     'required': ['interaction_id', 'label']
 }
 
+update_batch_schema = {
+    'type': 'object',
+    'properties': {
+        'updates': {
+            'type': 'array',
+            'minItems': 1,
+            'maxItems': 10000,
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'interaction_id': interaction_id_schema,
+                    'label': {'type': 'number'}
+                },
+                'required': ['interaction_id', 'label']
+            }
+        }
+    },
+    'required': ['updates']
+}
+
 # JSON schema for interaction payload validation
 interaction_payload_schema = {
     'type': 'object',
@@ -98,4 +122,43 @@ interaction_payload_schema = {
         'viewPort': {'type': 'object', 'properties': {'width': {'type': 'number'}, 'height': {'type': 'number'}}},
     },
     'required': ['interactions', 'duration', 'viewport', 'loadTimestamp']
-}
\ No newline at end of file
+}
+# Id captcha.js draws for each page (stream) whose events are streamed to /api/challenge/events
+stream_id_schema = {'type': 'string', 'pattern': '^[A-Za-z0-9_-]{8,64}$'}
+
+# Sequence number of a chunk within its stream, starting at 0; a retried chunk keeps its number
+chunk_seq_schema = {'type': 'integer', 'minimum': 0}
+
+# JSON schema for a chunk of interaction events streamed during the session
+interaction_chunk_schema = {
+    'type': 'object',
+    'properties': {
+        'streamId': stream_id_schema,
+        'seq': chunk_seq_schema,
+        'interactions': interaction_payload_schema['properties']['interactions']
+    },
+    'required': ['streamId', 'seq', 'interactions']
+}
+
+# JSON schema of the streaming fields of a /api/challenge body (next to data and save)
+challenge_stream_schema = {
+    'type': 'object',
+    'properties': {
+        'streamId': stream_id_schema,
+        # Number of chunks streamed with streamId, including those in chunks
+        'streamedChunks': chunk_seq_schema,
+        # Chunks the page could not deliver before the challenge, in order
+        'chunks': {
+            'type': 'array',
+            'maxItems': 64,
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'seq': chunk_seq_schema,
+                    'interactions': interaction_payload_schema['properties']['interactions']
+                },
+                'required': ['seq', 'interactions']
+            }
+        }
+    }
+}